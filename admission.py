@@ -0,0 +1,187 @@
+import time
+import asyncio
+from collections import deque
+from typing import Any, Optional
+
+# 按路径划分请求类别，数值越小优先级越高
+INTERACTIVE = "interactive"
+INGEST = "ingest"
+MAINTENANCE = "maintenance"
+PRIORITIES = {INTERACTIVE: 0, INGEST: 1, MAINTENANCE: 2}
+
+INGEST_PATHS = {"/rag/store", "/rag/batch_store", "/rag/update", "/rag/delete", "/rag/batch_update", "/rag/batch_delete"}
+MAINTENANCE_PATHS = {"/rag/release_disk", "/rag/tune", "/rag/migrate", "/rag/reclaim", "/rag/stats"}
+MAINTENANCE_PREFIXES = ("/rag/delete_collection/", "/rag/create_collection/", "/rag/sharded/create/")
+# 只读取内存状态的接口不需要排队
+EXEMPT_PATHS = {"/rag/admission", "/rag/ingest", "/rag/disk", "/rag/embedding_stats", "/rag/migrations"}
+
+
+def classify(path: str) -> Optional[str]:
+    """
+    判断请求所属的类别，不受准入控制的请求返回None。
+    """
+    if not path.startswith("/rag/") or path in EXEMPT_PATHS \
+            or path.startswith(("/rag/ingest/", "/rag/migrations/", "/rag/admin/")):
+        return None
+    if path in INGEST_PATHS or (path.startswith("/rag/sharded/") and path.endswith(("/store", "/delete"))):
+        return INGEST
+    if path in MAINTENANCE_PATHS or path.startswith(MAINTENANCE_PREFIXES) \
+            or (path.startswith("/rag/sharded/") and path.endswith("/drop")):
+        return MAINTENANCE
+    return INTERACTIVE
+
+
+class Rejected(Exception):
+    """
+    请求未被接纳。队列已满时状态码为429，排队超时时为503。
+    """
+    def __init__(self, status_code: int, retry_after: float, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.detail = detail
+
+
+class Lane:
+    """
+    一类请求的并发上限、排队上限和统计信息。
+
+    :param name: 类别名称
+    :param workers: 同时处理的最大请求数
+    :param queue: 最多排队的请求数
+    :param max_wait: 最长排队时间（秒），超过时返回503
+    """
+    def __init__(self, name: str, workers: int, queue: int, max_wait: float):
+        if workers <= 0 or queue < 0:
+            raise ValueError(f"invalid limits for {name}")
+        self.name = name
+        self.priority = PRIORITIES[name]
+        self.workers = workers
+        self.queue_limit = queue
+        self.max_wait = max_wait
+        self.active = 0
+        self.waiters: deque[asyncio.Future] = deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.wait_ms = 0.0
+        self.service_ms = 0.0
+        self.waits: deque[float] = deque(maxlen=1000)
+
+    def stats(self) -> dict[str, Any]:
+        waits = sorted(self.waits)
+        return {
+            "workers": self.workers,
+            "active": self.active,
+            "queue_depth": len(self.waiters),
+            "queue_limit": self.queue_limit,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "wait_ms_mean": round(self.wait_ms, 2),
+            "wait_ms_p95": round(waits[int(len(waits) * 0.95)], 2) if waits else 0.0,
+            "service_ms_mean": round(self.service_ms, 2),
+        }
+
+
+class AdmissionController:
+    """
+    准入控制与优先级调度：每类请求有独立的并发上限和有界队列，所有类别共享总并发上限。
+    有空闲名额时按优先级唤醒排队的请求，交互查询总是先于写入和维护任务。
+    队列已满时立即拒绝（429），排队超过max_wait时放弃（503），都附带建议的重试间隔。
+    只在事件循环线程中使用，不需要加锁。
+
+    :param total_workers: 所有类别合计的最大并发数
+    :param lanes: 各类别的 Lane
+    """
+    def __init__(self, total_workers: int, lanes: list[Lane]):
+        self.total_workers = total_workers
+        self.lanes = {lane.name: lane for lane in lanes}
+        self.ordered = sorted(lanes, key=lambda lane: lane.priority)
+        self.active = 0
+
+    def has_capacity(self, lane: Lane) -> bool:
+        return lane.active < lane.workers and self.active < self.total_workers
+
+    def retry_after(self, lane: Lane) -> float:
+        # 按排队数量和平均处理时间估算
+        per_request = max(lane.service_ms, 100.0) / 1000
+        return round(min(max((len(lane.waiters) + 1) * per_request / lane.workers, 1.0), 60.0), 1)
+
+    async def acquire(self, name: str) -> float:
+        """
+        等待处理名额。
+
+        :param name: 请求类别
+        :return: 排队时间（毫秒）
+        """
+        lane = self.lanes[name]
+        start = time.monotonic()
+        # 同类别有人排队时按先后顺序；更高优先级的类别有人在等总名额时让路
+        blocked = bool(lane.waiters) or any(other.waiters and other.active < other.workers
+                                            for other in self.ordered if other.priority < lane.priority)
+        if self.has_capacity(lane) and not blocked:
+            self.admit(lane)
+        else:
+            if len(lane.waiters) >= lane.queue_limit:
+                lane.rejected += 1
+                raise Rejected(429, self.retry_after(lane), f"{name} queue is full")
+            future = asyncio.get_running_loop().create_future()
+            lane.waiters.append(future)
+            try:
+                await asyncio.wait_for(asyncio.shield(future), timeout=lane.max_wait)
+            except asyncio.TimeoutError:
+                if future.done():
+                    # 超时的同时已被唤醒，名额已经分配
+                    pass
+                else:
+                    future.cancel()
+                    lane.waiters.remove(future)
+                    lane.timeouts += 1
+                    raise Rejected(503, self.retry_after(lane), f"{name} request waited too long")
+            except asyncio.CancelledError:
+                # 客户端断开
+                if future.done() and not future.cancelled():
+                    self.release(name)
+                else:
+                    future.cancel()
+                    if future in lane.waiters:
+                        lane.waiters.remove(future)
+                raise
+        waited = (time.monotonic() - start) * 1000
+        lane.waits.append(waited)
+        lane.wait_ms = 0.9 * lane.wait_ms + 0.1 * waited
+        return waited
+
+    def admit(self, lane: Lane) -> None:
+        lane.active += 1
+        lane.admitted += 1
+        self.active += 1
+
+    def release(self, name: str, service_ms: Optional[float] = None) -> None:
+        lane = self.lanes[name]
+        lane.active -= 1
+        self.active -= 1
+        if service_ms is not None:
+            lane.service_ms = service_ms if lane.service_ms == 0 else 0.9 * lane.service_ms + 0.1 * service_ms
+        self.dispatch()
+
+    def dispatch(self) -> None:
+        for lane in self.ordered:
+            while lane.waiters and self.has_capacity(lane):
+                future = lane.waiters.popleft()
+                if future.done():
+                    continue
+                self.admit(lane)
+                future.set_result(None)
+            if lane.waiters and self.active >= self.total_workers:
+                # 总名额已满，低优先级类别继续等待
+                return
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "total_workers": self.total_workers,
+            "active": self.active,
+            "queue_depth": sum(len(lane.waiters) for lane in self.ordered),
+            "lanes": {lane.name: lane.stats() for lane in self.ordered},
+        }
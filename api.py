@@ -1,15 +1,24 @@
 from dataclasses import dataclass
 from typing import List
+import os
+import threading
+import time
 import subprocess
 import base64
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 import json
 import requests
 from typing import Union
 import logging
+import asyncio
 import httpx
-import aiofiles
 import pathlib
+from tokens import message_tokens
+from conversation_store import ConversationIndex, ConversationLog, conversation_title
+from semantic_cache import SemanticCache
 
 class Base_llm:
     """
@@ -23,6 +32,9 @@ class Base_llm:
     :param system_prompt: 系统提示，默认为空
     :param limit: 聊天记录的最大长度限制，默认为"128k"
     :param proxy: 代理设置，默认为本地代理
+    :param verify_tokens: 本地裁剪聊天记录后是否再调用远程tokenizer确认，默认为否
+    :param semantic_cache: SemanticCache实例，传入时send先查找语义缓存，默认不启用
+    :param cache_namespace: 语义缓存的租户命名空间
     """
     def __init__(self,
                  api_key: str,
@@ -36,6 +48,9 @@ class Base_llm:
                      'http': 'http://127.0.0.1:7890',
                      'https': 'http://127.0.0.1:7890',
                  },
+                 verify_tokens: bool = False,
+                 semantic_cache: Union[SemanticCache, None] = None,
+                 cache_namespace: str = "",
                  ):
         self.base_url = base_url
         self.model = model
@@ -50,17 +65,27 @@ class Base_llm:
                 raise ValueError("storage path is not valid")
         else:
             self.storage = None
+        self.index: Union[ConversationIndex, None] = None
+        self.log: Union[ConversationLog, None] = None
+        # 按窗口加载时 store_history 只包含从 store_offset 开始的消息
+        self.store_offset = 0
+        # 上次保存或加载时的对话ID和消息快照，用于判断保存时需要追加哪些消息
+        self.persisted: Union[dict, None] = None
         self.tools = tools
         self.len_map = {"8k": 8000, "16k": 16000,
                         "32k": 32000, "64k": 64000, "128k": 128000}
         self.max_len = self.len_map.get(limit, 128000)
         self.proxy = proxy
+        # chat_history 中每条消息的本地token估算，与 chat_history 一一对应
+        self.history_tokens: list[int] = []
+        # 根据API返回的prompt_tokens校准本地估算的比例
+        self.token_scale = 1.0
+        self.verify_tokens = verify_tokens
+        self.semantic_cache = semantic_cache
+        self.cache_namespace = cache_namespace
 
         if system_prompt:
-            self.chat_history.append(
-                {"role": "system", "content": system_prompt})
-            self.store_history.append(
-                {"role": "system", "content": system_prompt})
+            self.append_history([{"role": "system", "content": system_prompt}])
 
     def clear_history(self):
         """
@@ -68,10 +93,76 @@ class Base_llm:
         """
         if self.chat_history and self.chat_history[0].get("role") == "system":
             self.chat_history = [self.chat_history[0]]
-            self.store_history = [self.store_history[0]]
+            if self.store_offset > 0:
+                # 按窗口加载时系统提示不在store_history中，保留文件中下标0的系统提示
+                self.store_history = []
+                self.store_offset = 1
+            else:
+                self.store_history = [self.store_history[0]]
         else:
             self.chat_history = []
             self.store_history = []
+            self.store_offset = 0
+        self.history_tokens = [message_tokens(message) for message in self.chat_history]
+
+    def append_history(self, messages: list[dict]):
+        """
+        追加消息到聊天记录，并增量更新每条消息的token估算。
+
+        :param messages: 消息列表
+        """
+        self.sync_tokens()
+        self.chat_history += messages
+        self.store_history += messages
+        self.history_tokens += [message_tokens(message) for message in messages]
+
+    def sync_tokens(self):
+        """
+        聊天记录被外部直接修改导致与token缓存不一致时重新计算。
+        """
+        if len(self.history_tokens) != len(self.chat_history):
+            self.history_tokens = [message_tokens(message) for message in self.chat_history]
+
+    def count_tokens(self) -> int:
+        """
+        在本地估算当前聊天记录的token数量，不发起请求。
+
+        :return: 估算的token数量
+        """
+        self.sync_tokens()
+        return int(sum(self.history_tokens) * self.token_scale)
+
+    def calibrate(self, messages: list[dict], usage: dict):
+        """
+        用API返回的prompt_tokens校准本地估算的比例。
+
+        :param messages: 本次发送的消息列表
+        :param usage: API返回的usage
+        """
+        prompt_tokens = usage.get("prompt_tokens") if usage else None
+        estimated = sum(message_tokens(message) for message in messages)
+        if prompt_tokens and estimated:
+            self.token_scale = 0.8 * self.token_scale + 0.2 * prompt_tokens / estimated
+
+    def trim_range(self, reserve: int = 0):
+        """
+        一次性计算需要删除的最早对话轮次，使估算的token数量低于上限。
+        每轮对话从一条用户消息开始，到下一条用户消息之前结束，最后一轮对话总是保留。
+
+        :param reserve: 为即将追加的内容预留的token数量
+        :return: 需要删除的消息下标范围 (start, end)
+        """
+        total = self.count_tokens() + reserve
+        starts = [index for index, message in enumerate(self.chat_history) if message.get("role") == "user"]
+        if total < self.max_len or len(starts) < 2:
+            return 0, 0
+        cut = starts[0]
+        for next_start in starts[1:]:
+            total -= int(sum(self.history_tokens[cut:next_start]) * self.token_scale)
+            cut = next_start
+            if total < self.max_len:
+                break
+        return starts[0], cut
 
     def send(self, messages: Union[dict, list[dict]]):
         """
@@ -81,34 +172,30 @@ class Base_llm:
         :return: API返回的消息
         """
         logging.info(f"send args: {messages}")
+        cache_key = self.cache_key([messages] if isinstance(messages, dict) else messages)
+        if cache_key:
+            cached = self.semantic_cache.lookup(*cache_key, namespace=self.cache_namespace) # type: ignore
+            if cached:
+                self.append_history(([messages] if isinstance(messages, dict) else messages) + [cached])
+                return cached
         url = f"{self.base_url}/chat/completions"
         with self.client as client:
-            if isinstance(messages, dict):
-                payload = {"model": self.model,
-                           "messages": self.chat_history+[messages]}
-            else:
-                payload = {"model": self.model,
-                           "messages": self.chat_history+messages}
-            if self.tools:
-                payload.update({"tools": self.tools})
+            payload = self.build_payload([messages] if isinstance(messages, dict) else messages)
             try:
                 response = client.post(url, json=payload, proxies=self.proxy)
             except Exception as e:
                 raise e
             if response.status_code == 200:
-                if isinstance(messages, dict):
-                    self.chat_history.append(messages)
-                    self.store_history.append(messages)
-                else:
-                    self.chat_history += messages
-                    self.store_history += messages
+                self.append_history([messages] if isinstance(messages, dict) else messages)
                 result = response.json()
+                self.calibrate(payload["messages"], result.get("usage"))
                 total_tokens = result.get("usage").get("total_tokens")
                 if total_tokens >= self.max_len:
                     self.del_earliest_history()
                 message = result["choices"][0]["message"]
-                self.chat_history.append(message)
-                self.store_history.append(message)
+                self.append_history([message])
+                if cache_key:
+                    self.semantic_cache.store(*cache_key, message, namespace=self.cache_namespace) # type: ignore
                 return message
             else:
                 try:
@@ -117,9 +204,139 @@ class Base_llm:
                     error_info = response.text
                 raise Exception(f"{response.status_code} : {error_info}")
 
+    def cache_key(self, messages: list[dict]):
+        """
+        计算语义缓存的查找键。只有最后一条消息是纯文本的用户消息时才使用缓存。
+
+        :param messages: 本次新增的消息列表
+        :return: (用户消息文本, 系统提示、工具和模型的哈希)，不使用缓存时返回None
+        """
+        if not self.semantic_cache or not messages or messages[-1].get("role") != "user":
+            return None
+        content = messages[-1].get("content")
+        if isinstance(content, list):
+            if any(part.get("type") != "text" for part in content):
+                return None
+            content = "\n".join(part.get("text", "") for part in content)
+        if not isinstance(content, str) or not content:
+            return None
+        history = self.chat_history + messages
+        system_prompt = history[0].get("content", "") if history[0].get("role") == "system" else ""
+        return content, self.semantic_cache.context_hash(system_prompt, self.tools, self.model)
+
+    def build_payload(self, messages: list[dict], stream: bool = False):
+        """
+        构造chat/completions请求体。
+
+        :param messages: 本次新增的消息列表
+        :param stream: 是否使用流式输出
+        :return: 请求体
+        """
+        payload = {"model": self.model,
+                   "messages": self.chat_history+messages}
+        if self.tools:
+            payload.update({"tools": self.tools})
+        if stream:
+            payload.update({"stream": True, "stream_options": {"include_usage": True}})
+        return payload
+
+    def merge_delta(self, message: dict, delta: dict):
+        """
+        把流式返回的一个delta合并到正在拼接的消息中，tool_calls按index拼接name和arguments。
+
+        :param message: 正在拼接的消息
+        :param delta: 流式返回的delta
+        :return: 本次新增的文本内容
+        """
+        content = delta.get("content") or ""
+        if content:
+            message["content"] = (message.get("content") or "") + content
+        for call in delta.get("tool_calls") or []:
+            tool_calls = message.setdefault("tool_calls", [])
+            index = call.get("index", len(tool_calls))
+            while len(tool_calls) <= index:
+                tool_calls.append({"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+            target = tool_calls[index]
+            if call.get("id"):
+                target["id"] = call["id"]
+            if call.get("type"):
+                target["type"] = call["type"]
+            function = call.get("function") or {}
+            target["function"]["name"] += function.get("name") or ""
+            target["function"]["arguments"] += function.get("arguments") or ""
+        return content
+
+    def parse_sse(self, line: str):
+        """
+        解析一行SSE数据。
+
+        :param line: SSE中的一行
+        :return: 解析后的数据块，非数据行返回None，结束标记返回False
+        """
+        if not line or not line.startswith("data:"):
+            return None
+        data = line[5:].strip()
+        if data == "[DONE]":
+            return False
+        return json.loads(data)
+
+    def finish_stream(self, messages: list[dict], payload: dict, message: dict, usage: Union[dict, None]):
+        """
+        流式输出结束后，与非流式发送一样把消息写入聊天记录。
+
+        :param messages: 本次新增的消息列表
+        :param payload: 请求体
+        :param message: 拼接完成的助手消息
+        :param usage: 最后一个数据块中的usage
+        """
+        self.append_history(messages)
+        if usage:
+            self.calibrate(payload["messages"], usage)
+            if usage.get("total_tokens", 0) >= self.max_len:
+                self.del_earliest_history()
+        self.append_history([message])
+
+    def send_stream(self, messages: Union[dict, list[dict]]):
+        """
+        以流式方式发送消息，边接收边产出文本增量，结束后把完整消息写入聊天记录。
+
+        :param messages: 要发送的消息，可以是单个消息或消息列表
+        :return: 文本增量的迭代器
+        """
+        logging.info(f"send_stream args: {messages}")
+        messages = [messages] if isinstance(messages, dict) else messages
+        url = f"{self.base_url}/chat/completions"
+        payload = self.build_payload(messages, stream=True)
+        response = self.client.post(url, json=payload, proxies=self.proxy, stream=True)
+        with response:
+            if response.status_code != 200:
+                try:
+                    error_info = response.json()
+                except Exception:
+                    error_info = response.text
+                raise Exception(f"{response.status_code} : {error_info}")
+            # SSE规定使用UTF-8，响应头没有charset时requests会按ISO-8859-1解码
+            response.encoding = "utf-8"
+            message: dict = {"role": "assistant", "content": None}
+            usage = None
+            for line in response.iter_lines(decode_unicode=True):
+                chunk = self.parse_sse(line)
+                if chunk is False:
+                    break
+                if not chunk:
+                    continue
+                if chunk.get("usage"):
+                    usage = chunk["usage"]
+                for choice in chunk.get("choices") or []:
+                    content = self.merge_delta(message, choice.get("delta") or {})
+                    if content:
+                        yield content
+        self.finish_stream(messages, payload, message, usage)
+
     def save(self, id: str = ""):
         """
         保存当前聊天记录到文件。
+        与上次保存或加载的是同一对话时只追加新增的消息。
 
         :param id: 文件ID，如果未提供则生成一个UUID
         :return: 文件ID
@@ -128,30 +345,116 @@ class Base_llm:
             raise ValueError("storage path is not valid")
         if not id:
             id = str(uuid4())
-        save_path = self.storage / f"{id or uuid4()}.json"
-        with save_path.open("w", encoding="utf-8") as f:
-            json.dump(self.store_history, f, ensure_ascii=False, indent=4)
+        self.persist(id)
         return id
 
-    def load(self, id: str):
+    def persist(self, id: str):
+        """
+        把store_history写入JSONL对话日志并更新索引。
+
+        :param id: 对话ID
+        """
+        log = self.get_log()
+        state = self.persisted
+        offset = self.store_offset
+        total = offset + len(self.store_history)
+        garbage = 0
+        title = conversation_title(self.store_history) if offset == 0 else None
+        if state is None or state["id"] != id or not log.exists(id) or offset < state["offset"]:
+            history = self.store_history
+            if offset > 0:
+                # 按窗口加载后另存为新对话，从原对话补全窗口之前的消息
+                if state is None:
+                    raise ValueError("history before the loaded window is unavailable")
+                history = log.read(state["id"], resolve=False)[:offset] + history
+                title = conversation_title(history)
+            log.rewrite(id, history)
+        else:
+            snapshot = state["snapshot"]
+            shift = offset - state["offset"]
+            same = 0
+            while same < len(self.store_history) and shift + same < len(snapshot) \
+                    and self.store_history[same] is snapshot[shift + same]:
+                same += 1
+            start = offset + same
+            saved_total = state["offset"] + len(snapshot)
+            if start == 0 and saved_total > 0:
+                # 第一条消息被改写时整体重写，保证文件第一行总是当前的第一条消息
+                log.rewrite(id, self.store_history)
+            else:
+                garbage = state["garbage"] + max(saved_total - start, 0)
+                log.append(id, start, self.store_history[same:], truncate=start < saved_total)
+                if garbage > max(32, total):
+                    log.compact(id)
+                    garbage = 0
+        legacy_file = self.storage / f"{id}.json" # type: ignore
+        if legacy_file.exists():
+            legacy_file.unlink()
+        self.persisted = {"id": id, "offset": offset, "snapshot": list(self.store_history), "garbage": garbage}
+        self.get_index().upsert(id, title, total)
+
+    def load(self, id: str, tail: int = 0):
         """
         从文件加载聊天记录。
 
         :param id: 文件ID
+        :param tail: 只加载最近的tail条消息（以及开头的系统提示），0 表示全部加载
         :return: 文件ID
         """
         if not self.storage:
             raise ValueError("storage path is not valid")
-        load_path = self.storage / f"{id}.json"
-        with load_path.open("r", encoding="utf-8") as f:
-            data = json.load(f)
-            self.chat_history = data.copy()
-            self.store_history = data.copy()
-            tokens = self.tokenizer(data)
-            if isinstance(tokens, int):
-                if tokens >= self.max_len:
-                    self.limiter()
-            return id
+        self.restore(id, tail)
+        self.limiter()
+        return id
+
+    def restore(self, id: str, tail: int = 0):
+        """
+        读取对话日志到聊天记录，兼容旧的JSON格式文件。
+
+        :param id: 对话ID
+        :param tail: 只加载最近的tail条消息，0 表示全部加载
+        """
+        log = self.get_log()
+        first = None
+        if log.exists(id):
+            if tail > 0:
+                offset, data, first = log.read_tail(id, tail)
+            else:
+                offset, data = 0, log.read(id)
+            self.persisted = {"id": id, "offset": offset, "snapshot": list(data), "garbage": 0}
+        else:
+            with (self.storage / f"{id}.json").open("r", encoding="utf-8") as f: # type: ignore
+                data = json.load(f)
+            offset = 0
+            self.persisted = None
+        self.store_offset = offset
+        self.store_history = data.copy()
+        self.chat_history = ([first] if first and first.get("role") == "system" else []) + data
+        self.history_tokens = [message_tokens(message) for message in self.chat_history]
+
+    def get_index(self):
+        """
+        获取对话索引，首次使用时创建。
+
+        :return: 对话索引
+        """
+        if not self.storage:
+            raise ValueError("storage path is not valid")
+        if self.index is None:
+            self.index = ConversationIndex(self.storage)
+        return self.index
+
+    def get_log(self):
+        """
+        获取JSONL对话日志存储。
+
+        :return: 对话日志存储
+        """
+        if not self.storage:
+            raise ValueError("storage path is not valid")
+        if self.log is None:
+            self.log = ConversationLog(self.storage)
+        return self.log
 
     def sort_files(self, folder_path: str = ""):
         """
@@ -173,30 +476,15 @@ class Base_llm:
                       reverse=True)
         return [f.as_posix() for f in files]
 
-    def get_conversations(self):
+    def get_conversations(self, offset: int = 0, limit: int = -1):
         """
-        获取所有对话记录。
+        获取对话记录，从索引中读取，不打开对话文件。
 
-        :return: 对话记录列表，包含标题和ID
+        :param offset: 跳过的数量
+        :param limit: 返回的数量，-1 表示全部
+        :return: 对话记录列表，包含标题、ID、创建时间、更新时间和消息数量
         """
-        if not self.storage:
-            raise ValueError("storage path is not valid")
-        files = self.sort_files(self.storage.as_posix())
-        conversations = []
-        for file_path in files:
-            with open(file_path, 'r', encoding='utf-8') as file:
-                data = json.load(file)
-                message_exist = False
-                for message in data:
-                    if message.get("role") == "user":
-                        conversations.append({"title": message.get("content")[
-                                             :10], "id": pathlib.Path(file_path).name[:-5]})
-                        message_exist = True
-                        break
-                if not message_exist:
-                    conversations.append(
-                        {"title": None, "id": pathlib.Path(file_path).name[:-5]})
-        return conversations
+        return self.get_index().list(offset, limit)
 
     def delete_conversation(self, id: str):
         """
@@ -208,10 +496,14 @@ class Base_llm:
         if not self.storage:
             raise ValueError("storage path is not valid")
         target_file = self.storage / f"{id}.json"
+        self.get_index().delete(id)
+        if self.persisted and self.persisted["id"] == id:
+            self.persisted = None
+        deleted = self.get_log().delete(id)
         if target_file.exists():
             target_file.unlink()
             return True
-        return False
+        return deleted
 
     def tokenizer(self, data: list[dict[str, str]],
                   url: str = "https://open.bigmodel.cn/api/paas/v4/tokenizer",
@@ -248,16 +540,30 @@ class Base_llm:
                 assistant_index = index
 
         if user_index != -1 and assistant_index != -1:
+            self.sync_tokens()
             del self.chat_history[user_index:assistant_index + 1]
+            del self.history_tokens[user_index:assistant_index + 1]
 
-    def limiter(self):
+    def limiter(self, reserve: int = 0):
         """
         限制聊天记录的长度，确保不超过最大token限制。
+        按本地估算一次性删除需要删除的轮次，verify_tokens为真时再用远程tokenizer确认。
+
+        :param reserve: 为即将追加的内容预留的token数量
         """
+        start, end = self.trim_range(reserve)
+        if end > start:
+            del self.chat_history[start:end]
+            del self.history_tokens[start:end]
+        if not self.verify_tokens:
+            return
         while True:
             tokens = self.tokenizer(self.chat_history)
-            if isinstance(tokens, int) and tokens >= self.max_len:
+            if isinstance(tokens, int) and tokens + reserve >= self.max_len and len(self.chat_history) > 1:
+                before = len(self.chat_history)
                 self.del_earliest_history()
+                if len(self.chat_history) == before:
+                    break
             else:
                 break
 
@@ -306,9 +612,39 @@ class Base_llm:
                     return message.get("content")
         return None
 
+def create_async_client(api_key: str,
+                        proxy: dict = {},
+                        http2: bool = False,
+                        max_connections: int = 100,
+                        max_keepalive_connections: int = 20,
+                        timeout: float = 120.0):
+    """
+    创建长期复用的异步HTTP连接池。
+
+    :param api_key: API密钥
+    :param proxy: 代理设置
+    :param http2: 是否启用HTTP/2，需要安装h2
+    :param max_connections: 最大连接数
+    :param max_keepalive_connections: 最大保持连接数
+    :param timeout: 请求超时时间（秒）
+    :return: httpx.AsyncClient
+    """
+    return httpx.AsyncClient(
+        headers={"Authorization": f"Bearer {api_key}"},
+        proxy=proxy.get('https') or proxy.get('http'),
+        http2=http2,
+        limits=httpx.Limits(max_connections=max_connections,
+                            max_keepalive_connections=max_keepalive_connections),
+        timeout=timeout,
+    )
+
 class Async_Base_llm(Base_llm):
     """
     异步基础大语言模型类，继承自Base_llm，使用异步HTTP客户端。
+    客户端在多次请求之间复用连接，使用完毕后调用aclose或通过async with关闭。
+
+    :param client: 共享的异步HTTP客户端，传入时由调用方负责关闭
+    :param http2: 未传入client时，新建的客户端是否启用HTTP/2
     """
     def __init__(self,
                  api_key: str,
@@ -322,13 +658,29 @@ class Async_Base_llm(Base_llm):
                      'http': 'http://127.0.0.1:7890',
                      'https': 'http://127.0.0.1:7890',
                  },
+                 verify_tokens: bool = False,
+                 client: Union[httpx.AsyncClient, None] = None,
+                 http2: bool = False,
+                 semantic_cache: Union[SemanticCache, None] = None,
+                 cache_namespace: str = "",
                  ):
-        super().__init__(api_key, base_url, model, storage, tools, system_prompt, limit, proxy)
-        self.client = httpx.AsyncClient(
-            headers={"Authorization": f"Bearer {api_key}"},
-            proxy=proxy.get('https') or proxy.get('http')
-        )
+        super().__init__(api_key, base_url, model, storage, tools, system_prompt, limit, proxy, verify_tokens,
+                         semantic_cache, cache_namespace)
+        self.owns_client = client is None
+        self.client = client or create_async_client(api_key, proxy, http2=http2)
+
+    async def aclose(self):
+        """
+        关闭自己创建的HTTP客户端，共享的客户端不关闭。
+        """
+        if self.owns_client:
+            await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
 
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
 
     async def send(self, messages: Union[dict, list[dict]]):
         """
@@ -338,35 +690,30 @@ class Async_Base_llm(Base_llm):
         :return: API返回的消息
         """
         logging.info(f"send args: {messages}")
+        cache_key = self.cache_key([messages] if isinstance(messages, dict) else messages)
+        if cache_key:
+            cached = await asyncio.to_thread(self.semantic_cache.lookup, *cache_key, namespace=self.cache_namespace) # type: ignore
+            if cached:
+                self.append_history(([messages] if isinstance(messages, dict) else messages) + [cached])
+                return cached
         url = f"{self.base_url}/chat/completions"
-        if isinstance(messages, dict):
-            payload = {"model": self.model,
-                        "messages": self.chat_history+[messages]}
-        else:
-            payload = {"model": self.model,
-                        "messages": self.chat_history+messages}
-        if self.tools:
-            payload.update({"tools": self.tools})
+        payload = self.build_payload([messages] if isinstance(messages, dict) else messages)
         try:
-            async with self.client as client:
-                response = await client.post(url, json=payload)
+            response = await self.client.post(url, json=payload)
         except Exception as e:
             raise e
 
         if response.status_code == 200:
-            if isinstance(messages, dict):
-                self.chat_history.append(messages)
-                self.store_history.append(messages)
-            else:
-                self.chat_history += messages
-                self.store_history += messages
+            self.append_history([messages] if isinstance(messages, dict) else messages)
             result = response.json()
+            self.calibrate(payload["messages"], result.get("usage"))
             total_tokens = result.get("usage").get("total_tokens")
             if total_tokens >= self.max_len:
                 self.del_earliest_history()
             message = result["choices"][0]["message"]
-            self.chat_history.append(message)
-            self.store_history.append(message)
+            self.append_history([message])
+            if cache_key:
+                await asyncio.to_thread(self.semantic_cache.store, *cache_key, message, namespace=self.cache_namespace) # type: ignore
             return message
         else:
             try:
@@ -375,6 +722,41 @@ class Async_Base_llm(Base_llm):
                 error_info = response.text
             raise Exception(f"{response.status_code} : {error_info}")
         
+    async def send_stream(self, messages: Union[dict, list[dict]]):
+        """
+        异步流式发送消息，边接收边产出文本增量，结束后把完整消息写入聊天记录。
+
+        :param messages: 要发送的消息，可以是单个消息或消息列表
+        :return: 文本增量的异步迭代器
+        """
+        logging.info(f"send_stream args: {messages}")
+        messages = [messages] if isinstance(messages, dict) else messages
+        url = f"{self.base_url}/chat/completions"
+        payload = self.build_payload(messages, stream=True)
+        message: dict = {"role": "assistant", "content": None}
+        usage = None
+        async with self.client.stream("POST", url, json=payload) as response:
+            if response.status_code != 200:
+                await response.aread()
+                try:
+                    error_info = response.json()
+                except Exception:
+                    error_info = response.text
+                raise Exception(f"{response.status_code} : {error_info}")
+            async for line in response.aiter_lines():
+                chunk = self.parse_sse(line)
+                if chunk is False:
+                    break
+                if not chunk:
+                    continue
+                if chunk.get("usage"):
+                    usage = chunk["usage"]
+                for choice in chunk.get("choices") or []:
+                    content = self.merge_delta(message, choice.get("delta") or {})
+                    if content:
+                        yield content
+        self.finish_stream(messages, payload, message, usage)
+
     async def save(self, id: str = ""):
         """
         异步保存当前聊天记录到文件。
@@ -386,55 +768,32 @@ class Async_Base_llm(Base_llm):
             raise ValueError("storage path is not valid")
         if not id:
             id = str(uuid4())
-        save_path = self.storage / f"{id or uuid4()}.json"
-        async with aiofiles.open(save_path, "w", encoding="utf-8") as f:
-            await f.write(json.dumps(self.store_history, ensure_ascii=False, indent=4))
+        await asyncio.to_thread(self.persist, id)
         return id
 
-    async def load(self, id: str):
+    async def load(self, id: str, tail: int = 0):
         """
         异步从文件加载聊天记录。
 
         :param id: 文件ID
+        :param tail: 只加载最近的tail条消息（以及开头的系统提示），0 表示全部加载
         :return: 文件ID
         """
         if not self.storage:
             raise ValueError("storage path is not valid")
-        load_path = self.storage / f"{id}.json"
-        async with aiofiles.open(load_path, "r", encoding="utf-8") as f:
-            data = json.loads(await f.read())
-            self.chat_history = data.copy()
-            self.store_history = data.copy()
-            tokens = await self.tokenizer(data)
-            if isinstance(tokens, int):
-                if tokens >= self.max_len:
-                    await self.limiter()
-            return id
+        await asyncio.to_thread(self.restore, id, tail)
+        await self.limiter()
+        return id
     
-    async def get_conversations(self):
+    async def get_conversations(self, offset: int = 0, limit: int = -1):
         """
-        异步获取所有对话记录。
+        异步获取对话记录，从索引中读取，不打开对话文件。
 
-        :return: 对话记录列表，包含标题和ID
+        :param offset: 跳过的数量
+        :param limit: 返回的数量，-1 表示全部
+        :return: 对话记录列表，包含标题、ID、创建时间、更新时间和消息数量
         """
-        if not self.storage:
-            raise ValueError("storage path is not valid")
-        files = self.sort_files(self.storage.as_posix())
-        conversations = []
-        for file_path in files:
-            async with aiofiles.open(file_path, 'r', encoding='utf-8') as file:
-                data = json.loads(await file.read())
-                message_exist = False
-                for message in data:
-                    if message.get("role") == "user":
-                        conversations.append({"title": message.get("content")[
-                                             :10], "id": pathlib.Path(file_path).name[:-5]})
-                        message_exist = True
-                        break
-                if not message_exist:
-                    conversations.append(
-                        {"title": None, "id": pathlib.Path(file_path).name[:-5]})
-        return conversations
+        return self.get_index().list(offset, limit)
     
     async def tokenizer(self, data: list[dict[str, str]],
                   url: str = "https://open.bigmodel.cn/api/paas/v4/tokenizer",
@@ -450,8 +809,7 @@ class Async_Base_llm(Base_llm):
         """
         payload = {"model": model, "messages": data}
         try:
-            async with self.client as client:
-                response = await client.post(url, json=payload)
+            response = await self.client.post(url, json=payload)
         except Exception as e:
             raise e
         if response.status_code == 200:
@@ -464,18 +822,173 @@ class Async_Base_llm(Base_llm):
                 error_info = response.text
             raise Exception(f"{response.status_code} : {error_info}")
 
-    async def limiter(self):
+    async def limiter(self, reserve: int = 0):
         """
         异步限制聊天记录的长度，确保不超过最大token限制。
+        按本地估算一次性删除需要删除的轮次，verify_tokens为真时再用远程tokenizer确认。
+
+        :param reserve: 为即将追加的内容预留的token数量
         """
+        start, end = self.trim_range(reserve)
+        if end > start:
+            del self.chat_history[start:end]
+            del self.history_tokens[start:end]
+        if not self.verify_tokens:
+            return
         while True:
             tokens = await self.tokenizer(self.chat_history)
-            if isinstance(tokens, int) and tokens >= self.max_len:
+            if isinstance(tokens, int) and tokens + reserve >= self.max_len and len(self.chat_history) > 1:
+                before = len(self.chat_history)
                 self.del_earliest_history()
+                if len(self.chat_history) == before:
+                    break
             else:
                 break
             
     
+class ConversationEngine:
+    """
+    管理多个独立对话的引擎，所有对话共享一个长期复用的连接池，
+    在全局并发数和速率限制下并发执行各对话的send，同一对话内的请求按顺序执行。
+
+    :param api_key: API密钥
+    :param base_url: API的基础URL
+    :param model: 使用的模型名称
+    :param storage: 聊天记录存储路径，默认为空
+    :param tools: 工具列表，默认为空
+    :param system_prompt: 新对话的系统提示，默认为空
+    :param limit: 聊天记录的最大长度限制，默认为"128k"
+    :param proxy: 代理设置，默认不使用代理
+    :param max_concurrency: 全局最大并发请求数
+    :param rate_limit: 全局每秒最多请求数，0 表示不限
+    :param http2: 是否启用HTTP/2
+    :param max_connections: 连接池最大连接数
+    :param semantic_cache: 所有对话共用的SemanticCache实例，默认不启用
+    :param cache_namespace: 语义缓存的租户命名空间，实际使用时再加上当前知识集合和模型
+    """
+    def __init__(self,
+                 api_key: str,
+                 base_url: str = "https://open.bigmodel.cn/api/paas/v4",
+                 model: str = "glm-4-flash",
+                 storage: str = "",
+                 tools: list = [],
+                 system_prompt: str = "",
+                 limit: str = "128k",
+                 proxy: dict = {},
+                 max_concurrency: int = 16,
+                 rate_limit: float = 0.0,
+                 http2: bool = False,
+                 max_connections: int = 100,
+                 semantic_cache: Union[SemanticCache, None] = None,
+                 cache_namespace: str = "",
+                 ):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.model = model
+        self.storage = storage
+        self.tools = tools
+        self.system_prompt = system_prompt
+        self.limit = limit
+        self.proxy = proxy
+        self.semantic_cache = semantic_cache
+        self.cache_namespace = cache_namespace
+        self.client = create_async_client(api_key, proxy, http2=http2, max_connections=max_connections,
+                                          max_keepalive_connections=min(max_connections, max_concurrency))
+        self.conversations: dict[str, Async_Base_llm] = {}
+        self.locks: dict[str, asyncio.Lock] = {}
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.rate_limit = rate_limit
+        self.next_slot = 0.0
+
+    def get(self, id: str = "") -> tuple[str, Async_Base_llm]:
+        """
+        获取对话，不存在时新建。
+
+        :param id: 对话ID，如果未提供则生成一个UUID
+        :return: 对话ID和对话实例
+        """
+        if not id:
+            id = str(uuid4())
+        if id not in self.conversations:
+            self.conversations[id] = Async_Base_llm(self.api_key, self.base_url, self.model, self.storage,
+                                                    self.tools, self.system_prompt, self.limit, self.proxy,
+                                                    client=self.client, semantic_cache=self.semantic_cache,
+                                                    cache_namespace=self.namespace())
+            self.locks[id] = asyncio.Lock()
+        return id, self.conversations[id]
+
+    def namespace(self):
+        """
+        语义缓存的命名空间，由租户命名空间、语义缓存所用RAG的当前集合和模型组成，
+        不同知识集合或模型的对话不会命中彼此的缓存。
+        """
+        if self.semantic_cache is None:
+            return self.cache_namespace
+        collection = getattr(self.semantic_cache.rag, "collection", None)
+        return ":".join([self.cache_namespace, collection.name if collection is not None else "", self.model])
+
+    def remove(self, id: str):
+        """
+        移除对话。
+
+        :param id: 对话ID
+        :return: 是否移除成功
+        """
+        self.locks.pop(id, None)
+        return self.conversations.pop(id, None) is not None
+
+    async def throttle(self):
+        """
+        按全局速率限制为请求分配发送时间，必要时等待。
+        """
+        if self.rate_limit <= 0:
+            return
+        now = asyncio.get_running_loop().time()
+        # 先占用时间槽再等待，单线程事件循环中这一段不会被打断
+        wait = self.next_slot - now
+        self.next_slot = max(now, self.next_slot) + 1 / self.rate_limit
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def send(self, id: str, messages: Union[dict, list[dict]]):
+        """
+        在指定对话中发送消息，对话不存在时新建。
+
+        :param id: 对话ID
+        :param messages: 要发送的消息，可以是单个消息或消息列表
+        :return: API返回的消息
+        """
+        id, conversation = self.get(id)
+        async with self.locks[id]:
+            # 当前集合可能在对话创建后切换，每次发送前重新计算
+            conversation.cache_namespace = self.namespace()
+            async with self.semaphore:
+                await self.throttle()
+                return await conversation.send(messages)
+
+    async def send_many(self, items: dict[str, Union[dict, list[dict]]]):
+        """
+        并发地在多个对话中发送消息。
+
+        :param items: 对话ID到消息的映射
+        :return: 对话ID到返回消息的映射，失败的对话对应异常对象
+        """
+        ids = list(items)
+        results = await asyncio.gather(*(self.send(id, items[id]) for id in ids), return_exceptions=True)
+        return dict(zip(ids, results))
+
+    async def aclose(self):
+        """
+        关闭共享的连接池。
+        """
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
 @dataclass
 class File_Format:
     """
@@ -499,15 +1012,33 @@ GEMINI = File_Format(
 class MessageGenerator:
     """
     消息生成器类，用于生成包含文本和文件的消息。
+    ffmpeg转换结果按源文件内容哈希和目标格式缓存在cache_dir中，超过cache_ttl未使用或总大小超过cache_max_bytes时
+    按最近使用时间淘汰，多个附件并行处理。
 
     :param format: 消息格式，默认为"openai"
     :param file_format: 文件格式类实例，默认为CHATGPT
     :param ffmpeg_path: ffmpeg路径，默认为"ffmpeg"
+    :param cache_dir: 转换结果的缓存目录，默认为系统临时目录下的rag_media_cache
+    :param max_workers: 并行处理附件的线程数
+    :param max_image_size: 图像最长边的像素上限，超过时先缩小再编码，0 表示不缩小
+    :param chunk_size: 计算文件哈希时每次读取的字节数
+    :param cache_ttl: 缓存文件多久未使用后删除（秒），0 表示不过期
+    :param cache_max_bytes: 缓存目录的总大小上限，0 表示不限
     """
-    def __init__(self, format: str = "openai", file_format=CHATGPT, ffmpeg_path: str = "ffmpeg"):
+    def __init__(self, format: str = "openai", file_format=CHATGPT, ffmpeg_path: str = "ffmpeg",
+                 cache_dir: str = "", max_workers: int = 4, max_image_size: int = 0,
+                 chunk_size: int = 3 * 1024 * 1024, cache_ttl: float = 7 * 86400,
+                 cache_max_bytes: int = 1024 ** 3):
         self.format = format
         self.file_format = file_format
         self.ffmpeg_path = ffmpeg_path
+        self.cache_dir = pathlib.Path(cache_dir or os.path.join(tempfile.gettempdir(), "rag_media_cache"))
+        self.max_workers = max_workers
+        self.max_image_size = max_image_size
+        self.chunk_size = chunk_size
+        self.cache_ttl = cache_ttl
+        self.cache_max_bytes = cache_max_bytes
+        self.cache_lock = threading.Lock()
 
     def get_file_format(self, file_path: str):
         """
@@ -533,6 +1064,29 @@ class MessageGenerator:
         else:
             return False
 
+    def file_hash(self, file_path: str):
+        """
+        分块计算文件内容的SHA-256。
+
+        :param file_path: 文件路径
+        :return: 十六进制哈希值
+        """
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def file_to_base64(self, file_path: str):
+        """
+        将文件编码为Base64。
+
+        :param file_path: 文件路径
+        :return: Base64编码的数据
+        """
+        with open(file_path, "rb") as f:
+            return base64.b64encode(f.read()).decode('utf-8')
+
     def audio_to_base64(self, file_path: str):
         """
         将音频文件转换为Base64编码。
@@ -542,55 +1096,135 @@ class MessageGenerator:
         """
         if self.get_file_format(file_path) not in self.file_format.audio:
             file_path = self.ffmpeg_convert(file_path, ".wav")
-        with open(file_path, "rb") as audio_file:
-            encoded_string = base64.b64encode(
-                audio_file.read()).decode('utf-8')
-        return encoded_string
+        return self.file_to_base64(file_path)
 
     def image_to_base64(self, file_path):
         """
-        将图像文件转换为Base64编码。
+        将图像文件转换为Base64编码，设置了max_image_size时先缩小。
 
         :param file_path: 图像文件路径
         :return: Base64编码的图像数据
         """
-        if self.get_file_format(file_path) not in self.file_format.image:
+        format = self.get_file_format(file_path)
+        if format not in self.file_format.image:
             file_path = self.ffmpeg_convert(file_path, ".png")
-        with open(file_path, "rb") as image_file:
-            encoded_string = base64.b64encode(
-                image_file.read()).decode('utf-8')
-        return encoded_string
+        elif self.max_image_size > 0:
+            file_path = self.ffmpeg_convert(file_path, format, max_size=self.max_image_size)
+        return self.file_to_base64(file_path)
 
-    def ffmpeg_convert(self, file_path: str, target_format: str, target_path: str = ""):
+    def ffmpeg_convert(self, file_path: str, target_format: str, target_path: str = "", max_size: int = 0):
         """
         使用ffmpeg转换文件格式。
+        未指定target_path时结果保存在缓存目录中，同样内容、同样参数的文件只转换一次。
 
         :param file_path: 原始文件路径
         :param target_format: 目标文件格式
-        :param target_path: 目标文件路径，如果未提供则使用原始文件路径
+        :param target_path: 目标目录，如果未提供则使用缓存目录
+        :param max_size: 图像最长边的像素上限，0 表示不缩放
         :return: 转换后的文件路径
         """
         if not target_path:
-            target_path = file_path.rsplit('.', 1)[0] + target_format
+            suffix = f"_{max_size}" if max_size else ""
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            output = self.cache_dir / f"{self.file_hash(file_path)}{suffix}{target_format}"
+            if output.exists():
+                try:
+                    # 更新修改时间作为最近使用时间
+                    os.utime(output)
+                    return output.as_posix()
+                except FileNotFoundError:
+                    pass
         else:
             tmp = pathlib.Path(target_path)
             if not tmp.exists() or not tmp.is_dir():
                 raise ValueError("target_path is not a valid file path")
+            output = tmp / (pathlib.Path(file_path).stem + target_format)
+        command = [self.ffmpeg_path, '-y', '-loglevel', 'error', '-i', file_path]
+        if max_size:
+            command += ['-vf', f"scale='min({max_size},iw)':'min({max_size},ih)':force_original_aspect_ratio=decrease"]
+        # 先写入临时文件再改名，并行转换同一文件时不会读到写了一半的结果
+        partial = output.with_name(f"{output.stem}.{uuid4().hex}.part{target_format}")
         try:
-            process = subprocess.Popen(
-                [self.ffmpeg_path, '-i', file_path, target_path],
-            )
-            process.wait()
-            process.terminate()
-
-            return target_path
-        except subprocess.CalledProcessError as e:
+            subprocess.run(command + [partial.as_posix()], check=True)
+            os.replace(partial, output)
+            if not target_path:
+                self.prune_cache()
+            return output.as_posix()
+        except (subprocess.CalledProcessError, OSError) as e:
+            if partial.exists():
+                partial.unlink()
             raise ValueError(
                 f"Error converting file {file_path} to {target_format}: {e}")
 
+    def prune_cache(self, grace: float = 60):
+        """
+        删除超过cache_ttl未使用的缓存文件，总大小仍超过cache_max_bytes时从最久未使用的开始删除。
+        最近grace秒内使用过的文件和正在写入的临时文件不删除，避免删掉其他线程刚取得的结果。
+
+        :param grace: 保护期（秒）
+        :return: 删除的文件数量
+        """
+        now = time.time()
+        removed = 0
+        with self.cache_lock:
+            entries = []
+            for entry in os.scandir(self.cache_dir):
+                if not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                    if ".part" in entry.name:
+                        # 转换进程崩溃后遗留的临时文件
+                        if now - stat.st_mtime > 3600:
+                            os.remove(entry.path)
+                            removed += 1
+                        continue
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+            entries.sort()
+            total = sum(size for _, size, _ in entries)
+            for mtime, size, path in entries:
+                if now - mtime < grace:
+                    break
+                expired = self.cache_ttl > 0 and now - mtime > self.cache_ttl
+                if not expired and not (self.cache_max_bytes > 0 and total > self.cache_max_bytes):
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                removed += 1
+        return removed
+
+    def file_content(self, file: str):
+        """
+        把单个文件转换为消息中的内容片段。
+
+        :param file: 文件路径
+        :return: 内容片段
+        """
+        format = self.get_file_format(file)
+        if format in self.file_format.image:
+            return {
+                "type": "image_url",
+                "image_url": {"url": f"data:image/{format[1:]};base64,"
+                                + self.image_to_base64(file)},
+            }
+        elif format in self.file_format.audio:
+            return {
+                "type": "input_audio",
+                "input_audio": {"data": self.audio_to_base64(file),
+                                "format": format[1:]}
+            }
+        else:
+            raise ValueError(
+                f"file {file} format {format} is not supported")
+
     def gen_user_msg(self, text: str, file_path: Union[str, list[str]] = ""):
         """
-        生成用户消息，支持文本和文件（图像或音频）。
+        生成用户消息，支持文本和文件（图像或音频），多个文件并行处理。
 
         :param text: 文本内容
         :param file_path: 文件路径，可以是单个文件路径或文件路径列表
@@ -606,41 +1240,17 @@ class MessageGenerator:
         ]
         if not file_path:
             return payload
-        if isinstance(file_path, list):
-            for file in file_path:
-                format = self.get_file_format(file)
-                if format in self.file_format.image:
-                    payload[0]["content"].append({
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/{self.get_file_format(file)[1:]};base64,"
-                                        + self.image_to_base64(file)},
-                    })
-                elif format in self.file_format.audio:
-                    payload[0]["content"].append({
-                        "type": "input_audio",
-                        "input_audio": {"data": self.audio_to_base64(file),
-                                        "format": self.get_file_format(file)[1:]}
-                    })
-                else:
-                    raise ValueError(
-                        f"file {file} format {format} is not supported")
-        else:
-            format = self.get_file_format(file_path)
-            if format in self.file_format.image:
-                payload[0]["content"].append({
-                    "type": "image_url",
-                    "image_url": {"url": f"data:image/{format[1:]};base64,"
-                                    + self.image_to_base64(file_path)},
-                })
-            elif format in self.file_format.audio:
-                payload[0]["content"].append({
-                    "type": "input_audio",
-                    "input_audio": {"data": self.audio_to_base64(file_path),
-                                    "format": self.get_file_format(file_path)[1:]}
-                })
-            else:
+        files = file_path if isinstance(file_path, list) else [file_path]
+        for file in files:
+            format = self.get_file_format(file)
+            if format not in self.file_format.image and format not in self.file_format.audio:
                 raise ValueError(
-                    f"file {file_path} format {format} is not supported")
+                    f"file {file} format {format} is not supported")
+        if len(files) == 1:
+            payload[0]["content"].append(self.file_content(files[0]))
+            return payload
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(files))) as executor:
+            payload[0]["content"] += list(executor.map(self.file_content, files))
         return payload
 
 class Gemini(Base_llm):
@@ -1,4 +1,5 @@
 import os
+import shutil
 import argparse
 import ast
 # import psutil
@@ -22,20 +23,8 @@ def delete_directory(path):
         print(f"路径 {path} 不存在")
         return
 
-    # 遍历目录内容
-    for item in os.listdir(path):
-        item_path = os.path.join(path, item)  # 获取完整路径
-
-        # 如果是目录，递归删除
-        if os.path.isdir(item_path):
-            delete_directory(item_path)  # 递归删除子目录
-        else:
-            # 如果是文件，直接删除
-            os.remove(item_path)
-            print(f"已删除文件: {item_path}")
-
-    # 删除空目录
-    os.rmdir(path)
+    # shutil.rmtree 基于 os.scandir 整体删除，不逐个打印文件
+    shutil.rmtree(path)
     print(f"已删除目录: {path}")
 
 
@@ -1,7 +1,19 @@
-from typing import Callable
+from typing import Callable, Optional
+import sys
+import json
+import time
+import array
+import base64
 import requests
 from requests.exceptions import HTTPError,RequestException,ConnectionError,Timeout
 
+def encode_vector(vector:list[float])->str:
+    # 向量以小端float32数组的Base64编码发送，比JSON浮点数组小得多
+    values = array.array("f", vector)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return base64.b64encode(values.tobytes()).decode("ascii")
+
 class RAG_Client:
     def __init__(self, base_url:str):
         self.base_url = base_url
@@ -19,7 +31,8 @@ class RAG_Client:
             raise e
         except Exception as e:
             raise e
-        if response.status_code == 200:
+        # 开启async_ingest时写入返回202和票据
+        if 200 <= response.status_code < 300:
             return response
         else:
             raise HTTPError(f"Error: {response.status_code} - {response.text}")
@@ -38,18 +51,65 @@ class RAG_Client:
         handle_requests = self.handel_requests(self.client.get, url)
         return handle_requests.json()
     
-    def store(self, text:str, metadata:dict[str,str]={}):
+    def store(self, text:str, metadata:dict[str,str]={}, embedding:Optional[list[float]]=None):
         url = f"{self.base_url}/rag/store"
         data = {"text":text, "metadata":metadata}
+        if embedding is not None:
+            data["embedding"] = encode_vector(embedding)
+        handle_requests = self.handel_requests(self.client.post, url, json=data)
+        return handle_requests.json()
+    
+    def batch_store(self, items:list[dict]):
+        # items 中每项包含 text，以及可选的 metadata 和 embedding（浮点列表）
+        url = f"{self.base_url}/rag/batch_store"
+        data = {"items":[{**item, "embedding":encode_vector(item["embedding"])} if item.get("embedding") is not None else item
+                         for item in items]}
         handle_requests = self.handel_requests(self.client.post, url, json=data)
         return handle_requests.json()
     
+    def ingest_status(self, ticket:str):
+        # 异步写入的票据状态：queued、running、done 或 failed
+        url = f"{self.base_url}/rag/ingest/{ticket}"
+        handle_requests = self.handel_requests(self.client.get, url)
+        return handle_requests.json()
+    
+    def wait_ingest(self, ticket:str, timeout:float=60, interval:float=0.5):
+        # 轮询直到票据写入完成或失败，返回最终状态
+        deadline = time.monotonic() + timeout
+        while True:
+            status = self.ingest_status(ticket)
+            if status["state"] in ("done", "failed"):
+                return status
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"ticket {ticket} is still {status['state']}")
+            time.sleep(interval)
+    
     def query(self, query_text:str, top_k:int=1):
         url = f"{self.base_url}/rag/query"
         data = {"query_text":query_text, "top_k":top_k}
         handle_requests = self.handel_requests(self.client.post, url, json=data)
         return handle_requests.json()
     
+    def query_by_vector(self, embedding:list[float], top_k:int=1, similarity:float=0.5):
+        url = f"{self.base_url}/rag/query_by_vector"
+        data = {"embedding":encode_vector(embedding), "top_k":top_k, "similarity":similarity}
+        handle_requests = self.handel_requests(self.client.post, url, json=data)
+        return handle_requests.json()
+    
+    def query_by_id(self, id:str, top_k:int=1, similarity:float=0.5):
+        url = f"{self.base_url}/rag/query_by_id"
+        data = {"id":id, "top_k":top_k, "similarity":similarity}
+        handle_requests = self.handel_requests(self.client.post, url, json=data)
+        return handle_requests.json()
+    
+    def range_query(self, query_text:str, similarity:float=80, max_k:int=1000):
+        url = f"{self.base_url}/rag/range_query"
+        data = {"query_text":query_text, "similarity":similarity, "max_k":max_k}
+        handle_requests = self.handel_requests(self.client.post, url, json=data, stream=True)
+        for line in handle_requests.iter_lines(decode_unicode=True):
+            if line:
+                yield json.loads(line)
+    
     def update(self, id:str, text:str, metadata:dict[str,str]={}):
         url = f"{self.base_url}/rag/update"
         data = {"id":id, "text":text, "metadata":metadata}
@@ -0,0 +1,280 @@
+import os
+import sys
+import json
+import asyncio
+import shutil
+import time
+import itertools
+import threading
+import subprocess
+import logging
+from typing import Optional
+
+import fastapi
+import httpx
+import uvicorn
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
+
+# 只读副本可以处理的请求，其余请求都交给写进程
+READ_PATHS = {"/rag/query", "/rag/range_query", "/rag/query_by_vector", "/rag/query_by_id", "/rag/multi_query",
+              "/rag/get_data"}
+
+
+# 每个进程各自维护状态的接口，多进程模式下分发给所有进程并合并结果。
+# /rag/stats 读取共享的chroma.sqlite3和段目录，各进程结果相同，仍只交给写进程
+FANOUT_PATHS = {"/rag/admission", "/rag/admin/profile", "/rag/admin/profile/start", "/rag/admin/profile/stop",
+                "/rag/admin/profile/flamegraph"}
+
+
+def is_read_path(path: str) -> bool:
+    # 分片集合的查询路径中包含集合名称
+    return path in READ_PATHS or (path.startswith("/rag/sharded/") and path.endswith("/query"))
+
+
+def process_alive(pid: int) -> bool:
+    if os.name == "nt":
+        # Windows上没有无副作用的检查方式，保守地认为仍在运行，serve启动时会清理遗留的记录
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ReplicaState:
+    """
+    写进程和只读副本之间共享的状态文件，记录写入版本和当前集合。
+
+    :param store_path: chromadb存储路径
+    :param max_staleness: 只读副本两次检查状态文件的最小间隔（秒），即最大数据延迟
+    """
+    def __init__(self, store_path: str, max_staleness: float = 1.0):
+        self.path = os.path.join(store_path, ".replica_state.json")
+        # 每个只读副本在这里记录自己的进程号和最近一次打开存储的时间
+        self.replicas_dir = os.path.join(store_path, ".replicas")
+        self.max_staleness = max_staleness
+        self.version: Optional[int] = None
+        self.checked = 0.0
+        self.lock = threading.Lock()
+
+    def publish(self, collection_name: Optional[str]) -> None:
+        """
+        写进程在每次修改后调用，原子地更新状态文件。
+
+        :param collection_name: 写进程当前使用的集合
+        """
+        state = {"version": time.time_ns(), "collection": collection_name}
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def read(self) -> Optional[dict]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def acknowledge(self) -> None:
+        """
+        只读副本打开或重新打开存储后调用。写进程据此判断已删除集合的段目录是否仍可能被副本引用。
+        """
+        os.makedirs(self.replicas_dir, exist_ok=True)
+        path = os.path.join(self.replicas_dir, f"{os.getpid()}.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"pid": os.getpid(), "opened": time.time_ns()}, f)
+        os.replace(tmp_path, path)
+
+    def leave(self) -> None:
+        try:
+            os.remove(os.path.join(self.replicas_dir, f"{os.getpid()}.json"))
+        except FileNotFoundError:
+            pass
+
+    def replicas(self) -> list[dict]:
+        """
+        :return: 仍在运行的只读副本，包含进程号和最近一次打开存储的时间
+        """
+        replicas = []
+        try:
+            names = os.listdir(self.replicas_dir)
+        except FileNotFoundError:
+            return replicas
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.replicas_dir, name), "r", encoding="utf-8") as f:
+                    replica = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                continue
+            if process_alive(replica["pid"]):
+                replicas.append(replica)
+        return replicas
+
+    def changed(self) -> bool:
+        """
+        检查状态文件是否有新版本，不重新加载。没有变化时同样计入检查间隔。
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now - self.checked < self.max_staleness:
+                return False
+            state = self.read()
+            if not state or state.get("version") == self.version:
+                self.checked = now
+                return False
+            return True
+
+    def sync(self, rag) -> bool:
+        """
+        只读副本在处理请求前调用，状态文件版本变化时重新打开存储。
+
+        :param rag: 副本进程中的RAG实例
+        :return: 是否重新加载了存储
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now - self.checked < self.max_staleness:
+                return False
+            self.checked = now
+            state = self.read()
+            if not state or state.get("version") == self.version:
+                return False
+            rag.reload()
+            self.acknowledge()
+            collection_name = state.get("collection")
+            if collection_name and rag.check_collection(collection_name):
+                rag.change_collection(collection_name)
+            self.version = state.get("version")
+            return True
+
+
+def build_dispatcher(writer_url: str, reader_urls: list[str]) -> fastapi.FastAPI:
+    """
+    构建分发请求的应用：读请求轮询分给只读副本，其余请求交给写进程。
+    FANOUT_PATHS 中的请求发给所有进程，按进程名（writer、reader-0……）合并结果；带 ?worker=进程名 时只发给该进程。
+
+    :param writer_url: 写进程地址
+    :param reader_urls: 只读副本地址列表
+    :return: FastAPI应用
+    """
+    app = fastapi.FastAPI()
+    client = httpx.AsyncClient(timeout=None)
+    readers = itertools.cycle(reader_urls) if reader_urls else None
+    workers = {"writer": writer_url, **{f"reader-{index}": url for index, url in enumerate(reader_urls)}}
+
+    async def relay(response: httpx.Response):
+        # 客户端提前断开时后台任务不会执行，在这里同样关闭上游连接
+        try:
+            async for chunk in response.aiter_raw():
+                yield chunk
+        finally:
+            await response.aclose()
+
+    async def fan_out(request: fastapi.Request, params: list, body: bytes, headers: dict):
+        async def fetch(url: str):
+            try:
+                return await client.request(request.method, f"{url}{request.url.path}",
+                                            params=params, content=body, headers=headers)
+            except httpx.TransportError as e:
+                return e
+        names = list(workers)
+        responses = await asyncio.gather(*(fetch(workers[name]) for name in names))
+        results = {}
+        for name, response in zip(names, responses):
+            if isinstance(response, Exception):
+                results[name] = {"status_code": 502, "content": {"detail": str(response)}}
+                continue
+            try:
+                content = response.json()
+            except ValueError:
+                content = response.text
+            results[name] = {"status_code": response.status_code, "content": content}
+        codes = {result["status_code"] for result in results.values()}
+        if len(codes) == 1 and min(codes) >= 400:
+            # 所有进程都拒绝时（如缺少管理令牌）原样返回错误
+            return JSONResponse(status_code=codes.pop(), content=next(iter(results.values()))["content"])
+        if request.url.path.endswith("/flamegraph"):
+            # 折叠栈以进程名作为根帧合并，火焰图中每个进程各占一支
+            return PlainTextResponse("".join(f"{name};{line}\n" for name, result in results.items()
+                                             if result["status_code"] == 200 and isinstance(result["content"], str)
+                                             for line in result["content"].splitlines() if line))
+        return JSONResponse(content={"workers": results})
+
+    @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
+    async def dispatch(path: str, request: fastapi.Request):
+        body = await request.body()
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in ("host", "content-length")}
+        # worker参数只由分发器使用，不转发给进程
+        params = [(key, value) for key, value in request.query_params.multi_items() if key != "worker"]
+        worker = request.query_params.get("worker")
+        targets = [writer_url]
+        if worker is not None:
+            if worker not in workers:
+                return JSONResponse(status_code=404, content={"detail": f"unknown worker {worker}, expected one of {list(workers)}"})
+            targets = [workers[worker]]
+        elif request.url.path in FANOUT_PATHS:
+            return await fan_out(request, params, body, headers)
+        elif readers and is_read_path(request.url.path):
+            targets = [next(readers), writer_url]
+        for index, target in enumerate(targets):
+            upstream = client.build_request(request.method, f"{target}{request.url.path}",
+                                            params=params, content=body, headers=headers)
+            try:
+                response = await client.send(upstream, stream=True)
+            except httpx.TransportError as e:
+                # 副本不可用时退回写进程
+                if index == len(targets) - 1:
+                    raise e
+                logging.warning(f"reader {target} unavailable: {e}")
+                continue
+            # 原样转发未解码的响应体，流式接口（如 /rag/range_query）逐块到达客户端
+            excluded = ("content-length", "transfer-encoding", "connection")
+            return StreamingResponse(relay(response), status_code=response.status_code,
+                                     headers={k: v for k, v in response.headers.items() if k.lower() not in excluded},
+                                     background=BackgroundTask(response.aclose))
+
+    return app
+
+
+def serve(cwd: str, host: str, port: int, workers: int, store_path: str = "") -> None:
+    """
+    启动一个写进程和若干只读副本进程，并在port上运行分发器。
+
+    :param cwd: server.py所在目录
+    :param host: 监听地址
+    :param port: 对外端口，写进程和副本使用其后的端口
+    :param workers: 只读副本数量
+    :param store_path: chromadb存储路径，用于清理遗留的副本记录
+    """
+    writer_port = port + 1
+    reader_ports = [port + 2 + i for i in range(workers)]
+    processes = []
+    if store_path:
+        # 清理上次运行遗留的副本记录
+        shutil.rmtree(ReplicaState(store_path).replicas_dir, ignore_errors=True)
+
+    def start(role: str, worker_port: int):
+        env = {**os.environ, "RAG_ROLE": role}
+        return subprocess.Popen([sys.executable, "-m", "uvicorn", "server:app",
+                                 "--host", "127.0.0.1", "--port", str(worker_port)], cwd=cwd, env=env)
+
+    try:
+        processes.append(start("writer", writer_port))
+        for reader_port in reader_ports:
+            processes.append(start("reader", reader_port))
+        app = build_dispatcher(f"http://127.0.0.1:{writer_port}",
+                               [f"http://127.0.0.1:{p}" for p in reader_ports])
+        uvicorn.run(app, host=host, port=port)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
@@ -0,0 +1,345 @@
+import os
+import re
+import json
+import time
+import hashlib
+import sqlite3
+import pathlib
+import tempfile
+import threading
+from typing import Union
+
+
+def conversation_title(messages: list[dict], length: int = 10):
+    """
+    取第一条用户消息的前length个字符作为对话标题。
+
+    :param messages: 消息列表
+    :param length: 标题长度
+    :return: 标题，没有用户消息时返回None
+    """
+    for message in messages:
+        if message.get("role") != "user":
+            continue
+        content = message.get("content")
+        if isinstance(content, list):
+            texts = [part.get("text", "") for part in content if part.get("type") == "text"]
+            content = texts[0] if texts else ""
+        return (content or "")[:length]
+    return None
+
+
+class ConversationIndex:
+    """
+    对话索引，保存在存储目录下的SQLite文件中，列出对话时不需要打开对话文件。
+
+    :param storage: 聊天记录存储路径
+    """
+    def __init__(self, storage: pathlib.Path):
+        self.storage = storage
+        self.path = storage / "index.sqlite3"
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                "id TEXT PRIMARY KEY, title TEXT, created REAL, updated REAL, message_count INTEGER)")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated)")
+        if self.count() == 0:
+            self.rebuild()
+
+    def rebuild(self):
+        """
+        扫描存储目录中已有的对话文件重建索引，只在索引为空时执行一次。
+        """
+        log = ConversationLog(self.storage)
+        for file_path in list(self.storage.glob("*.json")) + list(self.storage.glob("*.jsonl")):
+            try:
+                if file_path.suffix == ".jsonl":
+                    messages = log.read(file_path.stem, resolve=False)
+                else:
+                    with file_path.open("r", encoding="utf-8") as f:
+                        messages = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                continue
+            stat = file_path.stat()
+            self.upsert(file_path.stem, conversation_title(messages), len(messages),
+                        created=stat.st_ctime, updated=stat.st_mtime)
+
+    def upsert(self, id: str, title: Union[str, None], message_count: int,
+               created: Union[float, None] = None, updated: Union[float, None] = None):
+        """
+        保存对话后更新索引。
+
+        :param id: 对话ID
+        :param title: 对话标题，为None时保留原有标题
+        :param message_count: 消息数量
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO conversations (id, title, created, updated, message_count) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET title = COALESCE(excluded.title, conversations.title), "
+                "updated = excluded.updated, message_count = excluded.message_count",
+                (id, title, created or now, updated or now, message_count))
+
+    def delete(self, id: str):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM conversations WHERE id = ?", (id,))
+
+    def count(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+    def list(self, offset: int = 0, limit: int = -1, order: str = "updated"):
+        """
+        分页列出对话。
+
+        :param offset: 跳过的数量
+        :param limit: 返回的数量，-1 表示全部
+        :param order: 排序字段，"updated" 或 "created"，均为倒序
+        :return: 对话列表，包含标题、ID、创建时间、更新时间和消息数量
+        """
+        if order not in ("updated", "created"):
+            raise ValueError(f"unknown order {order}")
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT id, title, created, updated, message_count FROM conversations "
+                f"ORDER BY {order} DESC LIMIT ? OFFSET ?", (limit, offset)).fetchall()
+        return [{"title": title, "id": id, "created": created, "updated": updated, "message_count": count}
+                for id, title, created, updated, count in rows]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def replay(records: list[dict]) -> list[dict]:
+    """
+    按顺序重放对话日志，得到当前的消息列表。
+
+    :param records: 日志记录，{"i": 下标, "m": 消息} 或 {"truncate": 长度}
+    :return: 消息列表
+    """
+    messages: list[dict] = []
+    for record in records:
+        if "truncate" in record:
+            del messages[record["truncate"]:]
+        else:
+            del messages[record["i"]:]
+            messages.append(record["m"])
+    return messages
+
+
+class ConversationLog:
+    """
+    追加写入的JSONL对话存储。每行记录一条消息及其下标，保存时只追加新消息；
+    历史被截断时追加一条truncate记录，废弃的行累积过多时整体重写压缩。
+    超过blob_threshold的base64图片和音频数据按内容哈希单独保存在blobs目录中。
+
+    :param storage: 聊天记录存储路径
+    :param blob_threshold: 单独保存的媒体数据的最小长度
+    """
+    def __init__(self, storage: pathlib.Path, blob_threshold: int = 4096):
+        self.storage = storage
+        self.blob_dir = storage / "blobs"
+        self.blob_threshold = blob_threshold
+
+    def path(self, id: str) -> pathlib.Path:
+        return self.storage / f"{id}.jsonl"
+
+    def exists(self, id: str) -> bool:
+        return self.path(id).exists()
+
+    def blob_path(self, key: str) -> pathlib.Path:
+        return self.blob_dir / key[:2] / key
+
+    def write_blob(self, data: str) -> str:
+        key = hashlib.sha256(data.encode("utf-8")).hexdigest()
+        path = self.blob_path(key)
+        if path.exists():
+            try:
+                # 刷新修改时间，垃圾回收不会删除刚被再次引用的blob
+                os.utime(path)
+                return f"blob:{key}"
+            except FileNotFoundError:
+                pass
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # 每个写入方使用独立的临时文件，并发写入同一blob时不会互相覆盖
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=path.parent, prefix=f"{key}.",
+                                         suffix=".tmp", delete=False) as f:
+            f.write(data)
+        try:
+            os.replace(f.name, path)
+        except OSError:
+            os.unlink(f.name)
+            raise
+        return f"blob:{key}"
+
+    def read_blob(self, ref: str) -> str:
+        return self.blob_path(ref[5:]).read_text(encoding="utf-8")
+
+    def map_media(self, message: dict, func) -> dict:
+        """
+        对消息中的图片url和音频data调用func，只复制被修改的部分。
+        """
+        content = message.get("content")
+        if not isinstance(content, list):
+            return message
+        parts = []
+        changed = False
+        for part in content:
+            for kind, key in (("image_url", "url"), ("input_audio", "data")):
+                media = part.get(kind)
+                if part.get("type") == kind and isinstance(media, dict) and isinstance(media.get(key), str):
+                    value = func(media[key])
+                    if value is not media[key]:
+                        part = {**part, kind: {**media, key: value}}
+                        changed = True
+            parts.append(part)
+        return {**message, "content": parts} if changed else message
+
+    def externalize(self, message: dict) -> dict:
+        def to_blob(value: str):
+            return self.write_blob(value) if len(value) >= self.blob_threshold else value
+        return self.map_media(message, to_blob)
+
+    def resolve(self, message: dict) -> dict:
+        def from_blob(value: str):
+            return self.read_blob(value) if value.startswith("blob:") else value
+        return self.map_media(message, from_blob)
+
+    def append(self, id: str, start: int, messages: list[dict], truncate: bool = False) -> int:
+        """
+        追加消息，truncate为真时先把历史截断到start。
+
+        :param id: 对话ID
+        :param start: 第一条消息的下标
+        :param messages: 消息列表
+        :param truncate: 是否先截断
+        :return: 写入的行数
+        """
+        records: list[dict] = [{"truncate": start}] if truncate else []
+        records += [{"i": start + offset, "m": self.externalize(message)} for offset, message in enumerate(messages)]
+        if not records:
+            return 0
+        with self.path(id).open("a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+        return len(records)
+
+    def rewrite(self, id: str, messages: list[dict]) -> int:
+        """
+        用当前消息整体重写日志，同时也是压缩操作。
+
+        :return: 写入的行数
+        """
+        path = self.path(id)
+        # 同一进程内的多个线程可能同时压缩同一对话，每次重写使用独立的临时文件
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=path.parent, prefix=f"{path.stem}.",
+                                         suffix=".tmp", delete=False) as f:
+            f.write("".join(json.dumps({"i": i, "m": self.externalize(message)}, ensure_ascii=False) + "\n"
+                            for i, message in enumerate(messages)))
+        try:
+            os.replace(f.name, path)
+        except OSError:
+            os.unlink(f.name)
+            raise
+        return len(messages)
+
+    def compact(self, id: str) -> int:
+        return self.rewrite(id, self.read(id, resolve=False))
+
+    def read(self, id: str, resolve: bool = True) -> list[dict]:
+        """
+        读取完整的对话。
+
+        :param id: 对话ID
+        :param resolve: 是否把blob引用还原为原始数据
+        :return: 消息列表
+        """
+        with self.path(id).open("r", encoding="utf-8") as f:
+            messages = replay([json.loads(line) for line in f if line.strip()])
+        return [self.resolve(message) for message in messages] if resolve else messages
+
+    def reverse_lines(self, id: str, block_size: int = 65536):
+        with self.path(id).open("rb") as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            remainder = b""
+            while position > 0:
+                read_size = min(block_size, position)
+                position -= read_size
+                f.seek(position)
+                lines = (f.read(read_size) + remainder).split(b"\n")
+                remainder = lines.pop(0)
+                for line in reversed(lines):
+                    if line.strip():
+                        yield line
+            if remainder.strip():
+                yield remainder
+
+    def read_tail(self, id: str, tail: int):
+        """
+        从文件末尾向前读取最近的tail条消息，不读取更早的部分。
+        同一下标以最后写入的一行为准，因此从后向前遇到的第一行即为当前内容。
+
+        :param id: 对话ID
+        :param tail: 读取的消息数量
+        :return: (窗口起始下标, 窗口内的消息, 第一条消息)
+        """
+        total = None
+        start = 0
+        window: dict[int, dict] = {}
+        for line in self.reverse_lines(id):
+            record = json.loads(line)
+            if total is None:
+                total = record["truncate"] if "truncate" in record else record["i"] + 1
+                start = max(total - tail, 0)
+            if "truncate" in record:
+                continue
+            index = record["i"]
+            if start <= index < total and index not in window:
+                window[index] = record["m"]
+                if len(window) == total - start:
+                    break
+        messages = [self.resolve(window[i]) for i in range(start, start + len(window))]
+        first = None
+        if start > 0:
+            # 下标0被改写时保存方会整体重写，因此文件第一行总是当前的第一条消息
+            with self.path(id).open("r", encoding="utf-8") as f:
+                first = self.resolve(json.loads(f.readline())["m"])
+        return start, messages, first
+
+    def delete(self, id: str) -> bool:
+        path = self.path(id)
+        if path.exists():
+            path.unlink()
+            return True
+        return False
+
+    def collect_garbage(self, grace: float = 300) -> int:
+        """
+        删除不再被任何对话引用的blob文件。
+        并发的append可能已经写入blob但尚未写入引用它的行，修改时间在grace秒以内的blob不删除。
+
+        :param grace: 保护期（秒）
+        :return: 删除的文件数量
+        """
+        referenced = set()
+        for path in self.storage.glob("*.jsonl"):
+            with path.open("r", encoding="utf-8") as f:
+                referenced.update(re.findall(r"blob:([0-9a-f]{64})", f.read()))
+        removed = 0
+        now = time.time()
+        for path in self.blob_dir.glob("*/*"):
+            if path.name in referenced or path.name.endswith(".tmp"):
+                continue
+            try:
+                if now - path.stat().st_mtime < grace:
+                    continue
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            removed += 1
+        return removed
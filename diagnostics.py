@@ -0,0 +1,216 @@
+import os
+import sys
+import time
+import struct
+import sqlite3
+import threading
+from collections import Counter
+from typing import Any, Optional
+
+from rag import INTERNAL_KEY
+
+# HNSW段目录中的文件：data_level0.bin 保存向量和底层邻接表，其余为上层图结构和元数据
+HNSW_DATA_FILES = {"data_level0.bin"}
+HNSW_INDEX_FILES = {"header.bin", "length.bin", "link_lists.bin", "index_metadata.pickle"}
+
+
+def hnsw_elements(segment_path: str) -> Optional[int]:
+    # hnswlib的header依次为 offsetLevel0_、max_elements_、cur_element_count 三个size_t，
+    # cur_element_count 包含已标记删除但尚未清理的元素
+    try:
+        with open(os.path.join(segment_path, "header.bin"), "rb") as f:
+            header = f.read(24)
+    except OSError:
+        return None
+    if len(header) < 24:
+        return None
+    return struct.unpack_from("<Q", header, 16)[0]
+
+
+class CollectionStats:
+    """
+    统计每个集合的文档数量、向量维度、各段的磁盘占用（索引和数据分开）以及已删除条目的比例。
+    只读取chroma.sqlite3的元数据表和段目录的文件大小，不经过客户端，也不占用写锁，结果缓存ttl秒。
+
+    :param store_path: chromadb存储路径
+    :param ttl: 缓存时间（秒）
+    """
+    def __init__(self, store_path: str, ttl: float = 60):
+        self.store_path = store_path
+        self.ttl = ttl
+        self.cached: Optional[dict[str, Any]] = None
+        self.cached_at = 0.0
+        self.lock = threading.Lock()
+
+    def read_catalog(self) -> tuple[list[tuple], list[tuple], dict[str, int]]:
+        path = os.path.join(self.store_path, "chroma.sqlite3")
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=5)
+        try:
+            # 内部集合（如语义缓存）不计入统计
+            collections = connection.execute(
+                "SELECT id, name, dimension FROM collections WHERE id NOT IN "
+                "(SELECT collection_id FROM collection_metadata WHERE key = ?)", (INTERNAL_KEY,)).fetchall()
+            segments = connection.execute("SELECT id, scope, collection FROM segments").fetchall()
+            # 每条记录在元数据段的embeddings表中有一行，按段计数即为集合的文档数量
+            counts = dict(connection.execute("SELECT segment_id, COUNT(*) FROM embeddings GROUP BY segment_id").fetchall())
+        finally:
+            connection.close()
+        return collections, segments, counts
+
+    def segment_stats(self, segment_id: str, scope: str) -> dict[str, Any]:
+        path = os.path.join(self.store_path, segment_id)
+        index_bytes = data_bytes = other_bytes = 0
+        if os.path.isdir(path):
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    size = entry.stat(follow_symlinks=False).st_size
+                    if entry.name in HNSW_DATA_FILES:
+                        data_bytes += size
+                    elif entry.name in HNSW_INDEX_FILES:
+                        index_bytes += size
+                    else:
+                        other_bytes += size
+        return {
+            "id": segment_id,
+            "scope": scope,
+            # 元数据段保存在chroma.sqlite3中，没有单独的目录
+            "bytes": index_bytes + data_bytes + other_bytes,
+            "index_bytes": index_bytes,
+            "data_bytes": data_bytes,
+            "elements": hnsw_elements(path),
+        }
+
+    def collect(self) -> dict[str, Any]:
+        collections, segments, counts = self.read_catalog()
+        by_collection: dict[str, list[tuple]] = {}
+        for segment_id, scope, collection_id in segments:
+            by_collection.setdefault(collection_id, []).append((segment_id, scope))
+        results = []
+        for collection_id, name, dimension in collections:
+            count = sum(counts.get(segment_id, 0) for segment_id, _ in by_collection.get(collection_id, []))
+            segment_stats = [self.segment_stats(segment_id, scope)
+                             for segment_id, scope in by_collection.get(collection_id, [])]
+            elements = sum(segment["elements"] or 0 for segment in segment_stats)
+            results.append({
+                "name": name,
+                "id": collection_id,
+                "count": count,
+                "dimension": dimension,
+                "bytes": sum(segment["bytes"] for segment in segment_stats),
+                "index_bytes": sum(segment["index_bytes"] for segment in segment_stats),
+                "data_bytes": sum(segment["data_bytes"] for segment in segment_stats),
+                # 向量索引尚未落盘时无法得知已删除条目的数量
+                "deleted_ratio": round(max(elements - count, 0) / elements, 4) if elements else None,
+                "segments": segment_stats,
+            })
+        sqlite_path = os.path.join(self.store_path, "chroma.sqlite3")
+        return {
+            "collections": results,
+            "sqlite_bytes": os.path.getsize(sqlite_path) if os.path.exists(sqlite_path) else 0,
+            "computed_at": time.time(),
+        }
+
+    def get(self, refresh: bool = False) -> dict[str, Any]:
+        with self.lock:
+            cached = not (refresh or self.cached is None or time.monotonic() - self.cached_at > self.ttl)
+            if not cached:
+                self.cached = self.collect()
+                self.cached_at = time.monotonic()
+            return {**self.cached, "cached": cached} # type: ignore
+
+
+class SamplingProfiler:
+    """
+    采样分析器：后台线程每隔interval秒读取所有线程的调用栈，只记录正在执行指定文件中代码的线程，
+    按调用栈聚合计数，输出flamegraph.pl和speedscope可直接读取的折叠栈格式。
+
+    :param files: 关注的源文件名，调用栈中包含这些文件的样本才会被记录
+    """
+    def __init__(self, files: tuple[str, ...] = ("rag.py",)):
+        self.files = files
+        self.samples: Counter[str] = Counter()
+        self.total = 0
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.duration = 0.0
+        self.interval = 0.0
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, duration: float = 10.0, interval: float = 0.005) -> None:
+        """
+        开始采样，duration秒后自动停止。
+
+        :param duration: 采样时长（秒）
+        :param interval: 采样间隔（秒）
+        """
+        if self.running:
+            raise ValueError("profiler is already running")
+        with self.lock:
+            self.samples = Counter()
+            self.total = 0
+        self.duration = duration
+        self.interval = interval
+        self.started = time.time()
+        self.finished = None
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+
+    def label(self, code) -> str:
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+    def sample(self, own_thread: int) -> None:
+        stacks = []
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            if not any(os.path.basename(code.co_filename) in self.files for code in codes):
+                continue
+            stacks.append(";".join(self.label(code) for code in reversed(codes)))
+        with self.lock:
+            self.total += 1
+            self.samples.update(stacks)
+
+    def run(self) -> None:
+        own_thread = threading.get_ident()
+        deadline = time.monotonic() + self.duration
+        while time.monotonic() < deadline and not self.stop_event.wait(self.interval):
+            self.sample(own_thread)
+        self.finished = time.time()
+
+    def collapsed(self) -> str:
+        """
+        :return: 折叠栈文本，每行为 "调用栈 样本数"
+        """
+        with self.lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+    def status(self) -> dict[str, Any]:
+        with self.lock:
+            return {
+                "running": self.running,
+                "started": self.started,
+                "finished": self.finished,
+                "duration": self.duration,
+                "interval": self.interval,
+                "ticks": self.total,
+                "samples": sum(self.samples.values()),
+                "stacks": len(self.samples),
+            }
@@ -0,0 +1,325 @@
+import time
+import base64
+import random
+import logging
+import threading
+from typing import List, Optional
+
+import numpy as np
+from chromadb import EmbeddingFunction, Documents, Embeddings
+
+from tokens import estimate_tokens, split_by_tokens
+
+
+def _is_too_large(error: Exception) -> bool:
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if status == 413:
+        return True
+    message = str(error).lower()
+    keywords = ("too large", "too long", "too many", "maximum context", "max_tokens", "token limit", "exceeds")
+    return status in (400, None) and any(keyword in message for keyword in keywords)
+
+
+def decode_vector(data: str) -> List[float]:
+    """
+    解码客户端发送的向量：小端float32数组的Base64编码。
+
+    :param data: Base64字符串
+    :return: 向量
+    """
+    raw = base64.b64decode(data, validate=True)
+    if not raw or len(raw) % 4:
+        raise ValueError("embedding payload should be a non-empty float32 array")
+    return np.frombuffer(raw, dtype="<f4").astype(float).tolist()
+
+
+def encode_vector(vector) -> str:
+    return base64.b64encode(np.asarray(vector, dtype="<f4").tobytes()).decode("ascii")
+
+
+class BatchingEmbeddingFunction(EmbeddingFunction):
+    """
+    在嵌入函数外层按token预算打包请求，尽量填满每次请求又不超出服务端限制。
+
+    :param embedding_function: 实际发起请求的嵌入函数
+    :param max_batch_tokens: 单次请求的最大token数量
+    :param max_batch_items: 单次请求的最大文本条数
+    :param max_input_tokens: 单条文本的最大token数量
+    :param overflow: 单条文本超长时的处理方式，"split" 切分后取加权平均，"truncate" 截断，"error" 抛出异常
+    """
+    def __init__(self,
+                 embedding_function: EmbeddingFunction,
+                 max_batch_tokens: int = 8000,
+                 max_batch_items: int = 256,
+                 max_input_tokens: int = 8000,
+                 overflow: str = "split"):
+        if overflow not in ("split", "truncate", "error"):
+            raise ValueError(f"unknown overflow policy {overflow}")
+        if max_batch_tokens <= 0 or max_batch_items <= 0 or max_input_tokens <= 0:
+            raise ValueError("batch limits should be positive")
+        self.embedding_function = embedding_function
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_items = max_batch_items
+        self.max_input_tokens = min(max_input_tokens, max_batch_tokens)
+        self.overflow = overflow
+
+    def __call__(self, input: Documents) -> Embeddings:
+        texts = [input] if isinstance(input, str) else list(input)
+        # 每条输入对应一个或多个片段，owners 记录片段属于哪条输入
+        pieces: List[str] = []
+        owners: List[int] = []
+        for index, text in enumerate(texts):
+            for piece in self.prepare(text):
+                pieces.append(piece)
+                owners.append(index)
+        vectors = self.embed_pieces(pieces)
+        if len(pieces) == len(texts):
+            return vectors
+        grouped: List[List[int]] = [[] for _ in texts]
+        for piece_index, owner in enumerate(owners):
+            grouped[owner].append(piece_index)
+        results: Embeddings = []
+        for indices in grouped:
+            if len(indices) == 1:
+                results.append(vectors[indices[0]])
+                continue
+            weights = np.array([max(estimate_tokens(pieces[i]), 1) for i in indices], dtype=np.float32)
+            stacked = np.array([vectors[i] for i in indices], dtype=np.float32)
+            merged = (stacked * weights[:, None]).sum(axis=0) / weights.sum()
+            norm = np.linalg.norm(merged)
+            if norm > 0:
+                merged = merged / norm
+            results.append(merged)
+        return results
+
+    def prepare(self, text: str) -> List[str]:
+        """
+        按超长策略处理单条文本。
+
+        :param text: 文本
+        :return: 需要嵌入的片段列表
+        """
+        if estimate_tokens(text) <= self.max_input_tokens:
+            return [text]
+        if self.overflow == "error":
+            raise ValueError(f"input of about {estimate_tokens(text)} tokens exceeds max_input_tokens {self.max_input_tokens}")
+        pieces = split_by_tokens(text, self.max_input_tokens)
+        if self.overflow == "truncate":
+            return pieces[:1]
+        return pieces
+
+    def pack(self, texts: List[str]) -> List[List[int]]:
+        """
+        把文本按顺序装入批次，每批不超过token和条数预算。
+
+        :param texts: 文本列表
+        :return: 每个批次包含的文本下标
+        """
+        batches: List[List[int]] = []
+        current: List[int] = []
+        tokens = 0
+        for index, text in enumerate(texts):
+            cost = estimate_tokens(text)
+            if current and (tokens + cost > self.max_batch_tokens or len(current) >= self.max_batch_items):
+                batches.append(current)
+                current = []
+                tokens = 0
+            current.append(index)
+            tokens += cost
+        if current:
+            batches.append(current)
+        return batches
+
+    def embed_pieces(self, pieces: List[str]) -> Embeddings:
+        results: List[Optional[object]] = [None] * len(pieces)
+        for batch in self.pack(pieces):
+            vectors = self.embed_batch([pieces[i] for i in batch])
+            for index, vector in zip(batch, vectors):
+                results[index] = vector
+        return results  # type: ignore
+
+    def embed_batch(self, texts: List[str]) -> Embeddings:
+        """
+        发送一个批次，服务端因请求过大拒绝时二分后重试。
+
+        :param texts: 文本列表
+        :return: 嵌入向量列表
+        """
+        try:
+            vectors = self.embedding_function(texts)
+        except Exception as e:
+            if not _is_too_large(e):
+                raise e
+            if len(texts) > 1:
+                middle = len(texts) // 2
+                logging.info(f"embedding batch of {len(texts)} rejected as too large, splitting")
+                return list(self.embed_batch(texts[:middle])) + list(self.embed_batch(texts[middle:]))
+            text = texts[0]
+            half = estimate_tokens(text) // 2
+            if self.overflow == "error" or half < 1:
+                raise e
+            # 本地估算偏小，单条文本仍被拒绝时继续截短
+            logging.info(f"embedding input of about {estimate_tokens(text)} tokens rejected, truncating")
+            return self.embed_batch(split_by_tokens(text, half)[:1])
+        if len(vectors) != len(texts):
+            raise ValueError(f"embedding function returned {len(vectors)} vectors for {len(texts)} inputs")
+        return list(vectors)
+
+
+class EmbeddingEndpoint:
+    """
+    嵌入服务的单个后端，记录权重、限流状态以及延迟和错误率。
+
+    :param embedding_function: 该后端对应的嵌入函数
+    :param name: 后端名称，用于统计信息
+    :param weight: 负载均衡权重
+    :param rate_limit: 每秒最多请求数，0 表示不限流
+    """
+    def __init__(self, embedding_function: EmbeddingFunction, name: str = "", weight: float = 1.0, rate_limit: float = 0.0):
+        if weight <= 0:
+            raise ValueError("endpoint weight should be positive")
+        self.embedding_function = embedding_function
+        self.name = name
+        self.weight = weight
+        self.rate_limit = rate_limit
+        self.allowance = max(rate_limit, 1.0)
+        self.refilled = time.monotonic()
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.failures = 0
+        self.down_until = 0.0
+
+    def wait_time(self, now: float) -> float:
+        """
+        令牌桶补充后距离下一次可以请求还需等待的秒数。
+        """
+        if self.rate_limit <= 0:
+            return 0.0
+        self.allowance = min(max(self.rate_limit, 1.0), self.allowance + (now - self.refilled) * self.rate_limit)
+        self.refilled = now
+        if self.allowance >= 1.0:
+            return 0.0
+        return (1.0 - self.allowance) / self.rate_limit
+
+    def consume(self) -> None:
+        if self.rate_limit > 0:
+            self.allowance -= 1.0
+
+    def score(self) -> float:
+        # 延迟越高、错误率越高，分到的流量越少
+        return self.weight * (1.0 - self.error_rate) / (self.latency + 0.01)
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "weight": self.weight,
+            "rate_limit": self.rate_limit,
+            "latency_ms": round(self.latency * 1000, 2),
+            "error_rate": round(self.error_rate, 4),
+            "requests": self.requests,
+            "errors": self.errors,
+            "healthy": self.down_until <= time.monotonic(),
+        }
+
+
+class EmbeddingPool(EmbeddingFunction):
+    """
+    在多个嵌入后端之间做加权负载均衡和故障转移。
+
+    :param endpoints: 后端列表
+    :param alpha: 延迟和错误率滑动平均的系数
+    :param max_failures: 连续失败多少次后暂时摘除后端
+    :param cooldown: 摘除后端的秒数
+    :param slow_factor: 延迟超过最快后端多少倍时不再分配流量
+    """
+    def __init__(self,
+                 endpoints: List[EmbeddingEndpoint],
+                 alpha: float = 0.2,
+                 max_failures: int = 3,
+                 cooldown: float = 30.0,
+                 slow_factor: float = 3.0):
+        if not endpoints:
+            raise ValueError("embedding pool needs at least one endpoint")
+        self.endpoints = endpoints
+        self.alpha = alpha
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.slow_factor = slow_factor
+        self.lock = threading.Lock()
+
+    def choose(self, exclude: set) -> Optional[EmbeddingEndpoint]:
+        """
+        选择一个后端并占用一次限流额度，必要时等待限流恢复。
+
+        :param exclude: 本次请求已经尝试过的后端
+        :return: 选中的后端，没有可用后端时返回None
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                candidates = [e for e in self.endpoints if id(e) not in exclude and e.down_until <= now]
+                if not candidates:
+                    # 所有后端都被摘除时仍然尝试最早恢复的那个，避免整体不可用
+                    remaining = [e for e in self.endpoints if id(e) not in exclude]
+                    if not remaining:
+                        return None
+                    candidates = [min(remaining, key=lambda e: e.down_until)]
+                measured = [e.latency for e in candidates if e.requests]
+                if measured and len(candidates) > 1:
+                    fastest = min(measured)
+                    fast = [e for e in candidates if not e.requests or e.latency <= fastest * self.slow_factor]
+                    candidates = fast or candidates
+                waits = {id(e): e.wait_time(now) for e in candidates}
+                ready = [e for e in candidates if waits[id(e)] <= 0]
+                if ready:
+                    endpoint = random.choices(ready, weights=[e.score() for e in ready])[0]
+                    endpoint.consume()
+                    return endpoint
+                delay = min(waits.values())
+            time.sleep(delay)
+
+    def record(self, endpoint: EmbeddingEndpoint, latency: float, error: bool) -> None:
+        with self.lock:
+            endpoint.requests += 1
+            if error:
+                endpoint.errors += 1
+                endpoint.failures += 1
+                endpoint.error_rate = (1 - self.alpha) * endpoint.error_rate + self.alpha
+                if endpoint.failures >= self.max_failures:
+                    endpoint.down_until = time.monotonic() + self.cooldown
+                    logging.warning(f"embedding endpoint {endpoint.name} marked unhealthy for {self.cooldown}s")
+            else:
+                endpoint.failures = 0
+                endpoint.error_rate = (1 - self.alpha) * endpoint.error_rate
+                if endpoint.latency:
+                    endpoint.latency = (1 - self.alpha) * endpoint.latency + self.alpha * latency
+                else:
+                    endpoint.latency = latency
+
+    def __call__(self, input: Documents) -> Embeddings:
+        tried: set = set()
+        last_error: Optional[Exception] = None
+        while True:
+            endpoint = self.choose(tried)
+            if endpoint is None:
+                raise last_error or RuntimeError("no embedding endpoint available")
+            tried.add(id(endpoint))
+            start = time.monotonic()
+            try:
+                vectors = endpoint.embedding_function(input)
+            except Exception as e:
+                if _is_too_large(e):
+                    # 请求过大与后端健康无关，交给批处理层拆分
+                    raise e
+                self.record(endpoint, time.monotonic() - start, error=True)
+                logging.warning(f"embedding endpoint {endpoint.name} failed: {e}")
+                last_error = e
+                continue
+            self.record(endpoint, time.monotonic() - start, error=False)
+            return vectors
+
+    def stats(self) -> List[dict]:
+        with self.lock:
+            return [endpoint.stats() for endpoint in self.endpoints]
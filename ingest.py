@@ -0,0 +1,298 @@
+import os
+import json
+import time
+import logging
+import threading
+from uuid import uuid4
+from collections import OrderedDict, deque
+from typing import Any, Callable, Optional
+
+
+class QueueFull(Exception):
+    """
+    待写入的文档数量超过上限，调用方应稍后重试。
+    """
+    def __init__(self, pending: int, retry_after: float):
+        super().__init__(f"ingest queue is full ({pending} pending)")
+        self.pending = pending
+        self.retry_after = retry_after
+
+
+class IngestQueue:
+    """
+    异步写入队列：写入请求先追加到存储目录下的WAL文件并立即返回票据，
+    后台线程按集合合并多个请求，一次批量嵌入后分批写入chroma。
+    进程崩溃后重启时重放WAL中尚未完成的请求；文档ID在入队时分配，重放时用upsert保证幂等。
+
+    :param rag: RAG实例
+    :param wal_dir: WAL所在目录
+    :param batch_size: 每批嵌入和写入的最大文档数量
+    :param max_pending: 队列中最多等待的文档数量，超过时拒绝新的请求
+    :param flush_interval: 队列未满一批时最多等待的时间（秒），用于合并小请求
+    :param max_retries: 单批失败后的重试次数
+    :param keep_tickets: 内存中保留的已完成票据数量
+    :param compact_threshold: WAL中累积的完成记录超过该数量时压缩，只保留尚未完成的请求
+    :param on_flush: 每批写入完成后的回调
+    """
+    def __init__(self,
+                 rag,
+                 wal_dir: str,
+                 batch_size: int = 256,
+                 max_pending: int = 10000,
+                 flush_interval: float = 0.2,
+                 max_retries: int = 3,
+                 keep_tickets: int = 10000,
+                 compact_threshold: int = 1000,
+                 on_flush: Optional[Callable[[], None]] = None):
+        if batch_size <= 0 or max_pending <= 0:
+            raise ValueError("batch_size and max_pending should be positive")
+        self.rag = rag
+        os.makedirs(wal_dir, exist_ok=True)
+        self.wal_path = os.path.join(wal_dir, "ingest.wal")
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.keep_tickets = keep_tickets
+        self.compact_threshold = compact_threshold
+        # 上次压缩以来写入WAL的完成和失败记录数量
+        self.finished_records = 0
+        self.on_flush = on_flush
+        self.queue: deque[dict[str, Any]] = deque()
+        self.pending = 0
+        self.tickets: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        self.condition = threading.Condition()
+        self.wal_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.flushed = 0
+        self.failed = 0
+        self.rate = 0.0
+        self.replay()
+        self.wal = open(self.wal_path, "a", encoding="utf-8")
+
+    def append_wal(self, records: list[dict[str, Any]]) -> None:
+        with self.wal_lock:
+            self.wal.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+            self.wal.flush()
+            os.fsync(self.wal.fileno())
+
+    def replay(self) -> None:
+        """
+        读取WAL，把没有完成记录的请求重新放回队列，然后只保留这些请求重写WAL。
+        """
+        entries: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        try:
+            with open(self.wal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 崩溃时可能只写了半行
+                        continue
+                    if record.get("op") == "add":
+                        entries[record["ticket"]] = record
+                    else:
+                        entries.pop(record.get("ticket"), None)
+        except FileNotFoundError:
+            pass
+        self.rewrite_wal(list(entries.values()))
+        for entry in entries.values():
+            self.track(entry)
+        if entries:
+            logging.info(f"replaying {len(entries)} unflushed ingest requests")
+
+    def rewrite_wal(self, entries: list[dict[str, Any]]) -> None:
+        # 写入临时文件后替换，替换前崩溃时原WAL保持完整
+        tmp_path = f"{self.wal_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.wal_path)
+
+    def track(self, entry: dict[str, Any]) -> None:
+        self.queue.append(entry)
+        self.pending += len(entry["ids"])
+        self.tickets[entry["ticket"]] = {"ticket": entry["ticket"], "state": "queued", "collection": entry["collection"],
+                                         "count": len(entry["ids"]), "ids": entry["ids"], "created": entry["created"],
+                                         "finished": None, "error": None}
+
+    def enqueue(self, collection_name: str, items: list[dict[str, Any]]) -> dict[str, Any]:
+        """
+        把写入请求追加到WAL并放入队列。
+
+        :param collection_name: 目标集合
+        :param items: 每项包含 text，以及可选的 metadata 和 embedding（Base64编码的float32向量）
+        :return: 票据状态
+        """
+        if not items:
+            raise ValueError("items is empty")
+        entry = {
+            "op": "add",
+            "ticket": str(uuid4()),
+            "collection": collection_name,
+            "ids": [str(uuid4()) for _ in items],
+            "items": items,
+            "created": time.time(),
+        }
+        with self.condition:
+            if self.pending and self.pending + len(items) > self.max_pending:
+                raise QueueFull(self.pending, self.retry_after())
+            self.append_wal([entry])
+            self.track(entry)
+            self.condition.notify()
+            return dict(self.tickets[entry["ticket"]])
+
+    def retry_after(self) -> float:
+        # 按最近的写入速率估算队列降到一半所需的时间
+        if self.rate <= 0:
+            return 1.0
+        return round(min(max(self.pending / 2 / self.rate, 1.0), 60.0), 1)
+
+    def status(self, ticket: str) -> Optional[dict[str, Any]]:
+        with self.condition:
+            status = self.tickets.get(ticket)
+            return dict(status) if status else None
+
+    def stats(self) -> dict[str, Any]:
+        with self.condition:
+            return {
+                "queued_requests": len(self.queue),
+                "queued_documents": self.pending,
+                "max_pending": self.max_pending,
+                "flushed_documents": self.flushed,
+                "failed_documents": self.failed,
+                "rate": round(self.rate, 2),
+            }
+
+    def take(self) -> list[dict[str, Any]]:
+        # 取出同一集合的若干请求，合计不超过batch_size（单个请求超过时单独成批）
+        with self.condition:
+            while not self.queue and not self.stop_event.is_set():
+                self.condition.wait()
+            if self.stop_event.is_set():
+                return []
+            if sum(len(entry["ids"]) for entry in self.queue) < self.batch_size:
+                # 给后续的小请求一点时间合并进同一批
+                self.condition.wait(self.flush_interval)
+            collection = self.queue[0]["collection"]
+            batch = [self.queue.popleft()]
+            count = len(batch[0]["ids"])
+            while self.queue and self.queue[0]["collection"] == collection \
+                    and count + len(self.queue[0]["ids"]) <= self.batch_size:
+                entry = self.queue.popleft()
+                batch.append(entry)
+                count += len(entry["ids"])
+            for entry in batch:
+                self.tickets[entry["ticket"]]["state"] = "running"
+            return batch
+
+    def write(self, batch: list[dict[str, Any]]) -> None:
+        from embedding import decode_vector
+        rag = self.rag
+        name = batch[0]["collection"]
+        ids, documents, metadatas, embeddings = [], [], [], []
+        for entry in batch:
+            for doc_id, item in zip(entry["ids"], entry["items"]):
+                ids.append(doc_id)
+                documents.append(item["text"])
+                metadatas.append(item.get("metadata") or None)
+                embeddings.append(decode_vector(item["embedding"]) if item.get("embedding") else None)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            # 嵌入在写锁之外进行，整批文本交给嵌入函数一次性打包请求
+            vectors = rag.collection_embedding_function(name)([documents[i] for i in missing])
+            for i, vector in zip(missing, vectors):
+                embeddings[i] = [float(value) for value in vector]
+        size = rag.client.get_max_batch_size()
+        with rag.write_lock:
+            collection = rag.client.get_collection(name, embedding_function=rag.collection_embedding_function(name))
+            mirror = rag.mirrors.get(name)
+            for start in range(0, len(ids), size):
+                end = start + size
+                # chroma要求一次写入中要么全部有metadata要么都没有，按是否有metadata分开写
+                for with_metadata in (True, False):
+                    selected = [i for i in range(start, min(end, len(ids))) if bool(metadatas[i]) == with_metadata]
+                    if not selected:
+                        continue
+                    kwargs: dict[str, Any] = {"ids": [ids[i] for i in selected],
+                                              "documents": [documents[i] for i in selected]}
+                    if with_metadata:
+                        kwargs["metadatas"] = [metadatas[i] for i in selected]
+                    collection.upsert(embeddings=[embeddings[i] for i in selected], **kwargs) # type: ignore
+                    if mirror is not None:
+                        mirror.upsert(**kwargs)
+
+    def finish(self, batch: list[dict[str, Any]], error: Optional[str] = None) -> None:
+        now = time.time()
+        self.append_wal([{"op": "failed" if error else "done", "ticket": entry["ticket"]} for entry in batch])
+        with self.condition:
+            for entry in batch:
+                count = len(entry["ids"])
+                self.pending -= count
+                if error:
+                    self.failed += count
+                else:
+                    self.flushed += count
+                status = self.tickets[entry["ticket"]]
+                status.update(state="failed" if error else "done", finished=now, error=error)
+                self.tickets.move_to_end(entry["ticket"])
+            while len(self.tickets) > self.keep_tickets + len(self.queue):
+                oldest = next(iter(self.tickets.values()))
+                if oldest["state"] in ("queued", "running"):
+                    break
+                self.tickets.popitem(last=False)
+            self.finished_records += len(batch)
+            # 持续写入时队列不会清空，完成记录累积到一定数量也要压缩，避免WAL无限增长
+            if not self.queue or self.finished_records >= self.compact_threshold:
+                self.compact()
+
+    def compact(self) -> None:
+        # 调用方持有condition，此时只有队列中的请求尚未完成（写入线程只有一个），只保留它们的add记录
+        with self.wal_lock:
+            self.wal.close()
+            try:
+                self.rewrite_wal(list(self.queue))
+            finally:
+                self.wal = open(self.wal_path, "a", encoding="utf-8")
+        self.finished_records = 0
+
+    def run(self) -> None:
+        while not self.stop_event.is_set():
+            batch = self.take()
+            if not batch:
+                continue
+            started = time.monotonic()
+            error = None
+            for attempt in range(self.max_retries + 1):
+                try:
+                    self.write(batch)
+                    error = None
+                    break
+                except Exception as e:
+                    error = str(e)
+                    logging.warning(f"ingest batch to {batch[0]['collection']} failed (attempt {attempt + 1}): {e}")
+                    if self.stop_event.wait(min(2 ** attempt, 30)):
+                        # 停止时保留在WAL中，下次启动重放
+                        return
+            count = sum(len(entry["ids"]) for entry in batch)
+            if error is None:
+                rate = count / max(time.monotonic() - started, 1e-6)
+                self.rate = rate if self.rate == 0 else 0.8 * self.rate + 0.2 * rate
+            self.finish(batch, error)
+            if error is None and self.on_flush:
+                self.on_flush()
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.stop_event.set()
+            self.condition.notify_all()
+        if self.thread:
+            self.thread.join(timeout=10)
+        with self.wal_lock:
+            self.wal.close()
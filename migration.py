@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import logging
+import threading
+from typing import Any, Callable, Optional
+
+from chromadb import EmbeddingFunction
+
+
+class MigrationJob:
+    """
+    在后台把集合用新的嵌入模型重新嵌入到影子集合，迁移期间旧集合继续提供查询，
+    新写入同时写到两个集合，完成后切换为影子集合。
+
+    :param rag: RAG实例
+    :param collection_name: 要迁移的集合
+    :param model: 新的嵌入模型名称
+    :param embedding_function: 新模型的嵌入函数
+    :param checkpoint_dir: 保存断点的目录
+    :param batch_size: 每批重新嵌入的文档数量
+    :param max_rate: 每秒最多迁移的文档数量，0 表示不限速
+    :param on_complete: 切换完成后的回调
+    """
+    def __init__(self,
+                 rag,
+                 collection_name: str,
+                 model: str,
+                 embedding_function: EmbeddingFunction,
+                 checkpoint_dir: str,
+                 batch_size: int = 64,
+                 max_rate: float = 0.0,
+                 on_complete: Optional[Callable[[], None]] = None):
+        if batch_size <= 0:
+            raise ValueError("batch_size should be positive")
+        self.rag = rag
+        self.collection_name = collection_name
+        self.model = model
+        self.embedding_function = embedding_function
+        self.shadow_name = f"{collection_name[:50]}_shadow"
+        self.retired_name = f"{collection_name[:50]}_retired"
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.checkpoint_path = os.path.join(checkpoint_dir, f"{collection_name}.json")
+        self.ids_path = os.path.join(checkpoint_dir, f"{collection_name}.ids")
+        self.batch_size = batch_size
+        self.max_rate = max_rate
+        self.on_complete = on_complete
+        self.state = "pending"
+        self.total = 0
+        self.done = 0
+        self.skipped = 0
+        self.error: Optional[str] = None
+        self.started: Optional[float] = None
+        self.resumed_from = 0
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+    def status(self) -> dict[str, Any]:
+        rate = 0.0
+        eta = None
+        if self.started and self.done > self.resumed_from:
+            rate = (self.done - self.resumed_from) / max(time.monotonic() - self.started, 1e-6)
+            eta = round((self.total - self.done) / rate, 1) if rate else None
+        return {
+            "collection": self.collection_name,
+            "model": self.model,
+            "state": self.state,
+            "total": self.total,
+            "done": self.done,
+            "skipped": self.skipped,
+            "progress": round(self.done / self.total, 4) if self.total else 0.0,
+            "rate": round(rate, 2),
+            "eta_seconds": eta,
+            "error": self.error,
+        }
+
+    def load_checkpoint(self, source) -> Optional[dict]:
+        try:
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+            with open(self.ids_path, "r", encoding="utf-8") as f:
+                checkpoint["ids"] = [json.loads(line) for line in f if line.strip()]
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        # 模型或源集合不同的断点属于另一次迁移
+        if checkpoint.get("model") != self.model or checkpoint.get("source") != str(source.id):
+            return None
+        return checkpoint
+
+    def save_ids(self, ids: list[str], append: bool = False) -> None:
+        # 待迁移的id列表只在开始时写入一次，从断点恢复时只追加新增的id，每行一个JSON字符串
+        lines = [json.dumps(doc_id) + "\n" for doc_id in ids]
+        if append:
+            with open(self.ids_path, "a", encoding="utf-8") as f:
+                f.writelines(lines)
+            return
+        tmp_path = f"{self.ids_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        os.replace(tmp_path, self.ids_path)
+
+    def save_checkpoint(self, source, position: int, dimension: Optional[int]) -> None:
+        # 每批只记录位置以及模型、源集合和向量维度，写入量与集合大小无关
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"model": self.model, "source": str(source.id), "dimension": dimension, "position": position}, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def owns(self, collection, source) -> bool:
+        # 影子集合创建时在metadata中记录源集合，只删除或复用带有该标记的集合，不误伤同名的用户集合
+        return (collection.metadata or {}).get("migrating_from") == str(source.id)
+
+    def read(self, source, ids: list[str]) -> dict[str, tuple]:
+        data = source.get(ids=ids, include=["documents", "metadatas"])
+        return {doc_id: (document, metadata) for doc_id, document, metadata
+                in zip(data["ids"], data["documents"], data["metadatas"])} # type: ignore
+
+    def copy(self, source, shadow, ids: list[str]) -> None:
+        # 在写锁之外读取并重新嵌入，持锁时重新读取源集合，只有内容未变的文档沿用已算好的向量，
+        # 期间被修改的少量文档在锁内重新嵌入
+        snapshot = {doc_id: value for doc_id, value in self.read(source, ids).items() if value[0] is not None}
+        vectors = self.embedding_function([document for document, _ in snapshot.values()]) if snapshot else []
+        embedded = {doc_id: (value, vector) for (doc_id, value), vector in zip(snapshot.items(), vectors)}
+        with self.rag.write_lock:
+            current = self.read(source, ids)
+            with_metadata: dict[str, list] = {"ids": [], "documents": [], "metadatas": [], "embeddings": []}
+            without_metadata: dict[str, list] = {"ids": [], "documents": [], "embeddings": []}
+            for doc_id, (document, metadata) in current.items():
+                if document is None:
+                    # 没有原文的文档无法重新嵌入
+                    self.skipped += 1
+                    continue
+                target = with_metadata if metadata else without_metadata
+                target["ids"].append(doc_id)
+                target["documents"].append(document)
+                if metadata:
+                    target["metadatas"].append(metadata)
+                previous = embedded.get(doc_id)
+                target["embeddings"].append(previous[1] if previous and previous[0] == (document, metadata) else None)
+            for target in (with_metadata, without_metadata):
+                if not target["ids"]:
+                    continue
+                changed = [i for i, vector in enumerate(target["embeddings"]) if vector is None]
+                if changed:
+                    for i, vector in zip(changed, self.embedding_function([target["documents"][i] for i in changed])):
+                        target["embeddings"][i] = vector
+                target["embeddings"] = [[float(value) for value in vector] for vector in target["embeddings"]]
+                shadow.upsert(**target)
+
+    def remove_stale(self, source, shadow) -> None:
+        # 删除影子集合中源集合已经不存在的文档，需要在写锁内执行
+        source_ids = set(source.get(include=[])["ids"])
+        stale = [doc_id for doc_id in shadow.get(include=[])["ids"] if doc_id not in source_ids]
+        if stale:
+            shadow.delete(ids=stale)
+
+    def reconcile(self, source, shadow, ids: list[str]) -> None:
+        # 从断点恢复时，进程中断期间源集合的修改没有同步到影子集合，逐批比对已复制的部分，
+        # 只对内容不同的文档重新嵌入
+        for start in range(0, len(ids), self.batch_size):
+            batch = ids[start:start+self.batch_size]
+            old = source.get(ids=batch, include=["documents", "metadatas"])
+            new = shadow.get(ids=batch, include=["documents", "metadatas"])
+            copied = {doc_id: (document, metadata) for doc_id, document, metadata
+                      in zip(new["ids"], new["documents"], new["metadatas"])} # type: ignore
+            changed = [doc_id for doc_id, document, metadata
+                       in zip(old["ids"], old["documents"], old["metadatas"]) # type: ignore
+                       if copied.get(doc_id) != (document, metadata)]
+            if changed:
+                self.copy(source, shadow, changed)
+
+    def run(self) -> None:
+        rag = self.rag
+        try:
+            self.state = "running"
+            source = rag.client.get_collection(self.collection_name)
+            if rag.check_collection(self.retired_name):
+                raise ValueError(f"collection {self.retired_name} already exists, "
+                                 f"rename or delete it before migrating {self.collection_name}")
+            existing = rag.client.get_collection(self.shadow_name) if rag.check_collection(self.shadow_name) else None
+            if existing is not None and not self.owns(existing, source):
+                raise ValueError(f"collection {self.shadow_name} exists and is not a migration shadow of {self.collection_name}")
+            checkpoint = self.load_checkpoint(source)
+            shadow = None
+            dimension = None
+            if checkpoint and existing is not None and (existing.metadata or {}).get("target_model") == self.model:
+                shadow = rag.client.get_collection(self.shadow_name, embedding_function=self.embedding_function)
+                dimension = checkpoint.get("dimension")
+                # 影子集合中的向量维度与断点记录不符时重新开始
+                if dimension is not None and rag.dimension(shadow) != dimension:
+                    shadow = None
+            if shadow is not None and checkpoint:
+                ids = checkpoint["ids"]
+                position = checkpoint["position"]
+                with rag.write_lock:
+                    rag.mirrors[self.collection_name] = shadow
+                    self.remove_stale(source, shadow)
+                    # 中断期间新增的文档追加到待迁移列表末尾
+                    known = set(ids)
+                    added = [doc_id for doc_id in source.get(include=[])["ids"] if doc_id not in known]
+                ids += added
+                self.save_ids(added, append=True)
+                # 双写已经生效，比对和重新嵌入不需要持有写锁
+                self.reconcile(source, shadow, ids[:position])
+            else:
+                if existing is not None:
+                    rag.client.delete_collection(self.shadow_name)
+                metadata = dict(source.metadata or {})
+                metadata["embedding_model"] = self.model
+                metadata["migrating_from"] = str(source.id)
+                metadata["target_model"] = self.model
+                shadow = rag.client.create_collection(name=self.shadow_name, metadata=metadata,
+                                                      embedding_function=self.embedding_function)
+                with rag.write_lock:
+                    # 先注册双写再取id快照，之后的写入都会同步到影子集合
+                    rag.mirrors[self.collection_name] = shadow
+                    ids = source.get(include=[])["ids"]
+                position = 0
+                # 先删除旧断点，避免新的id列表和旧的位置组合在一起
+                if os.path.exists(self.checkpoint_path):
+                    os.remove(self.checkpoint_path)
+                self.save_ids(ids)
+                self.save_checkpoint(source, position, dimension)
+            self.total = len(ids)
+            self.done = self.resumed_from = position
+            self.started = time.monotonic()
+            while position < len(ids):
+                if self.stop_event.is_set():
+                    self.state = "stopped"
+                    return
+                batch_start = time.monotonic()
+                batch = ids[position:position+self.batch_size]
+                self.copy(source, shadow, batch)
+                position += len(batch)
+                self.done = position
+                dimension = dimension or rag.dimension(shadow)
+                self.save_checkpoint(source, position, dimension)
+                if self.max_rate > 0:
+                    delay = len(batch) / self.max_rate - (time.monotonic() - batch_start)
+                    if delay > 0:
+                        time.sleep(delay)
+            self.switch(source)
+            os.remove(self.checkpoint_path)
+            os.remove(self.ids_path)
+            self.state = "completed"
+            if self.on_complete:
+                self.on_complete()
+        except Exception as e:
+            logging.exception(f"migration of {self.collection_name} failed")
+            self.state = "failed"
+            self.error = str(e)
+        finally:
+            if self.state != "completed":
+                with rag.write_lock:
+                    rag.mirrors.pop(self.collection_name, None)
+
+    def switch(self, source) -> None:
+        # 同时持有写锁和查询的独占锁，正在执行的查询结束后才切换，之后的查询都使用新集合和新模型
+        rag = self.rag
+        with rag.write_lock, rag.switch_lock.exclusive():
+            if rag.check_collection(self.retired_name):
+                raise ValueError(f"collection {self.retired_name} already exists, cannot retire {self.collection_name}")
+            rag.mirrors.pop(self.collection_name, None)
+            source.modify(name=self.retired_name)
+            rag.client.get_collection(self.shadow_name).modify(name=self.collection_name)
+            rag.model_functions[self.model] = self.embedding_function
+            current = getattr(rag, "collection", None)
+            if current is not None and current.id == source.id:
+                rag.collection = rag.client.get_collection(self.collection_name, embedding_function=self.embedding_function)
+            rag.client.delete_collection(self.retired_name)
@@ -0,0 +1,201 @@
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+from tokens import estimate_tokens, message_tokens
+
+CONTEXT_TEMPLATE = "请参考以下资料回答问题，资料与问题无关时忽略资料。\n\n资料：\n{context}\n\n问题：{question}"
+
+
+def shingles(text: str, size: int = 5) -> set[str]:
+    text = "".join(text.split())
+    if len(text) <= size:
+        return {text}
+    return {text[i:i+size] for i in range(len(text) - size + 1)}
+
+
+def deduplicate(chunks: list[dict[str, Any]], threshold: float = 0.8) -> tuple[list[dict[str, Any]], int]:
+    """
+    去掉重叠的片段。chunks按相似度从高到低排列，两个片段的字符n-gram重叠系数
+    （交集除以较小的集合）不低于threshold时只保留相似度高的一个，互相包含的片段重叠系数为1。
+
+    :param chunks: 检索结果
+    :param threshold: 判定为重复的重叠系数
+    :return: (去重后的片段, 去掉的数量)
+    """
+    kept: list[dict[str, Any]] = []
+    kept_shingles: list[set[str]] = []
+    seen_ids = set()
+    for chunk in chunks:
+        if chunk["id"] in seen_ids or not chunk.get("document"):
+            continue
+        current = shingles(chunk["document"])
+        if any(len(current & other) / min(len(current), len(other)) >= threshold for other in kept_shingles):
+            continue
+        seen_ids.add(chunk["id"])
+        kept.append(chunk)
+        kept_shingles.append(current)
+    return kept, len(chunks) - len(kept)
+
+
+def pack(chunks: list[dict[str, Any]], budget: int) -> tuple[list[dict[str, Any]], int]:
+    """
+    按相似度从高到低把片段放入token预算，放不下的片段跳过，继续尝试更短的片段。
+
+    :param chunks: 去重后的片段
+    :param budget: 资料的token预算
+    :return: (选中的片段, 使用的token数量)
+    """
+    selected = []
+    used = 0
+    for chunk in sorted(chunks, key=lambda chunk: chunk["score"], reverse=True):
+        cost = estimate_tokens(chunk["document"]) + 1
+        if used + cost > budget:
+            continue
+        selected.append(chunk)
+        used += cost
+    return selected, used
+
+
+class RAGPipeline:
+    """
+    检索增强对话：检索资料的同时裁剪聊天记录，对检索结果去重后按token预算挑选资料，
+    拼进用户消息发送给模型，并返回各阶段耗时。
+
+    :param llm: Base_llm 或 Async_Base_llm 实例
+    :param rag: RAG实例，使用其当前集合检索
+    :param context_tokens: 资料的token预算
+    :param top_k: 检索的片段数量
+    :param similarity_value: 相似度下限（百分比）
+    :param overlap_threshold: 判定片段重复的重叠系数
+    :param keep_context: 是否在聊天记录中保留资料，默认只保留原始问题，避免后续轮次重复携带资料
+    :param template: 拼接资料和问题的模板，包含 {context} 和 {question}
+    """
+    def __init__(self,
+                 llm,
+                 rag,
+                 context_tokens: int = 2000,
+                 top_k: int = 10,
+                 similarity_value: float = 50,
+                 overlap_threshold: float = 0.8,
+                 keep_context: bool = False,
+                 template: str = CONTEXT_TEMPLATE):
+        if context_tokens <= 0:
+            raise ValueError("context_tokens should be positive")
+        self.llm = llm
+        self.rag = rag
+        self.context_tokens = context_tokens
+        self.top_k = top_k
+        self.similarity_value = similarity_value
+        self.overlap_threshold = overlap_threshold
+        self.keep_context = keep_context
+        self.template = template
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def retrieve(self, question: str) -> tuple[list[dict[str, Any]], float]:
+        start = time.perf_counter()
+        try:
+            results = self.rag.query(question, top_k=self.top_k, similarity_value=self.similarity_value)
+        except ValueError:
+            results = []
+        for result in results:
+            result["score"] = float(str(result["similarity"]).rstrip("%"))
+        return results, time.perf_counter() - start
+
+    def reserve(self, question: str) -> int:
+        # 为本轮的问题、资料和模板预留的token数量
+        return (message_tokens({"role": "user", "content": self.template.format(context="", question=question)})
+                + self.context_tokens)
+
+    def build(self, question: str, results: list[dict[str, Any]], timings: dict[str, float]) -> tuple[dict, dict[str, Any]]:
+        start = time.perf_counter()
+        unique, removed = deduplicate(results, self.overlap_threshold)
+        timings["dedup"] = time.perf_counter() - start
+        start = time.perf_counter()
+        selected, used = pack(unique, self.context_tokens)
+        timings["pack"] = time.perf_counter() - start
+        if selected:
+            context = "\n\n".join(f"[{i+1}] {chunk['document']}" for i, chunk in enumerate(selected))
+            message = {"role": "user", "content": self.template.format(context=context, question=question)}
+        else:
+            message = {"role": "user", "content": question}
+        stats = {
+            "retrieved": len(results),
+            "duplicates": removed,
+            "selected": len(selected),
+            "context_tokens": used,
+        }
+        return message, {"context": [{k: v for k, v in chunk.items() if k != "score"} for chunk in selected],
+                         "stats": stats}
+
+    def strip_context(self, message: dict, question: str) -> None:
+        # 发送后把聊天记录中带资料的消息换回原始问题
+        if self.keep_context or message["content"] == question:
+            return
+        plain = {"role": "user", "content": question}
+        llm = self.llm
+        llm.sync_tokens()
+        for history in (llm.chat_history, llm.store_history):
+            for index in range(len(history) - 1, -1, -1):
+                if history[index] is message:
+                    history[index] = plain
+                    if history is llm.chat_history:
+                        llm.history_tokens[index] = message_tokens(plain)
+                    break
+
+    def finish(self, answer: dict, extra: dict[str, Any], timings: dict[str, float], started: float) -> dict[str, Any]:
+        timings["total"] = time.perf_counter() - started
+        return {
+            "message": answer,
+            **extra,
+            "timings": {stage: round(seconds * 1000, 2) for stage, seconds in timings.items()},
+        }
+
+    def ask(self, question: str) -> dict[str, Any]:
+        """
+        检索资料并发送问题，llm为 Base_llm 时使用。
+
+        :param question: 问题
+        :return: 模型回复、使用的资料、统计信息和各阶段耗时（毫秒）
+        """
+        started = time.perf_counter()
+        timings: dict[str, float] = {}
+        future = self.executor.submit(self.retrieve, question)
+        start = time.perf_counter()
+        self.llm.limiter(self.reserve(question))
+        timings["history"] = time.perf_counter() - start
+        results, timings["retrieval"] = future.result()
+        message, extra = self.build(question, results, timings)
+        start = time.perf_counter()
+        answer = self.llm.send(message)
+        timings["generation"] = time.perf_counter() - start
+        self.strip_context(message, question)
+        return self.finish(answer, extra, timings, started)
+
+    async def aask(self, question: str) -> dict[str, Any]:
+        """
+        检索资料并发送问题，llm为 Async_Base_llm 时使用，检索在线程中执行。
+
+        :param question: 问题
+        :return: 模型回复、使用的资料、统计信息和各阶段耗时（毫秒）
+        """
+        started = time.perf_counter()
+        timings: dict[str, float] = {}
+
+        async def prepare_history():
+            start = time.perf_counter()
+            await self.llm.limiter(self.reserve(question))
+            return time.perf_counter() - start
+
+        (results, timings["retrieval"]), timings["history"] = await asyncio.gather(
+            asyncio.to_thread(self.retrieve, question), prepare_history())
+        message, extra = self.build(question, results, timings)
+        start = time.perf_counter()
+        answer = await self.llm.send(message)
+        timings["generation"] = time.perf_counter() - start
+        self.strip_context(message, question)
+        return self.finish(answer, extra, timings, started)
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False)
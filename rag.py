@@ -1,23 +1,134 @@
+from __future__ import annotations
 import os
+import threading
 from uuid import uuid4
-import chromadb
-from chromadb.utils import embedding_functions
-from chromadb import EmbeddingFunction
-from typing import Optional, Union, List, Dict, Any
+from contextlib import contextmanager
+from typing import Optional, Union, List, Dict, Any, Callable, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import chromadb
+    from chromadb import EmbeddingFunction
+
+# metadata中带有该键的集合供内部使用（如语义缓存），不出现在集合列表、预热和统计中
+INTERNAL_KEY = "rag:internal"
+
+def is_internal(collection) -> bool:
+    # 较新的chromadb版本 list_collections 只返回名称，无法判断时视为用户集合
+    return bool((getattr(collection, "metadata", None) or {}).get(INTERNAL_KEY))
+
+class SharedLock:
+    """
+    读写锁：查询持有共享锁并发执行，切换集合时持有独占锁，等待正在执行的查询结束并阻止新的查询。
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = False
+
+    @contextmanager
+    def shared(self):
+        with self.condition:
+            while self.writer:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self.condition:
+            while self.writer:
+                self.condition.wait()
+            self.writer = True
+            while self.readers:
+                self.condition.wait()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = False
+                self.condition.notify_all()
 
 class RAG:
+    # chromadb 和默认的本地嵌入模型导入较慢，首次使用时才加载
     def __init__(self, 
                  store_path: str = "", 
-                 embedding_function:Optional[EmbeddingFunction] = embedding_functions.DefaultEmbeddingFunction(), 
+                 embedding_function:Optional[EmbeddingFunction] = None, 
                  persistent: bool = True,
-                 chroma_executable_path: str = "chroma"):
+                 chroma_executable_path: str = "chroma",
+                 embedding_function_factory: Optional[Callable[[str], EmbeddingFunction]] = None):
         self.store_path = store_path
-        if persistent and store_path:
-            self.client = chromadb.PersistentClient(path=store_path)
-        else:
-            self.client = chromadb.Client()
-        self.embedding_function = embedding_function
+        self.persistent = persistent
+        self._client = None
+        self._embedding_function = embedding_function
+        self._init_lock = threading.Lock()
         self.chroma_executable_path = chroma_executable_path
+        # 集合metadata中记录了embedding_model时，用工厂按模型名创建对应的嵌入函数
+        self.embedding_function_factory = embedding_function_factory
+        self.model_functions: dict[str, EmbeddingFunction] = {}
+        # 修改操作持有write_lock；mirrors中的集合会同步收到对应源集合的所有写入，用于迁移期间双写
+        self.write_lock = threading.RLock()
+        self.mirrors: dict[str, chromadb.Collection] = {}
+        # 查询持有switch_lock的共享锁，迁移切换集合和嵌入函数时持有独占锁
+        self.switch_lock = SharedLock()
+        # 按集合id缓存向量维度，用于校验调用方直接提供的向量
+        self.dimensions: dict[Any, int] = {}
+
+    @property
+    def client(self) -> chromadb.ClientAPI:
+        if self._client is None:
+            with self._init_lock:
+                if self._client is None:
+                    import chromadb
+                    if self.persistent and self.store_path:
+                        self._client = chromadb.PersistentClient(path=self.store_path)
+                    else:
+                        self._client = chromadb.Client()
+        return self._client
+
+    @property
+    def embedding_function(self) -> EmbeddingFunction:
+        if self._embedding_function is None:
+            from chromadb.utils import embedding_functions
+            self._embedding_function = embedding_functions.DefaultEmbeddingFunction()
+        return self._embedding_function
+
+    @embedding_function.setter
+    def embedding_function(self, embedding_function: EmbeddingFunction) -> None:
+        self._embedding_function = embedding_function
+
+    def reload(self) -> None:
+        # 丢弃缓存的客户端并重新打开存储，只读副本借此读到其他进程的写入
+        collection_name = self.collection.name if getattr(self, "collection", None) is not None else None
+        with self._init_lock:
+            if self._client is not None:
+                # 只移除本存储的缓存条目，并停止旧的System，释放其sqlite连接、HNSW索引和后台线程
+                from chromadb.api.client import SharedSystemClient
+                system = self._client._system
+                SharedSystemClient._identifier_to_system.pop(self._client._identifier, None)
+                self._client = None
+                system.stop()
+        if collection_name and self.check_collection(collection_name):
+            self.change_collection(collection_name)
+
+    def warm_up(self) -> list[str]:
+        # 每个集合用已存储的向量查询一次，让chroma把HNSW索引加载进内存，不触发嵌入请求
+        warmed = []
+        for collection in self.client.list_collections():
+            if is_internal(collection):
+                continue
+            sample = collection.get(limit=1, include=["embeddings"])
+            embeddings = sample.get("embeddings")
+            if embeddings is None or len(embeddings) == 0:
+                continue
+            collection.query(query_embeddings=[list(embeddings[0])], n_results=1, include=[])
+            warmed.append(collection.name)
+        return warmed
 
     def check_collection(self, collection_name: str) -> bool:
         collections = self.client.list_collections()
@@ -45,44 +156,112 @@ class RAG:
         self.client.delete_collection(name)
         return None
 
+    def collection_embedding_function(self, collection_name: str) -> EmbeddingFunction:
+        return self.model_embedding_function((self.client.get_collection(collection_name).metadata or {}).get("embedding_model"))
+
+    def model_embedding_function(self, model: Optional[str]) -> EmbeddingFunction:
+        if not model or self.embedding_function_factory is None:
+            return self.embedding_function
+        if model not in self.model_functions:
+            self.model_functions[model] = self.embedding_function_factory(model)
+        return self.model_functions[model]
+
     def change_collection(self, collection_name: str) -> None:
         if self.check_collection(collection_name=collection_name):
-            self.collection = self.client.get_collection(collection_name,embedding_function=self.embedding_function)
+            self.collection = self.client.get_collection(collection_name,embedding_function=self.collection_embedding_function(collection_name))
             return None
         else:
             raise ValueError(f"collection {collection_name} not found")
         
+    def _mirror(self) -> Optional[chromadb.Collection]:
+        return self.mirrors.get(self.collection.name)
+
+
+    def dimension(self, collection: Optional[chromadb.Collection] = None) -> Optional[int]:
+        # 集合的向量维度取自已存储的任意一条向量，集合为空时返回None
+        collection = collection or self.collection
+        if collection.id not in self.dimensions:
+            stored = collection.get(limit=1, include=["embeddings"])["embeddings"]
+            if stored is None or len(stored) == 0:
+                return None
+            self.dimensions[collection.id] = len(stored[0])
+        return self.dimensions[collection.id]
+
+    def validate_embeddings(self, embeddings: List[List[float]], count: Optional[int] = None) -> None:
+        if count is not None and len(embeddings) != count:
+            raise ValueError(f"expected {count} embeddings, got {len(embeddings)}")
+        dimensions = {len(embedding) for embedding in embeddings}
+        if len(dimensions) > 1:
+            raise ValueError(f"embeddings have different dimensions {sorted(dimensions)}")
+        expected = self.dimension()
+        if expected is not None and dimensions and dimensions != {expected}:
+            raise ValueError(f"embedding dimension {dimensions.pop()} does not match collection dimension {expected}")
 
     def store(self, 
             text: Union[str, List[str]], 
-            metadata: Union[Dict[str, str], List[Dict[str, Any]],None]=None) -> None:
+            metadata: Union[Dict[str, str], List[Dict[str, Any]],None]=None,
+            embeddings: Optional[List[List[float]]] = None) -> List[str]:
+        # 传入embeddings时直接写入，不调用嵌入函数；迁移中的影子集合使用不同的模型，仍按文本重新嵌入
         kwargs:dict[str,Any]={"documents":text}
         if metadata and isinstance(metadata, dict):
             kwargs["metadatas"]=[metadata]
+        elif metadata:
+            kwargs["metadatas"]=metadata
         if isinstance(text, str):
             kwargs["ids"]=[str(uuid4())]
         if isinstance(text, list):
             kwargs["ids"]=[str(uuid4()) for _ in range(len(text))]
-        self.collection.add(**kwargs)
-        return None
+        if embeddings is not None:
+            self.validate_embeddings(embeddings, len(kwargs["ids"]))
+        with self.write_lock:
+            mirror = self._mirror()
+            size = self.client.get_max_batch_size()
+            # 超过chroma单次写入上限时分批写入，嵌入请求的打包由嵌入函数负责
+            for start in range(0, len(kwargs["ids"]), size):
+                chunk = {key: value[start:start+size] if isinstance(value, list) else value for key, value in kwargs.items()}
+                if embeddings is not None:
+                    self.collection.add(embeddings=embeddings[start:start+size], **chunk) # type: ignore
+                else:
+                    self.collection.add(**chunk)
+                if mirror is not None:
+                    mirror.add(**chunk)
+        return kwargs["ids"]
+
+    def similarity(self, distance: float, space: Optional[str] = None) -> float:
+        # 按集合的距离空间把距离换算成百分比相似度
+        # cosine 和 ip 的距离都是 1 - 相似度；l2 为平方距离，按单位向量换算为余弦相似度 1 - d/2
+        if space is None:
+            space = (self.collection.metadata or {}).get("hnsw:space", "l2")
+        if space in ("cosine", "ip"):
+            return (1 - distance) * 100
+        if space == "l2":
+            return (1 - distance / 2) * 100
+        raise ValueError(f"unknown hnsw space {space}")
 
     def query(self, query_text: str, top_k: int = 1,similarity_value:float=0.5):
-        results = self.collection.query(
-            query_texts=query_text,
-            n_results=top_k
-        )
-        for i in results:
-            if i:
-                pass
-            else:
-                raise ValueError("No result found")
+        with self.switch_lock.shared():
+            results = self.collection.query(
+                query_texts=query_text,
+                n_results=top_k
+            )
+            for i in results:
+                if i:
+                    pass
+                else:
+                    raise ValueError("No result found")
+            return self.restructure(results, similarity_value)
+
+    def restructure(self, results, similarity_value: float, exclude: Optional[str] = None) -> list[dict[str, Any]]:
+        space = (self.collection.metadata or {}).get("hnsw:space", "l2")
         restructured = []
         for i in range(len(results['ids'][0])):
             doc_id = results['ids'][0][i]
+            if doc_id == exclude:
+                continue
             document = results['documents'][0][i] # type: ignore
             metadata = results['metadatas'][0][i] # type: ignore
             distance = results['distances'][0][i] # type: ignore
-            similarity=(1 - abs(distance)) * 100
+            similarity=self.similarity(distance, space)
             if similarity<similarity_value:
                 continue
             similarity=format(similarity, ".2f") + "%"
@@ -95,20 +274,159 @@ class RAG:
         
         return restructured
 
+    def query_by_vector(self, embedding: List[float], top_k: int = 1, similarity_value: float = 0.5) -> list[dict[str, Any]]:
+        # 用调用方提供的向量查询，不调用嵌入函数
+        with self.switch_lock.shared():
+            self.validate_embeddings([embedding])
+            results = self.collection.query(query_embeddings=[list(embedding)], n_results=top_k)
+            return self.restructure(results, similarity_value)
+
+    def query_by_id(self, id: str, top_k: int = 1, similarity_value: float = 0.5, include_self: bool = False) -> list[dict[str, Any]]:
+        # 复用已存储文档的向量查找相似文档，默认不返回该文档本身
+        with self.switch_lock.shared():
+            stored = self.collection.get(ids=[id], include=["embeddings"])
+            if not stored["ids"]:
+                raise ValueError(f"document {id} not found")
+            embedding = list(stored["embeddings"][0]) # type: ignore
+            n_results = top_k if include_self else top_k + 1
+            results = self.collection.query(query_embeddings=[embedding], n_results=n_results)
+            restructured = self.restructure(results, similarity_value, exclude=None if include_self else id)
+            return restructured[:top_k]
+
+    def range_query(self, query_text: str, similarity_value: float = 80, initial_k: int = 10, max_k: int = 1000, growth: int = 2):
+        # 返回相似度不低于similarity_value的所有结果：候选数量从initial_k开始按growth倍扩大，
+        # 直到出现低于阈值的结果、取完整个集合或达到max_k，结果逐个产出
+        if initial_k <= 0 or growth < 2:
+            raise ValueError("initial_k should be positive and growth at least 2")
+        # 结果是逐步产出的，不在产出期间持有共享锁；每次查询前确认集合没有被迁移切换
+        with self.switch_lock.shared():
+            collection = self.collection
+            total = collection.count()
+            if total == 0:
+                return
+            space = (collection.metadata or {}).get("hnsw:space", "l2")
+            # 查询文本只嵌入一次，扩大候选数量时复用向量
+            query_embedding = self.collection_embedding_function(collection.name)([query_text])[0]
+        seen: set[str] = set()
+        k = min(initial_k, max_k, total)
+        while True:
+            with self.switch_lock.shared():
+                if self.collection.id != collection.id:
+                    raise ValueError(f"collection {collection.name} was switched during the range query")
+                results = collection.query(
+                    query_embeddings=[list(query_embedding)],
+                    n_results=k
+                )
+            crossed = False
+            for i in range(len(results['ids'][0])):
+                distance = results['distances'][0][i] # type: ignore
+                similarity = self.similarity(distance, space)
+                if similarity < similarity_value:
+                    crossed = True
+                    break
+                doc_id = results['ids'][0][i]
+                if doc_id in seen:
+                    continue
+                seen.add(doc_id)
+                yield {
+                    "document": results['documents'][0][i], # type: ignore
+                    "metadata": results['metadatas'][0][i], # type: ignore
+                    "id": doc_id,
+                    "similarity": format(similarity, ".2f") + "%"
+                }
+            if crossed or k >= total or k >= max_k:
+                return
+            k = min(k * growth, max_k, total)
+
     def update(self,id:str,text:str,metadata:dict[str,str] = {}):
+        kwargs:dict[str,Any]={"documents":text, "ids":id}
         if metadata:
-            self.collection.update(documents=text, metadatas=metadata, ids=id)
-        else:
-            self.collection.update(documents=text, ids=id)
+            kwargs["metadatas"]=metadata
+        with self.write_lock:
+            self.collection.update(**kwargs)
+            mirror = self._mirror()
+            if mirror is not None:
+                # 尚未复制到影子集合的文档在复制时会读到更新后的内容
+                mirror.update(**kwargs)
         return None
     
     def delete(self,id:Union[str,list[str]]):
         ids = [id] if isinstance(id, str) else id
-        self.collection.delete(ids=ids)
+        with self.write_lock:
+            self.collection.delete(ids=ids)
+            mirror = self._mirror()
+            if mirror is not None:
+                mirror.delete(ids=ids)
         return None
 
+    def batch_update(self, items: list[dict[str, Any]]) -> dict[str, Any]:
+        # items 中每项包含 id，以及可选的 text 和 metadata
+        # 只对内容变化的文本做一次批量嵌入，其余沿用已存储的向量，整体作为一次chroma更新
+        ids = [item["id"] for item in items]
+        if len(set(ids)) != len(ids):
+            raise ValueError("duplicate ids in batch update")
+        with self.write_lock:
+            existing = self.collection.get(ids=ids, include=["documents", "metadatas", "embeddings"])
+            stored = {doc_id: i for i, doc_id in enumerate(existing["ids"])}
+            found = [item for item in items if item["id"] in stored]
+            missing = [item["id"] for item in items if item["id"] not in stored]
+            if not found:
+                return {"updated": 0, "embedded": 0, "missing": missing}
+            documents, metadatas, embeddings, changed = [], [], [], []
+            for item in found:
+                index = stored[item["id"]]
+                old_document = existing["documents"][index] # type: ignore
+                document = item.get("text")
+                if document is None:
+                    document = old_document
+                documents.append(document)
+                metadatas.append(item.get("metadata") or existing["metadatas"][index]) # type: ignore
+                if document != old_document:
+                    changed.append(len(embeddings))
+                embeddings.append(existing["embeddings"][index]) # type: ignore
+            if changed:
+                vectors = self.collection_embedding_function(self.collection.name)([documents[i] for i in changed])
+                for position, vector in zip(changed, vectors):
+                    embeddings[position] = vector
+            mirror = self._mirror()
+            # chroma要求一次更新中要么全部有metadata要么都没有，按是否有metadata分开更新
+            for with_metadata in (True, False):
+                selected = [i for i in range(len(found)) if bool(metadatas[i]) == with_metadata]
+                if not selected:
+                    continue
+                kwargs: dict[str, Any] = {
+                    "ids": [found[i]["id"] for i in selected],
+                    "documents": [documents[i] for i in selected],
+                }
+                if with_metadata:
+                    kwargs["metadatas"] = [metadatas[i] for i in selected]
+                self.collection.update(embeddings=[list(embeddings[i]) for i in selected], **kwargs)
+                if mirror is not None:
+                    mirror.update(**kwargs)
+        return {"updated": len(found), "embedded": len(changed), "missing": missing}
+
+    def delete_by(self, ids: Optional[list[str]] = None, where: Optional[dict[str, Any]] = None) -> int:
+        # 按id列表和/或metadata过滤条件删除，返回实际删除的数量
+        if not ids and not where:
+            raise ValueError("ids or where is required")
+        kwargs: dict[str, Any] = {}
+        if ids:
+            kwargs["ids"] = ids
+        if where:
+            kwargs["where"] = where
+        with self.write_lock:
+            matched = self.collection.get(include=[], **kwargs)["ids"]
+            if not matched:
+                return 0
+            self.collection.delete(ids=matched)
+            mirror = self._mirror()
+            if mirror is not None:
+                mirror.delete(ids=matched)
+        return len(matched)
+
     def get_data(self):
-        results=self.collection.get()
+        with self.switch_lock.shared():
+            results=self.collection.get()
         for i in results:
             if i:
                 pass
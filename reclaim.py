@@ -0,0 +1,214 @@
+import os
+import re
+import time
+import shutil
+import sqlite3
+import logging
+import threading
+from typing import Any, Callable, Optional
+
+_SEGMENT_DIR = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+
+def directory_size(path: str) -> int:
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            continue
+    return total
+
+
+def open_handles(pids: list[int], path: str) -> list[int]:
+    """
+    通过 /proc/<pid>/fd 查找打开了path下文件的进程。没有 /proc 的系统上返回空列表，
+    由改名或删除失败来发现仍被占用的目录。
+
+    :return: 打开了其中文件的进程号
+    """
+    prefix = path.rstrip(os.sep) + os.sep
+    holders = []
+    for pid in pids:
+        try:
+            fds = os.listdir(f"/proc/{pid}/fd")
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                target = os.readlink(f"/proc/{pid}/fd/{fd}")
+            except OSError:
+                continue
+            if target.startswith(prefix):
+                holders.append(pid)
+                break
+    return holders
+
+
+class SegmentReclaimer:
+    """
+    在后台回收已删除集合遗留的段目录。存储目录下以UUID命名、但不再出现在chroma.sqlite3
+    segments表中的目录即为孤立目录。只有在没有客户端引用时才回收：所有只读副本都在目录被发现孤立之后
+    重新打开过存储，并且本进程和副本进程都没有打开其中的文件。
+    回收时先改名移入 .trash 使其立即脱离存储，再用 shutil.rmtree 整体删除；改名或删除失败的目录留到下一轮重试。
+
+    :param store_path: chromadb存储路径
+    :param interval: 两次自动扫描的间隔（秒）
+    :param replicas: 返回仍在运行的只读副本（进程号和最近一次打开存储的时间）的函数
+    """
+    def __init__(self, store_path: str, interval: float = 300,
+                 replicas: Optional[Callable[[], list[dict]]] = None):
+        self.store_path = store_path
+        self.trash_path = os.path.join(store_path, ".trash")
+        self.interval = interval
+        self.replicas = replicas
+        self.pending: dict[str, int] = {}
+        # 孤立目录第一次被发现的时间，在此之前打开存储的副本可能仍引用它
+        self.first_seen: dict[str, int] = {}
+        self.deferred: dict[str, str] = {}
+        self.reclaimed_bytes = 0
+        self.reclaimed_dirs = 0
+        self.failures = 0
+        self.last_run: Optional[float] = None
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def live_segments(self) -> Optional[set[str]]:
+        path = os.path.join(self.store_path, "chroma.sqlite3")
+        if not os.path.exists(path):
+            return None
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=5)
+        try:
+            return {row[0] for row in connection.execute("SELECT id FROM segments")}
+        finally:
+            connection.close()
+
+    def scan(self) -> dict[str, int]:
+        """
+        查找孤立的段目录。
+
+        :return: 目录路径到字节数的映射
+        """
+        # 先列目录再读segments表：之后新建的段目录不会被列出，避免误删
+        try:
+            names = [entry.name for entry in os.scandir(self.store_path)
+                     if entry.is_dir(follow_symlinks=False) and _SEGMENT_DIR.match(entry.name)]
+        except FileNotFoundError:
+            names = []
+        live = self.live_segments()
+        orphans = {}
+        if live is not None:
+            for name in names:
+                if name not in live:
+                    path = os.path.join(self.store_path, name)
+                    orphans[path] = directory_size(path)
+        if os.path.isdir(self.trash_path):
+            for entry in os.scandir(self.trash_path):
+                orphans[entry.path] = directory_size(entry.path)
+        now = time.time_ns()
+        with self.lock:
+            self.pending = dict(orphans)
+            self.first_seen = {path: self.first_seen.get(path, now) for path in orphans}
+        return orphans
+
+    def referenced(self, path: str) -> Optional[str]:
+        """
+        判断孤立目录是否仍可能被引用。
+
+        :return: 引用者的说明，没有引用时返回None
+        """
+        replicas = self.replicas() if self.replicas else []
+        first_seen = self.first_seen.get(path, time.time_ns())
+        stale = [replica["pid"] for replica in replicas if replica["opened"] < first_seen]
+        if stale:
+            return f"replicas {stale} have not reopened the store"
+        pids = list(dict.fromkeys([os.getpid()] + [replica["pid"] for replica in replicas]))
+        holders = open_handles(pids, path)
+        if holders:
+            return f"processes {holders} have open files"
+        return None
+
+    def remove(self, path: str) -> bool:
+        if os.path.dirname(path) != self.trash_path:
+            os.makedirs(self.trash_path, exist_ok=True)
+            target = os.path.join(self.trash_path, f"{os.path.basename(path)}.{time.time_ns()}")
+            os.rename(path, target)
+            path = target
+        shutil.rmtree(path)
+        return True
+
+    def reclaim(self) -> dict[str, Any]:
+        """
+        扫描并删除孤立的段目录。
+
+        :return: 本轮回收的目录数量和字节数
+        """
+        dirs = 0
+        reclaimed = 0
+        deferred = {}
+        for path, size in self.scan().items():
+            reason = self.referenced(path)
+            if reason:
+                deferred[path] = reason
+                continue
+            try:
+                self.remove(path)
+            except OSError as e:
+                logging.warning(f"failed to reclaim {path}, will retry: {e}")
+                with self.lock:
+                    self.failures += 1
+                continue
+            dirs += 1
+            reclaimed += size
+            with self.lock:
+                self.pending.pop(path, None)
+                self.reclaimed_dirs += 1
+                self.reclaimed_bytes += size
+                self.first_seen.pop(path, None)
+        with self.lock:
+            self.deferred = deferred
+        self.last_run = time.time()
+        return {"dirs": dirs, "bytes": reclaimed}
+
+    def run(self) -> None:
+        while not self.stop_event.is_set():
+            try:
+                self.reclaim()
+            except Exception:
+                logging.exception("segment reclamation failed")
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def notify(self) -> None:
+        """
+        请求尽快执行一轮回收，不等待回收完成。
+        """
+        self.wake.set()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        self.wake.set()
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            return {
+                "reclaimable_bytes": sum(self.pending.values()),
+                "reclaimable_dirs": len(self.pending),
+                "deferred": dict(self.deferred),
+                "reclaimed_bytes": self.reclaimed_bytes,
+                "reclaimed_dirs": self.reclaimed_dirs,
+                "failures": self.failures,
+                "last_run": self.last_run,
+            }
@@ -0,0 +1,152 @@
+import re
+import json
+import time
+import hashlib
+import threading
+from uuid import uuid4
+from typing import Any, Optional
+
+from rag import INTERNAL_KEY
+
+
+def normalize(text: str) -> str:
+    # 忽略大小写、多余空白和结尾标点的差异
+    return re.sub(r"\s+", " ", text).strip().lower().rstrip("?？!！.。~～ ")
+
+
+class SemanticCache:
+    """
+    语义缓存：把最后一条用户消息归一化后嵌入，在专用的RAG集合中查找相似的历史请求，
+    相似度达到阈值且未过期时直接返回缓存的助手消息。系统提示、工具和模型的哈希不同的请求互不命中，
+    不同租户的命名空间互相隔离。写入时每隔purge_interval秒顺带删除一次过期的缓存。
+
+    :param rag: RAG实例，只使用其客户端和嵌入函数，不改变当前集合
+    :param collection_name: 缓存集合名称
+    :param similarity_value: 命中所需的最低相似度（百分比）
+    :param ttl: 缓存有效期（秒），0 表示不过期
+    :param purge_interval: 两次清理过期缓存的最小间隔（秒）
+    """
+    def __init__(self,
+                 rag,
+                 collection_name: str = "semantic_cache",
+                 similarity_value: float = 95,
+                 ttl: float = 86400,
+                 purge_interval: float = 600):
+        self.rag = rag
+        self.collection_name = collection_name
+        self.similarity_value = similarity_value
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self.last_purge = time.monotonic()
+        self._collection = None
+        self.lock = threading.Lock()
+        self.counters: dict[str, dict[str, int]] = {}
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            with self.lock:
+                if self._collection is None:
+                    self._collection = self.rag.client.get_or_create_collection(
+                        self.collection_name, embedding_function=self.rag.embedding_function,
+                        metadata={"hnsw:space": "cosine", INTERNAL_KEY: "semantic_cache"})
+        return self._collection
+
+    def context_hash(self, system_prompt: str, tools: list, model: str) -> str:
+        data = json.dumps([system_prompt, tools, model], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def count(self, namespace: str, key: str) -> None:
+        with self.lock:
+            counter = self.counters.setdefault(namespace, {"hits": 0, "misses": 0, "stores": 0})
+            counter[key] += 1
+
+    def where(self, namespace: str, context: str) -> dict[str, Any]:
+        conditions: list[dict[str, Any]] = [{"namespace": namespace}, {"context": context}]
+        if self.ttl > 0:
+            conditions.append({"created": {"$gte": time.time() - self.ttl}})
+        return {"$and": conditions}
+
+    def lookup(self, text: str, context: str, namespace: str = "") -> Optional[dict]:
+        """
+        查找缓存。
+
+        :param text: 最后一条用户消息的文本
+        :param context: context_hash 的结果
+        :param namespace: 租户命名空间
+        :return: 命中时返回缓存的助手消息，否则返回None
+        """
+        query = normalize(text)
+        if not query:
+            return None
+        results = self.collection.query(query_texts=[query], n_results=1,
+                                        where=self.where(namespace, context),
+                                        include=["metadatas", "distances"])
+        if results["ids"] and results["ids"][0]:
+            distance = results["distances"][0][0] # type: ignore
+            if self.rag.similarity(distance, "cosine") >= self.similarity_value:
+                self.count(namespace, "hits")
+                return json.loads(results["metadatas"][0][0]["message"]) # type: ignore
+        self.count(namespace, "misses")
+        return None
+
+    def store(self, text: str, context: str, message: dict, namespace: str = "") -> None:
+        """
+        缓存助手消息，调用工具的回复不缓存。
+
+        :param text: 最后一条用户消息的文本
+        :param context: context_hash 的结果
+        :param message: 助手消息
+        :param namespace: 租户命名空间
+        """
+        query = normalize(text)
+        if not query or message.get("tool_calls"):
+            return
+        metadata = {
+            "namespace": namespace,
+            "context": context,
+            "created": time.time(),
+            "message": json.dumps(message, ensure_ascii=False),
+        }
+        with self.rag.write_lock:
+            self.collection.add(ids=[str(uuid4())], documents=[query], metadatas=[metadata])
+        self.count(namespace, "stores")
+        with self.lock:
+            due = self.ttl > 0 and time.monotonic() - self.last_purge >= self.purge_interval
+            if due:
+                self.last_purge = time.monotonic()
+        if due:
+            self.purge_expired()
+
+    def purge_expired(self) -> int:
+        """
+        删除过期的缓存。
+
+        :return: 删除的数量
+        """
+        if self.ttl <= 0:
+            return 0
+        with self.rag.write_lock:
+            expired = self.collection.get(where={"created": {"$lt": time.time() - self.ttl}}, include=[])["ids"]
+            if expired:
+                self.collection.delete(ids=expired)
+        return len(expired)
+
+    def clear(self, namespace: str = "") -> None:
+        with self.rag.write_lock:
+            self.collection.delete(where={"namespace": namespace})
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            namespaces = {name: dict(counter) for name, counter in self.counters.items()}
+        for counter in namespaces.values():
+            lookups = counter["hits"] + counter["misses"]
+            counter["hit_rate"] = round(counter["hits"] / lookups, 4) if lookups else 0.0
+        hits = sum(counter["hits"] for counter in namespaces.values())
+        lookups = hits + sum(counter["misses"] for counter in namespaces.values())
+        return {
+            "hits": hits,
+            "lookups": lookups,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "namespaces": namespaces,
+        }
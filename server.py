@@ -12,12 +12,23 @@ sys.path.append(cwd)
 import fastapi
 from pydantic import BaseModel
 import json
+import time
+import asyncio
+import logging
+import secrets
+import threading
 import uvicorn
-from rag import RAG
-from chromadb.utils.embedding_functions.openai_embedding_function import OpenAIEmbeddingFunction
-from chromadb import Collection
+from contextlib import asynccontextmanager
+from rag import RAG, is_internal
+from cluster import ReplicaState, is_read_path, serve, FANOUT_PATHS
+from reclaim import SegmentReclaimer
+from diagnostics import CollectionStats, SamplingProfiler
+from admission import AdmissionController, Lane, Rejected, classify, INTERACTIVE, INGEST, MAINTENANCE
 from fastapi.responses import JSONResponse
 from fastapi.responses import FileResponse
+from fastapi.responses import StreamingResponse
+from fastapi.responses import PlainTextResponse
+from starlette.datastructures import MutableHeaders
 
 config_path = os.path.join(cwd, "config.json")
 try:
@@ -30,13 +41,44 @@ except json.JSONDecodeError:
     print(f"Error: config.json at {config_path} is not valid JSON.")
     sys.exit(1)
 
+class EmbeddingEndpointConfig(BaseModel):
+    url: str
+    api_key: str
+    model: str = ""
+    weight: float = 1.0
+    rate_limit: float = 0.0
+
+class AdmissionLaneConfig(BaseModel):
+    workers: int
+    queue: int
+    max_wait: float = 10.0
+
 class Config(BaseModel):
     chroma_executable_path: str
     store_path: str
-    embedding_url: str
     embedding_model: str
-    embedding_api_key: str
     server_port: int
+    embedding_url: str = ""
+    embedding_api_key: str = ""
+    embedding_endpoints: list[EmbeddingEndpointConfig] = []
+    embedding_max_batch_tokens: int = 8000
+    embedding_max_batch_items: int = 256
+    embedding_max_input_tokens: int = 8000
+    embedding_overflow: str = "split"
+    prewarm: bool = True
+    workers: int = 0
+    max_staleness: float = 1.0
+    reclaim_interval: float = 300
+    async_ingest: bool = False
+    ingest_batch_size: int = 256
+    ingest_max_pending: int = 10000
+    admission_workers: int = 16
+    admission_interactive: AdmissionLaneConfig = AdmissionLaneConfig(workers=12, queue=256, max_wait=5.0)
+    admission_ingest: AdmissionLaneConfig = AdmissionLaneConfig(workers=4, queue=64, max_wait=30.0)
+    admission_maintenance: AdmissionLaneConfig = AdmissionLaneConfig(workers=1, queue=4, max_wait=60.0)
+    stats_ttl: float = 60
+    # 管理接口的令牌，为空时管理接口不可用
+    admin_token: str = ""
 
 try:
     config = Config.model_validate(data)
@@ -44,100 +86,683 @@ except Exception as e:
     print(f"Error validating configuration from config.json: {e}")
     sys.exit(1)
 
-try:
-    embedding_function = OpenAIEmbeddingFunction(
-                    api_key=config.embedding_api_key,
-                    api_base=config.embedding_url,
-                    model_name=config.embedding_model
-                )
-except Exception as e:
-     print(f"Error initializing OpenAIEmbeddingFunction: {e}")
-     sys.exit(1)
+# chromadb 和嵌入函数在 lifespan 中初始化，导入 server 本身不做耗时操作
+embedding_function = None
+embedding_pool = None
+rag: RAG = None # type: ignore
+ingest_queue = None
+collection_stats: CollectionStats = None # type: ignore
+profiler = SamplingProfiler(files=("rag.py", "sharding.py", "ingest.py"))
+# 已打开的分片集合，只读副本重新加载存储或分片被迁移时移除
+sharded: dict = {}
+sharded_lock = threading.Lock()
+ready = threading.Event()
 
+# 多进程模式下由 cluster.serve 通过环境变量指定角色：writer 负责所有修改，reader 只处理读请求
+role = os.environ.get("RAG_ROLE", "")
 store_path_abs = os.path.join(cwd, config.store_path)
-os.makedirs(store_path_abs, exist_ok=True)
+replica_state = ReplicaState(store_path_abs, max_staleness=config.max_staleness)
+# 只读副本不删除文件，孤立段目录由写进程（或单进程模式）回收
+# 副本在发现孤立目录之后重新打开存储前，目录可能仍被引用，不回收
+reclaimer = SegmentReclaimer(store_path_abs, interval=config.reclaim_interval, replicas=replica_state.replicas)
+# 处理函数在线程池中执行，准入控制决定每类请求同时占用多少线程
+admission = AdmissionController(config.admission_workers, [
+    Lane(name, lane.workers, lane.queue, lane.max_wait) for name, lane in (
+        (INTERACTIVE, config.admission_interactive),
+        (INGEST, config.admission_ingest),
+        (MAINTENANCE, config.admission_maintenance))])
+# 只读副本重新加载存储前等待正在处理的请求结束
+reader_gate = {"active": 0, "idle": None, "lock": None}
 
-try:
-    rag = RAG(store_path=store_path_abs, embedding_function=embedding_function, chroma_executable_path=config.chroma_executable_path)
-except Exception as e:
-     print(f"Error initializing RAG with store_path='{store_path_abs}': {e}")
-     sys.exit(1)
+def build_embedding_function(model: str = ""):
+    """
+    按配置创建嵌入函数，model为空时使用config中的embedding_model。
+    """
+    from chromadb.utils.embedding_functions.openai_embedding_function import OpenAIEmbeddingFunction
+    from embedding import BatchingEmbeddingFunction, EmbeddingEndpoint, EmbeddingPool
+    endpoints = config.embedding_endpoints or [
+        EmbeddingEndpointConfig(url=config.embedding_url, api_key=config.embedding_api_key)]
+    pool = EmbeddingPool([
+        EmbeddingEndpoint(
+            OpenAIEmbeddingFunction(
+                api_key=endpoint.api_key,
+                api_base=endpoint.url,
+                model_name=model or endpoint.model or config.embedding_model
+            ),
+            name=endpoint.url,
+            weight=endpoint.weight,
+            rate_limit=endpoint.rate_limit
+        ) for endpoint in endpoints])
+    return BatchingEmbeddingFunction(
+                    pool,
+                    max_batch_tokens=config.embedding_max_batch_tokens,
+                    max_batch_items=config.embedding_max_batch_items,
+                    max_input_tokens=config.embedding_max_input_tokens,
+                    overflow=config.embedding_overflow
+                )
+
+def init_rag():
+    global embedding_function, embedding_pool, rag, collection_stats
+    try:
+        embedding_function = build_embedding_function()
+        embedding_pool = embedding_function.embedding_function
+    except Exception as e:
+        print(f"Error initializing OpenAIEmbeddingFunction: {e}")
+        raise
+
+    os.makedirs(store_path_abs, exist_ok=True)
+
+    try:
+        rag = RAG(store_path=store_path_abs, embedding_function=embedding_function, chroma_executable_path=config.chroma_executable_path,
+                  embedding_function_factory=build_embedding_function)
+        rag.client
+    except Exception as e:
+        print(f"Error initializing RAG with store_path='{store_path_abs}': {e}")
+        raise
+    collection_stats = CollectionStats(store_path_abs, ttl=config.stats_ttl)
+
+def prewarm():
+    try:
+        warmed = rag.warm_up()
+        logging.info(f"prewarmed collections: {warmed}")
+    except Exception as e:
+        logging.warning(f"prewarm failed: {e}")
+    ready.set()
+
+def start_ingest():
+    global ingest_queue
+    from ingest import IngestQueue
+    # 写入在后台完成，完成后再通知只读副本
+    ingest_queue = IngestQueue(rag, os.path.join(store_path_abs, ".ingest"), batch_size=config.ingest_batch_size,
+                               max_pending=config.ingest_max_pending, on_flush=publish_state)
+    ingest_queue.start()
+
+@asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    await asyncio.to_thread(init_rag)
+    refresher = None
+    if role == "reader":
+        replica_state.acknowledge()
+        refresher = asyncio.create_task(refresh_replica_periodically())
+    if config.prewarm:
+        threading.Thread(target=prewarm, daemon=True).start()
+    else:
+        ready.set()
+    if role != "reader":
+        reclaimer.start()
+        if config.async_ingest:
+            start_ingest()
+    yield
+    if refresher is not None:
+        refresher.cancel()
+    if role == "reader":
+        replica_state.leave()
+    reclaimer.stop()
+    if ingest_queue is not None:
+        ingest_queue.stop()
+
+app = fastapi.FastAPI(lifespan=lifespan)
+
+def is_mutation(method: str, path: str) -> bool:
+    return (path.startswith("/rag/") and not is_read_path(path) and method == "POST") \
+        or path.startswith(("/rag/delete_collection/", "/rag/change_collection/")) \
+        or (path.startswith("/rag/sharded/") and path.endswith("/drop"))
+
+async def refresh_replica():
+    # 只读副本在存储变化时重新加载，新到的请求同样在此等待，正在处理的请求结束后才重新加载
+    if reader_gate["idle"] is None:
+        reader_gate["idle"] = asyncio.Event()
+        reader_gate["idle"].set()
+        reader_gate["lock"] = asyncio.Lock()
+    if replica_state.changed():
+        async with reader_gate["lock"]:
+            await reader_gate["idle"].wait()
+            if replica_state.sync(rag):
+                evict_sharded()
+
+async def refresh_replica_periodically():
+    # 空闲的副本没有请求触发重新加载，同样需要定期确认，否则写进程无法回收已删除集合的段目录
+    while True:
+        await asyncio.sleep(max(replica_state.max_staleness, 1.0))
+        try:
+            await refresh_replica()
+        except Exception as e:
+            logging.warning(f"replica refresh failed: {e}")
 
-app = fastapi.FastAPI()
+class ReplicationMiddleware:
+    """
+    只读副本拒绝修改请求，存储变化时等正在处理的请求结束后重新加载；写入进程在修改成功后通知副本。
+    直接包裹ASGI应用，流式响应发送完毕、出错或客户端提前断开时都会结束计数。
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        path = scope["path"]
+        if role == "reader":
+            if not is_read_path(path) and path not in FANOUT_PATHS and path not in ("/healthz", "/readyz"):
+                response = JSONResponse(status_code=403, content={"detail": "read replica only serves queries"})
+                return await response(scope, receive, send)
+            await refresh_replica()
+            reader_gate["active"] += 1
+            reader_gate["idle"].clear()
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                reader_gate["active"] -= 1
+                if reader_gate["active"] == 0:
+                    reader_gate["idle"].set()
+            return
+        status = {"code": 500}
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+        await self.app(scope, receive, send_status)
+        if is_mutation(scope["method"], path) and status["code"] < 400:
+            publish_state()
+
+class AdmissionMiddleware:
+    """
+    按请求类别排队，被拒绝的请求不会进入副本同步和处理函数。
+    名额在内层应用返回后释放，不依赖响应体被完整读取。
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        lane = classify(scope["path"]) if scope["type"] == "http" else None
+        if lane is None:
+            return await self.app(scope, receive, send)
+        try:
+            waited = await admission.acquire(lane)
+        except Rejected as e:
+            response = JSONResponse(status_code=e.status_code, content={"detail": e.detail},
+                                    headers={"Retry-After": str(int(e.retry_after + 0.999))})
+            return await response(scope, receive, send)
+        start = time.monotonic()
+        async def send_with_wait(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append("X-Queue-Wait-Ms", f"{waited:.1f}")
+            await send(message)
+        completed = False
+        try:
+            await self.app(scope, receive, send_with_wait)
+            completed = True
+        finally:
+            # 出错或断开时不计入处理耗时，避免拉低估算的等待时间
+            admission.release(lane, (time.monotonic() - start) * 1000 if completed else None)
+
+# 后添加的中间件在外层，先排队再进入副本同步
+app.add_middleware(ReplicationMiddleware)
+app.add_middleware(AdmissionMiddleware)
+
+@app.get("/healthz")
+async def healthz():
+    return JSONResponse(content={"status": "ok"})
+
+@app.get("/readyz")
+async def readyz():
+    if rag is None or not ready.is_set():
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    return JSONResponse(content={"status": "ready"})
 
 class create_collection_data(BaseModel):
     metadata : dict = {}
 
 @app.post("/rag/create_collection/{name}")
-async def create_database(name: str, data: create_collection_data):
+def create_database(name: str, data: create_collection_data):
     rag.create_collection(name, embedding_function=embedding_function, metadata=data.metadata)
     return JSONResponse(content={"message": f"Collection {name} created"})
 
 @app.get("/rag/delete_collection/{name}")
-async def delete_database(name: str):
+def delete_database(name: str):
     rag.delete_collection(name)
+    reclaimer.notify()
     return JSONResponse(content={"message": f"Collection {name} deleted"})
 
 @app.get("/rag/change_collection/{name}")
-async def change_database(name: str):
+def change_database(name: str):
     rag.change_collection(name)
     return JSONResponse(content={"message": f"changed to Collection {name}"})
 
 @app.get("/rag/list_collections")
-async def list_collections():
+def list_collections():
+    from chromadb import Collection
     collections = rag.client.list_collections()
     if collections and isinstance(collections[0],Collection):
-        collection_names = [c.name for c in collections]
+        collection_names = [c.name for c in collections if not is_internal(c)]
         return JSONResponse(content={"collections": collection_names})
 
+def decode_vectors(data: list[str]) -> list[list[float]]:
+    from embedding import decode_vector
+    try:
+        return [decode_vector(item) for item in data]
+    except ValueError as e:
+        raise fastapi.HTTPException(status_code=400, detail=f"invalid embedding: {e}")
+
+def enqueue(items: list[dict]):
+    from ingest import QueueFull
+    if getattr(rag, "collection", None) is None:
+        raise fastapi.HTTPException(status_code=400, detail="no collection selected")
+    vectors = [item["embedding"] for item in items if item.get("embedding")]
+    try:
+        if vectors:
+            rag.validate_embeddings(decode_vectors(vectors))
+        ticket = ingest_queue.enqueue(rag.collection.name, items) # type: ignore
+    except QueueFull as e:
+        raise fastapi.HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(int(e.retry_after + 0.999))})
+    except ValueError as e:
+        raise fastapi.HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(status_code=202, content={"message": "queued", "ticket": ticket["ticket"], "ids": ticket["ids"]})
+
 class store_data(BaseModel):
     text: str
     metadata: dict[str, str] = {}
+    # Base64编码的小端float32向量，提供时不调用嵌入接口
+    embedding: str | None = None
 @app.post("/rag/store")
-async def store(data: store_data):
-    if data.metadata:
-        rag.store(text=data.text, metadata=data.metadata)
-    else:
-        rag.store(text=data.text)
-    return JSONResponse(content={"message": "stored"})
+def store(data: store_data):
+    if ingest_queue is not None:
+        return enqueue([data.model_dump(exclude_none=True)])
+    embeddings = decode_vectors([data.embedding]) if data.embedding else None
+    try:
+        ids = rag.store(text=data.text, metadata=data.metadata or None, embeddings=embeddings)
+    except ValueError as e:
+        raise fastapi.HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(content={"message": "stored", "id": ids[0]})
+
+class batch_store_item(BaseModel):
+    text: str
+    metadata: dict | None = None
+    embedding: str | None = None
+class batch_store_data(BaseModel):
+    items: list[batch_store_item]
+@app.post("/rag/batch_store")
+def batch_store(data: batch_store_data):
+    if not data.items:
+        raise fastapi.HTTPException(status_code=400, detail="items is empty")
+    if ingest_queue is not None:
+        return enqueue([item.model_dump(exclude_none=True) for item in data.items])
+    with_embedding = [item.embedding is not None for item in data.items]
+    if any(with_embedding) and not all(with_embedding):
+        raise fastapi.HTTPException(status_code=400, detail="either all or none of the items should have an embedding")
+    metadatas = [item.metadata for item in data.items]
+    if any(metadatas) and not all(metadatas):
+        raise fastapi.HTTPException(status_code=400, detail="either all or none of the items should have metadata")
+    embeddings = decode_vectors([item.embedding for item in data.items]) if all(with_embedding) else None # type: ignore
+    try:
+        ids = rag.store(text=[item.text for item in data.items], metadata=metadatas if all(metadatas) else None,
+                        embeddings=embeddings)
+    except ValueError as e:
+        raise fastapi.HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(content={"message": "stored", "ids": ids})
 
 class query_data(BaseModel):
     query_text: str
     top_k: int
     similarity:float=0.5
 @app.post("/rag/query")
-async def query(data: query_data):
+def query(data: query_data):
     result = rag.query(data.query_text, top_k=data.top_k,similarity_value=data.similarity)
     return JSONResponse(content=result)
 
+class query_by_vector_data(BaseModel):
+    embedding: str
+    top_k: int = 1
+    similarity: float = 0.5
+@app.post("/rag/query_by_vector")
+def query_by_vector(data: query_by_vector_data):
+    embedding = decode_vectors([data.embedding])[0]
+    try:
+        result = rag.query_by_vector(embedding, top_k=data.top_k, similarity_value=data.similarity)
+    except ValueError as e:
+        raise fastapi.HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(content=result)
+
+class query_by_id_data(BaseModel):
+    id: str
+    top_k: int = 1
+    similarity: float = 0.5
+    include_self: bool = False
+@app.post("/rag/query_by_id")
+def query_by_id(data: query_by_id_data):
+    try:
+        result = rag.query_by_id(data.id, top_k=data.top_k, similarity_value=data.similarity,
+                                 include_self=data.include_self)
+    except ValueError as e:
+        raise fastapi.HTTPException(status_code=404, detail=str(e))
+    return JSONResponse(content=result)
+
+class range_query_data(BaseModel):
+    query_text: str
+    similarity: float = 80
+    initial_k: int = 10
+    max_k: int = 1000
+@app.post("/rag/range_query")
+def range_query(data: range_query_data):
+    if getattr(rag, "collection", None) is None:
+        raise fastapi.HTTPException(status_code=400, detail="no collection selected")
+    results = rag.range_query(data.query_text, similarity_value=data.similarity,
+                              initial_k=data.initial_k, max_k=data.max_k)
+    # 生成器是惰性的，先在返回响应头之前算出第一个结果，参数或查询出错时仍能返回错误状态码
+    try:
+        first = next(results, None)
+    except ValueError as e:
+        raise fastapi.HTTPException(status_code=400, detail=str(e))
+    def lines():
+        if first is None:
+            return
+        yield json.dumps(first, ensure_ascii=False) + "\n"
+        # 每行一个结果，客户端可以边接收边处理
+        for result in results:
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
 class update_data(BaseModel):
     id: str
     text: str
     metadata: dict
 @app.post("/rag/update")
-async def update(data: update_data):
+def update(data: update_data):
     rag.update(id=data.id, text=data.text, metadata=data.metadata)
     return JSONResponse(content={"message": "updated"})
 
 class delete_data(BaseModel):
     id: str
 @app.post("/rag/delete")
-async def delete(data: delete_data):
+def delete(data: delete_data):
     rag.delete(data.id)
     return JSONResponse(content={"message": "deleted"})
 
+class batch_update_item(BaseModel):
+    id: str
+    text: str | None = None
+    metadata: dict | None = None
+class batch_update_data(BaseModel):
+    items: list[batch_update_item]
+@app.post("/rag/batch_update")
+def batch_update(data: batch_update_data):
+    result = rag.batch_update([item.model_dump(exclude_none=True) for item in data.items])
+    return JSONResponse(content=result)
+
+class batch_delete_data(BaseModel):
+    ids: list[str] = []
+    where: dict = {}
+@app.post("/rag/batch_delete")
+def batch_delete(data: batch_delete_data):
+    if not data.ids and not data.where:
+        raise fastapi.HTTPException(status_code=400, detail="ids or where is required")
+    deleted = rag.delete_by(ids=data.ids or None, where=data.where or None)
+    return JSONResponse(content={"deleted": deleted})
+
 @app.get("/rag/get_data")
-async def get_data():
+def get_data():
     result = rag.get_data()
     return JSONResponse(content={"data": result})
 
 class release_disk_data(BaseModel):
     path:str
 @app.post("/rag/release_disk")
-async def release_disk(data:release_disk_data):
+def release_disk(data:release_disk_data):
     rag.release_disk(data.path)
     return JSONResponse(content={"message": f"collection {data.path} disk released"})
 
+class tune_data(BaseModel):
+    collection: str = ""
+    k: int = 10
+    sample_size: int = 100
+    search_ef: list[int] = [10, 20, 40, 80, 160, 320]
+    m: list[int] = [16, 32]
+    construction_ef: list[int] = [100, 200]
+    target_recall: float = 0.95
+    apply: bool = False
+@app.post("/rag/tune")
+def tune(data: tune_data):
+    from tuning import tune_collection
+    if data.collection:
+        if not rag.check_collection(data.collection):
+            raise fastapi.HTTPException(status_code=404, detail=f"collection {data.collection} not found")
+        collection = rag.client.get_collection(data.collection)
+    elif getattr(rag, "collection", None) is None:
+        raise fastapi.HTTPException(status_code=400, detail="no collection selected")
+    else:
+        collection = rag.collection
+    report = tune_collection(collection, k=data.k, sample_size=data.sample_size,
+                             search_ef_values=data.search_ef, m_values=data.m,
+                             construction_ef_values=data.construction_ef,
+                             target_recall=data.target_recall, apply=data.apply)
+    # 写回参数失败时仍返回扫描结果，状态码提示调用方未生效
+    return JSONResponse(status_code=409 if report.get("apply_error") else 200, content=report)
+
+migrations: dict = {}
+
+def publish_state():
+    if role == "writer":
+        current = getattr(rag, "collection", None)
+        replica_state.publish(current.name if current is not None else None)
+
+class migrate_data(BaseModel):
+    collection: str
+    model: str
+    batch_size: int = 64
+    max_rate: float = 0.0
+@app.post("/rag/migrate")
+def migrate(data: migrate_data):
+    from migration import MigrationJob
+    if not rag.check_collection(data.collection):
+        raise fastapi.HTTPException(status_code=404, detail=f"collection {data.collection} not found")
+    running = migrations.get(data.collection)
+    if running and running.state == "running":
+        raise fastapi.HTTPException(status_code=409, detail=f"collection {data.collection} is already migrating")
+    def on_complete():
+        # 迁移替换了物理集合，缓存中包含它的分片集合持有的集合对象已经失效
+        evict_sharded(data.collection)
+        publish_state()
+    job = MigrationJob(rag, data.collection, data.model, build_embedding_function(data.model),
+                       os.path.join(store_path_abs, ".migrations"), batch_size=data.batch_size,
+                       max_rate=data.max_rate, on_complete=on_complete)
+    migrations[data.collection] = job
+    job.start()
+    return JSONResponse(content=job.status())
+
+@app.get("/rag/migrations")
+async def list_migrations():
+    return JSONResponse(content={"migrations": [job.status() for job in migrations.values()]})
+
+@app.get("/rag/migrations/{name}")
+async def migration_status(name: str):
+    if name not in migrations:
+        raise fastapi.HTTPException(status_code=404, detail=f"no migration for collection {name}")
+    return JSONResponse(content=migrations[name].status())
+
+@app.post("/rag/migrations/{name}/stop")
+async def stop_migration(name: str):
+    if name not in migrations:
+        raise fastapi.HTTPException(status_code=404, detail=f"no migration for collection {name}")
+    migrations[name].stop()
+    return JSONResponse(content={"message": f"migration of {name} stopping"})
+
+def get_sharded(name: str):
+    from sharding import ShardedCollection
+    with sharded_lock:
+        if name not in sharded:
+            try:
+                sharded[name] = ShardedCollection.open(rag, name)
+            except ValueError as e:
+                raise fastapi.HTTPException(status_code=404, detail=str(e))
+        return sharded[name]
+
+def evict_sharded(collection_name: str = ""):
+    """
+    移除缓存的分片集合并关闭其线程池，collection_name不为空时只移除包含该物理集合的分片集合。
+    """
+    with sharded_lock:
+        names = [name for name, collection in sharded.items()
+                 if not collection_name or any(shard.name == collection_name for shard in collection.collections)]
+        evicted = [sharded.pop(name) for name in names]
+    for collection in evicted:
+        collection.close()
+
+class create_sharded_data(BaseModel):
+    shards: int
+    metadata: dict = {}
+@app.post("/rag/sharded/create/{name}")
+def create_sharded(name: str, data: create_sharded_data):
+    from sharding import ShardedCollection
+    try:
+        collection = ShardedCollection.create(rag, name, data.shards, metadata=data.metadata)
+    except ValueError as e:
+        raise fastapi.HTTPException(status_code=400, detail=str(e))
+    with sharded_lock:
+        previous = sharded.pop(name, None)
+        sharded[name] = collection
+    if previous is not None:
+        previous.close()
+    return JSONResponse(content={"message": f"Sharded collection {name} created with {data.shards} shards"})
+
+@app.post("/rag/sharded/{name}/store")
+def sharded_store(name: str, data: batch_store_data):
+    collection = get_sharded(name)
+    if not data.items:
+        raise fastapi.HTTPException(status_code=400, detail="items is empty")
+    with_embedding = [item.embedding is not None for item in data.items]
+    if any(with_embedding) and not all(with_embedding):
+        raise fastapi.HTTPException(status_code=400, detail="either all or none of the items should have an embedding")
+    metadatas = [item.metadata for item in data.items]
+    if any(metadatas) and not all(metadatas):
+        raise fastapi.HTTPException(status_code=400, detail="either all or none of the items should have metadata")
+    embeddings = decode_vectors([item.embedding for item in data.items]) if all(with_embedding) else None # type: ignore
+    try:
+        ids = collection.store([item.text for item in data.items], metadata=metadatas if all(metadatas) else None, # type: ignore
+                               embeddings=embeddings)
+    except ValueError as e:
+        raise fastapi.HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(content={"message": "stored", "ids": ids})
+
+class sharded_query_data(BaseModel):
+    query_text: str
+    top_k: int = 1
+    similarity: float = 0.5
+    where: dict = {}
+@app.post("/rag/sharded/{name}/query")
+def sharded_query(name: str, data: sharded_query_data):
+    result = get_sharded(name).query(data.query_text, top_k=data.top_k, similarity_value=data.similarity,
+                                     where=data.where or None)
+    return JSONResponse(content=result)
+
+@app.post("/rag/sharded/{name}/delete")
+def sharded_delete(name: str, data: batch_delete_data):
+    if not data.ids:
+        raise fastapi.HTTPException(status_code=400, detail="ids is required")
+    get_sharded(name).delete(data.ids)
+    return JSONResponse(content={"message": "deleted"})
+
+@app.get("/rag/sharded/{name}/drop")
+def drop_sharded(name: str):
+    get_sharded(name).drop()
+    with sharded_lock:
+        sharded.pop(name, None)
+    reclaimer.notify()
+    return JSONResponse(content={"message": f"Sharded collection {name} deleted"})
+
+class multi_query_data(BaseModel):
+    collections: list[str]
+    query_text: str
+    top_k: int = 1
+    similarity: float = 0.5
+    where: dict = {}
+@app.post("/rag/multi_query")
+def multi_query(data: multi_query_data):
+    from sharding import query_collections
+    if not data.collections:
+        raise fastapi.HTTPException(status_code=400, detail="collections is empty")
+    # 按名称取集合和嵌入函数，持有共享锁避免迁移在两者之间切换
+    with rag.switch_lock.shared():
+        collections = []
+        for name in data.collections:
+            if not rag.check_collection(name):
+                raise fastapi.HTTPException(status_code=404, detail=f"collection {name} not found")
+            collections.append(rag.client.get_collection(name, embedding_function=rag.collection_embedding_function(name)))
+        result = query_collections(rag, collections, data.query_text, top_k=data.top_k,
+                                   similarity_value=data.similarity, where=data.where or None)
+    return JSONResponse(content=result)
+
+@app.get("/rag/stats")
+def stats(refresh: bool = False):
+    return JSONResponse(content=collection_stats.get(refresh=refresh))
+
+def require_admin(request: fastapi.Request):
+    token = request.headers.get("X-Admin-Token", "")
+    # 请求头可能含有非ASCII字符，compare_digest只接受ASCII字符串，统一按字节比较
+    if not config.admin_token or not secrets.compare_digest(token.encode("utf-8"), config.admin_token.encode("utf-8")):
+        raise fastapi.HTTPException(status_code=403, detail="admin token required")
+
+class profile_data(BaseModel):
+    duration: float = 10.0
+    interval: float = 0.005
+@app.post("/rag/admin/profile/start")
+async def start_profile(data: profile_data, request: fastapi.Request):
+    require_admin(request)
+    if not 0 < data.duration <= 300 or not 0.001 <= data.interval <= 1:
+        raise fastapi.HTTPException(status_code=400, detail="duration should be in (0, 300] and interval in [0.001, 1]")
+    try:
+        profiler.start(duration=data.duration, interval=data.interval)
+    except ValueError as e:
+        raise fastapi.HTTPException(status_code=409, detail=str(e))
+    return JSONResponse(content=profiler.status())
+
+@app.post("/rag/admin/profile/stop")
+async def stop_profile(request: fastapi.Request):
+    require_admin(request)
+    await asyncio.to_thread(profiler.stop)
+    return JSONResponse(content=profiler.status())
+
+@app.get("/rag/admin/profile")
+async def profile_status(request: fastapi.Request):
+    require_admin(request)
+    return JSONResponse(content=profiler.status())
+
+@app.get("/rag/admin/profile/flamegraph")
+async def profile_flamegraph(request: fastapi.Request):
+    # 折叠栈格式，可直接交给 flamegraph.pl 或 speedscope
+    require_admin(request)
+    return PlainTextResponse(profiler.collapsed())
+
+@app.get("/rag/admission")
+async def admission_stats():
+    return JSONResponse(content=admission.stats())
+
+@app.get("/rag/ingest")
+async def ingest_stats():
+    if ingest_queue is None:
+        raise fastapi.HTTPException(status_code=404, detail="async ingest is disabled")
+    return JSONResponse(content=ingest_queue.stats())
+
+@app.get("/rag/ingest/{ticket}")
+async def ingest_status(ticket: str):
+    if ingest_queue is None:
+        raise fastapi.HTTPException(status_code=404, detail="async ingest is disabled")
+    status = ingest_queue.status(ticket)
+    if status is None:
+        raise fastapi.HTTPException(status_code=404, detail=f"ticket {ticket} not found")
+    return JSONResponse(content=status)
+
+@app.get("/rag/disk")
+async def disk_stats():
+    return JSONResponse(content=reclaimer.stats())
+
+@app.post("/rag/reclaim")
+async def reclaim():
+    reclaimer.notify()
+    return JSONResponse(content={"message": "reclamation scheduled", **reclaimer.stats()})
+
+@app.get("/rag/embedding_stats")
+async def embedding_stats():
+    return JSONResponse(content={"endpoints": embedding_pool.stats()}) # type: ignore
+
 @app.get("/")
 async def serve_frontend():
     """
@@ -152,5 +777,8 @@ async def serve_frontend():
 if __name__ == "__main__":
     print(f"Starting server on http://127.0.0.1:{config.server_port}")
     print(f"Frontend should be accessible at http://127.0.0.1:{config.server_port}/")
-    uvicorn.run(app, host="127.0.0.1", port=config.server_port)
+    if config.workers > 0:
+        serve(cwd, "127.0.0.1", config.server_port, config.workers, store_path=store_path_abs)
+    else:
+        uvicorn.run(app, host="127.0.0.1", port=config.server_port)
 
@@ -0,0 +1,256 @@
+import re
+import time
+import heapq
+import hashlib
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+
+_SHARD_NAME = re.compile(r"^(?P<name>.+)_shard_(?P<index>\d+)$")
+
+
+def shard_of(doc_id: str, shards: int) -> int:
+    # 用稳定的哈希分区，不同进程和重启之间结果一致（内置hash会随进程变化）
+    return int.from_bytes(hashlib.blake2b(doc_id.encode("utf-8"), digest_size=8).digest(), "big") % shards
+
+
+def query_collections(rag,
+                      collections: list,
+                      query_text: str,
+                      top_k: int = 1,
+                      similarity_value: float = 0.5,
+                      executor: Optional[ThreadPoolExecutor] = None,
+                      where: Optional[dict[str, Any]] = None) -> dict[str, Any]:
+    """
+    并发查询多个集合，按相似度合并出全局前top_k个结果。
+    使用同一嵌入函数的集合共用一次查询文本的嵌入；不同集合的距离空间可能不同，统一换算成相似度后再合并。
+
+    :param rag: RAG实例
+    :param collections: chromadb集合列表
+    :param query_text: 查询文本
+    :param top_k: 返回的结果数量
+    :param similarity_value: 相似度下限（百分比）
+    :param executor: 执行查询的线程池，不传时临时创建
+    :param where: metadata过滤条件
+    :return: 合并后的结果和每个集合的耗时
+    """
+    started = time.perf_counter()
+    vectors: dict[int, list[float]] = {}
+    embed_ms = {}
+    functions = [rag.model_embedding_function((collection.metadata or {}).get("embedding_model"))
+                 for collection in collections]
+    for function in functions:
+        if id(function) not in vectors:
+            start = time.perf_counter()
+            vectors[id(function)] = [float(value) for value in function([query_text])[0]]
+            embed_ms[id(function)] = round((time.perf_counter() - start) * 1000, 2)
+
+    def search(collection, function):
+        start = time.perf_counter()
+        kwargs: dict[str, Any] = {"query_embeddings": [vectors[id(function)]],
+                                  "n_results": top_k}
+        if where:
+            kwargs["where"] = where
+        results = collection.query(**kwargs)
+        space = (collection.metadata or {}).get("hnsw:space", "l2")
+        hits = []
+        for i in range(len(results["ids"][0])):
+            similarity = rag.similarity(results["distances"][0][i], space) # type: ignore
+            if similarity < similarity_value:
+                continue
+            hits.append((similarity, {
+                "document": results["documents"][0][i], # type: ignore
+                "metadata": results["metadatas"][0][i], # type: ignore
+                "id": results["ids"][0][i],
+                "collection": collection.name,
+            }))
+        return hits, round((time.perf_counter() - start) * 1000, 2)
+
+    own_executor = executor is None
+    executor = executor or ThreadPoolExecutor(max_workers=min(len(collections), 32) or 1)
+    try:
+        outcomes = list(executor.map(search, collections, functions))
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False)
+    # 每个集合的结果已按相似度排序，堆合并后取前top_k
+    merged = heapq.merge(*[hits for hits, _ in outcomes], key=lambda hit: -hit[0])
+    results = []
+    for similarity, hit in merged:
+        if len(results) >= top_k:
+            break
+        hit["similarity"] = format(similarity, ".2f") + "%"
+        results.append(hit)
+    return {
+        "results": results,
+        "timings": {
+            "embedding_ms": round(sum(embed_ms.values()), 2),
+            "shards": [{"collection": collection.name, "ms": ms, "results": len(hits)}
+                       for collection, (hits, ms) in zip(collections, outcomes)],
+            "total_ms": round((time.perf_counter() - started) * 1000, 2),
+        },
+    }
+
+
+class ShardedCollection:
+    """
+    逻辑集合：按文档ID的哈希把文档分布到N个物理集合 {name}_shard_{i}，
+    写入时只嵌入一次再分发，查询时并发查询所有分片并合并全局前k个结果。
+
+    :param rag: RAG实例
+    :param name: 逻辑集合名称
+    :param collections: 按分片序号排列的物理集合
+    """
+    def __init__(self, rag, name: str, collections: list):
+        if not collections:
+            raise ValueError(f"sharded collection {name} has no shards")
+        self.rag = rag
+        self.name = name
+        self.collections = collections
+        self.executor = ThreadPoolExecutor(max_workers=min(len(collections), 32))
+        # 各分片的向量维度，首次写入时检查并记录
+        self.dimension: Optional[int] = None
+        self.validated = False
+
+    @staticmethod
+    def shard_name(name: str, index: int) -> str:
+        return f"{name}_shard_{index}"
+
+    @classmethod
+    def create(cls, rag, name: str, shards: int, metadata: dict = {}) -> "ShardedCollection":
+        """
+        创建分片集合。
+
+        :param rag: RAG实例
+        :param name: 逻辑集合名称
+        :param shards: 分片数量
+        :param metadata: 每个分片集合的metadata，例如hnsw参数
+        :return: 分片集合
+        """
+        if shards < 1:
+            raise ValueError("shards should be at least 1")
+        if len(cls.shard_name(name, shards - 1)) > 64:
+            raise ValueError("sharded collection name is too long")
+        if cls.list_shards(rag, name):
+            raise ValueError(f"sharded collection {name} already exists")
+        collections = []
+        for index in range(shards):
+            shard_metadata = {**metadata, "sharded_from": name, "shard_index": index, "shard_count": shards}
+            collections.append(rag.create_collection(cls.shard_name(name, index), embedding_function=rag.embedding_function,
+                                                     metadata=shard_metadata))
+        return cls(rag, name, collections)
+
+    @classmethod
+    def list_shards(cls, rag, name: str) -> list[str]:
+        names = []
+        for collection in rag.client.list_collections():
+            collection_name = collection if isinstance(collection, str) else collection.name
+            match = _SHARD_NAME.match(collection_name)
+            if match and match.group("name") == name:
+                names.append(collection_name)
+        return sorted(names, key=lambda shard: int(_SHARD_NAME.match(shard).group("index"))) # type: ignore
+
+    @classmethod
+    def open(cls, rag, name: str) -> "ShardedCollection":
+        names = cls.list_shards(rag, name)
+        if not names:
+            raise ValueError(f"sharded collection {name} not found")
+        collections = [rag.client.get_collection(shard, embedding_function=rag.collection_embedding_function(shard))
+                       for shard in names]
+        expected = (collections[0].metadata or {}).get("shard_count", len(collections))
+        if len(collections) != expected:
+            raise ValueError(f"sharded collection {name} has {len(collections)} of {expected} shards")
+        return cls(rag, name, collections)
+
+    def validate(self) -> None:
+        """
+        检查各分片使用相同的嵌入模型和向量维度，并记录维度。
+        分片之间不一致时查询会在合并结果时才失败，因此在写入前检查。
+        """
+        models = {(collection.metadata or {}).get("embedding_model") for collection in self.collections} - {None}
+        if len(models) > 1:
+            raise ValueError(f"shards of {self.name} use different embedding models {sorted(models)}")
+        dimensions = {self.rag.dimension(collection) for collection in self.collections} - {None}
+        if len(dimensions) > 1:
+            raise ValueError(f"shards of {self.name} have different dimensions {sorted(dimensions)}")
+        self.dimension = dimensions.pop() if dimensions else None
+        self.validated = True
+
+    def store(self,
+              text: list[str],
+              metadata: Optional[list[dict[str, Any]]] = None,
+              embeddings: Optional[list[list[float]]] = None) -> list[str]:
+        """
+        写入文档。未提供向量时整批只调用一次嵌入函数，再按ID分发到各分片并发写入。
+
+        :return: 文档ID列表
+        """
+        if metadata is not None and len(metadata) != len(text):
+            raise ValueError("metadata should have the same length as text")
+        ids = [str(uuid4()) for _ in text]
+        if embeddings is None:
+            function = self.rag.model_embedding_function((self.collections[0].metadata or {}).get("embedding_model"))
+            embeddings = [[float(value) for value in vector] for vector in function(text)]
+        elif len(embeddings) != len(text):
+            raise ValueError("embeddings should have the same length as text")
+        dimensions = {len(vector) for vector in embeddings}
+        if len(dimensions) > 1:
+            raise ValueError(f"embeddings have different dimensions {sorted(dimensions)}")
+        dimension = dimensions.pop() if dimensions else None
+        groups: dict[int, list[int]] = {}
+        for position, doc_id in enumerate(ids):
+            groups.setdefault(shard_of(doc_id, len(self.collections)), []).append(position)
+        size = self.rag.client.get_max_batch_size()
+
+        def write(item):
+            index, positions = item
+            collection = self.collections[index]
+            mirror = self.rag.mirrors.get(collection.name)
+            for start in range(0, len(positions), size):
+                chunk = positions[start:start+size]
+                kwargs: dict[str, Any] = {"ids": [ids[i] for i in chunk], "documents": [text[i] for i in chunk]}
+                if metadata:
+                    kwargs["metadatas"] = [metadata[i] for i in chunk]
+                collection.add(embeddings=[embeddings[i] for i in chunk], **kwargs) # type: ignore
+                if mirror is not None:
+                    mirror.add(**kwargs)
+
+        with self.rag.write_lock:
+            if not self.validated:
+                self.validate()
+            if self.dimension is not None and dimension is not None and dimension != self.dimension:
+                raise ValueError(f"embedding dimension {dimension} does not match sharded collection dimension {self.dimension}")
+            list(self.executor.map(write, groups.items()))
+            self.dimension = self.dimension or dimension
+        return ids
+
+    def delete(self, ids: list[str]) -> None:
+        groups: dict[int, list[str]] = {}
+        for doc_id in ids:
+            groups.setdefault(shard_of(doc_id, len(self.collections)), []).append(doc_id)
+        with self.rag.write_lock:
+            for index, shard_ids in groups.items():
+                self.collections[index].delete(ids=shard_ids)
+                mirror = self.rag.mirrors.get(self.collections[index].name)
+                if mirror is not None:
+                    mirror.delete(ids=shard_ids)
+
+    def count(self) -> int:
+        return sum(collection.count() for collection in self.collections)
+
+    def query(self, query_text: str, top_k: int = 1, similarity_value: float = 0.5,
+              where: Optional[dict[str, Any]] = None) -> dict[str, Any]:
+        return query_collections(self.rag, self.collections, query_text, top_k, similarity_value,
+                                 executor=self.executor, where=where)
+
+    def drop(self) -> None:
+        with self.rag.write_lock:
+            for collection in self.collections:
+                self.rag.client.delete_collection(collection.name)
+        self.close()
+
+    def close(self) -> None:
+        """
+        关闭查询和写入用的线程池，不再使用时调用。
+        """
+        self.executor.shutdown(wait=False)
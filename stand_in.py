@@ -0,0 +1,220 @@
+import json
+import time
+import base64
+import random
+import struct
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Any, Optional
+
+
+def fake_vector(text: str, dimension: int = 8) -> list[float]:
+    """
+    由文本哈希生成的确定性单位向量，相同文本总是得到相同的向量。
+    """
+    digest = b""
+    counter = 0
+    while len(digest) < dimension * 4:
+        digest += hashlib.blake2b(f"{counter}:{text}".encode("utf-8")).digest()
+        counter += 1
+    values = [value / 2**31 - 1 for value in struct.unpack(f"<{dimension}I", digest[:dimension * 4])]
+    norm = sum(value * value for value in values) ** 0.5 or 1.0
+    return [value / norm for value in values]
+
+
+class FakeEmbeddingFunction:
+    """
+    进程内的替身嵌入函数，可以模拟延迟、随机失败和单批上限，用于在不连接真实服务的情况下测试 EmbeddingPool 和批处理。
+
+    :param dimension: 向量维度
+    :param latency: 每次调用的延迟（秒）
+    :param error_rate: 随机失败的概率
+    :param max_batch: 单批最多的文本条数，超过时按“请求过大”失败，0 表示不限
+    """
+    def __init__(self, dimension: int = 8, latency: float = 0.0, error_rate: float = 0.0, max_batch: int = 0):
+        self.dimension = dimension
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_batch = max_batch
+        self.calls = 0
+        self.inputs = 0
+
+    def __call__(self, input):
+        texts = [input] if isinstance(input, str) else list(input)
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            raise RuntimeError("stand-in embedding endpoint failed")
+        if self.max_batch and len(texts) > self.max_batch:
+            raise ValueError(f"batch of {len(texts)} is too large")
+        self.inputs += len(texts)
+        return [fake_vector(text, self.dimension) for text in texts]
+
+
+class StandInServer:
+    """
+    本地替身服务，提供OpenAI兼容的 /embeddings 和 /chat/completions 接口。
+    把 embedding_endpoints 中的url指向它即可在本地测试负载均衡、限流和故障转移；
+    把 Base_llm 的base_url指向它可以测试 send 和 send_stream，stream为真时按SSE逐块返回。
+
+    :param host: 监听地址
+    :param port: 监听端口，0 表示随机分配
+    :param dimension: 向量维度
+    :param latency: 每个请求的延迟（秒）
+    :param error_rate: 随机返回500的概率
+    :param reply: chat/completions 返回的文本
+    :param tool_calls: chat/completions 返回的工具调用，流式返回时把arguments拆成多块
+    :param chunk_size: 流式返回时每块的字符数
+    :param chunk_delay: 流式返回时每块之间的间隔（秒）
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, dimension: int = 8,
+                 latency: float = 0.0, error_rate: float = 0.0, reply: str = "你好，我是本地替身。",
+                 tool_calls: Optional[list[dict]] = None, chunk_size: int = 4, chunk_delay: float = 0.0):
+        self.dimension = dimension
+        self.latency = latency
+        self.error_rate = error_rate
+        self.reply = reply
+        self.tool_calls = tool_calls or []
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        # 收到的请求体，按到达顺序保存
+        self.requests: list[dict[str, Any]] = []
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status: int, content: dict):
+                body = json.dumps(content).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    payload = json.loads(self.rfile.read(length) or b"{}")
+                except json.JSONDecodeError:
+                    return self.send_json(400, {"error": {"message": "invalid json"}})
+                stand_in.requests.append(payload)
+                if stand_in.latency:
+                    time.sleep(stand_in.latency)
+                if stand_in.error_rate and random.random() < stand_in.error_rate:
+                    return self.send_json(500, {"error": {"message": "stand-in failure"}})
+                path = self.path.rstrip("/")
+                if path.endswith("/embeddings"):
+                    return self.send_json(200, stand_in.embeddings(payload))
+                if path.endswith("/chat/completions"):
+                    if not payload.get("stream"):
+                        return self.send_json(200, stand_in.completion(payload))
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.send_header("Cache-Control", "no-cache")
+                    self.end_headers()
+                    for chunk in stand_in.completion_chunks(payload):
+                        self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                        self.wfile.flush()
+                        if stand_in.chunk_delay:
+                            time.sleep(stand_in.chunk_delay)
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    self.wfile.flush()
+                    return
+                self.send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+
+        return Handler
+
+    def embeddings(self, payload: dict) -> dict:
+        texts = payload.get("input") or []
+        texts = [texts] if isinstance(texts, str) else texts
+        data = []
+        for index, text in enumerate(texts):
+            vector: Any = fake_vector(str(text), self.dimension)
+            if payload.get("encoding_format") == "base64":
+                vector = base64.b64encode(struct.pack(f"<{len(vector)}f", *vector)).decode("ascii")
+            data.append({"object": "embedding", "index": index, "embedding": vector})
+        tokens = sum(len(str(text)) for text in texts)
+        return {"object": "list", "data": data, "model": payload.get("model", "stand-in"),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+    def usage(self, payload: dict) -> dict:
+        prompt_tokens = sum(len(json.dumps(message.get("content"), ensure_ascii=False))
+                            for message in payload.get("messages") or [])
+        completion_tokens = len(self.reply)
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens}
+
+    def completion(self, payload: dict) -> dict:
+        message: dict[str, Any] = {"role": "assistant", "content": self.reply or None}
+        if self.tool_calls:
+            message["tool_calls"] = self.tool_calls
+        return {"id": "chatcmpl-stand-in", "object": "chat.completion", "model": payload.get("model", "stand-in"),
+                "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if self.tool_calls else "stop"}],
+                "usage": self.usage(payload)}
+
+    def completion_chunks(self, payload: dict):
+        def chunk(delta: dict, finish_reason: Optional[str] = None) -> dict:
+            return {"id": "chatcmpl-stand-in", "object": "chat.completion.chunk", "model": payload.get("model", "stand-in"),
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+        yield chunk({"role": "assistant", "content": ""})
+        for start in range(0, len(self.reply), self.chunk_size):
+            yield chunk({"content": self.reply[start:start+self.chunk_size]})
+        for index, call in enumerate(self.tool_calls):
+            function = call.get("function") or {}
+            yield chunk({"tool_calls": [{"index": index, "id": call.get("id", f"call_{index}"), "type": "function",
+                                         "function": {"name": function.get("name", ""), "arguments": ""}}]})
+            arguments = function.get("arguments", "")
+            for start in range(0, len(arguments), self.chunk_size):
+                yield chunk({"tool_calls": [{"index": index, "function": {"arguments": arguments[start:start+self.chunk_size]}}]})
+        yield chunk({}, "tool_calls" if self.tool_calls else "stop")
+        if (payload.get("stream_options") or {}).get("include_usage"):
+            yield {"id": "chatcmpl-stand-in", "object": "chat.completion.chunk", "choices": [], "usage": self.usage(payload)}
+
+    def start(self) -> "StandInServer":
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="local stand-in for OpenAI compatible endpoints")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--dimension", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--reply", default="你好，我是本地替身。")
+    parser.add_argument("--chunk-delay", type=float, default=0.0)
+    args = parser.parse_args()
+    server = StandInServer(args.host, args.port, dimension=args.dimension, latency=args.latency, error_rate=args.error_rate,
+                           reply=args.reply, chunk_delay=args.chunk_delay)
+    print(f"stand-in server listening on {server.url}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
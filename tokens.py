@@ -0,0 +1,73 @@
+import re
+import json
+from typing import List
+
+# CJK 字符大致一个字符一个token，其余字符按 4 个字符一个token 估算
+_CJK = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯＀-￯]")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    在本地粗略估算文本的token数量，不发起任何请求。
+
+    :param text: 文本
+    :return: 估算的token数量
+    """
+    cjk = len(_CJK.findall(text))
+    rest = len(text) - cjk
+    return cjk + (rest + 3) // 4
+
+
+def split_by_tokens(text: str, max_tokens: int) -> List[str]:
+    """
+    按估算的token数量把文本切成若干段，每段不超过max_tokens。
+
+    :param text: 文本
+    :param max_tokens: 每段的最大token数量
+    :return: 文本片段列表
+    """
+    if max_tokens <= 0:
+        raise ValueError("max_tokens should be positive")
+    pieces = []
+    start = 0
+    cost = 0.0
+    for index, char in enumerate(text):
+        weight = 1.0 if _CJK.match(char) else 0.25
+        if cost + weight > max_tokens and index > start:
+            pieces.append(text[start:index])
+            start = index
+            cost = 0.0
+        cost += weight
+    if start < len(text) or not pieces:
+        pieces.append(text[start:])
+    return pieces
+
+
+# 每条消息的角色、分隔符等固定开销，以及图片和音频按固定数量估算
+MESSAGE_OVERHEAD = 4
+IMAGE_TOKENS = 1000
+AUDIO_TOKENS = 1000
+
+
+def message_tokens(message: dict) -> int:
+    """
+    在本地估算一条聊天消息的token数量。
+
+    :param message: OpenAI格式的消息
+    :return: 估算的token数量
+    """
+    tokens = MESSAGE_OVERHEAD
+    content = message.get("content")
+    if isinstance(content, str):
+        tokens += estimate_tokens(content)
+    elif isinstance(content, list):
+        for part in content:
+            if part.get("type") == "text":
+                tokens += estimate_tokens(part.get("text", ""))
+            elif part.get("type") == "image_url":
+                tokens += IMAGE_TOKENS
+            elif part.get("type") == "input_audio":
+                tokens += AUDIO_TOKENS
+    if message.get("tool_calls"):
+        tokens += estimate_tokens(json.dumps(message["tool_calls"], ensure_ascii=False))
+    return tokens
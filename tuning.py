@@ -0,0 +1,229 @@
+import time
+import argparse
+import json
+import logging
+from uuid import uuid4
+from typing import Any, Optional
+
+import numpy as np
+
+
+def exact_neighbors(vectors: np.ndarray, queries: np.ndarray, k: int, space: str = "l2") -> np.ndarray:
+    """
+    用NumPy暴力计算每个查询的前k个近邻，作为召回率的基准。
+
+    :param vectors: 所有向量，形状为 (n, d)
+    :param queries: 查询向量，形状为 (q, d)
+    :param k: 近邻数量
+    :param space: 距离空间，"l2"、"ip" 或 "cosine"
+    :return: 近邻下标，形状为 (q, k)
+    """
+    if space == "cosine":
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        distances = 1 - queries @ vectors.T
+    elif space == "ip":
+        distances = 1 - queries @ vectors.T
+    elif space == "l2":
+        distances = (queries ** 2).sum(axis=1)[:, None] - 2 * queries @ vectors.T + (vectors ** 2).sum(axis=1)[None, :]
+    else:
+        raise ValueError(f"unknown hnsw space {space}")
+    k = min(k, vectors.shape[0])
+    nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    order = np.take_along_axis(distances, nearest, axis=1).argsort(axis=1)
+    return np.take_along_axis(nearest, order, axis=1)
+
+
+def measure(client, vectors: np.ndarray, queries: np.ndarray, truth: np.ndarray, k: int,
+            space: str, m: int, construction_ef: int, search_ef: int) -> dict:
+    """
+    用给定参数在临时集合中建索引，测量recall@k和查询延迟。
+    """
+    name = f"tune_{uuid4().hex[:16]}"
+    collection = client.create_collection(name=name, metadata={
+        "hnsw:space": space,
+        "hnsw:M": m,
+        "hnsw:construction_ef": construction_ef,
+        "hnsw:search_ef": search_ef,
+    })
+    try:
+        ids = [str(i) for i in range(len(vectors))]
+        size = client.get_max_batch_size()
+        start = time.perf_counter()
+        for offset in range(0, len(ids), size):
+            collection.add(ids=ids[offset:offset+size], embeddings=vectors[offset:offset+size].tolist())
+        build_seconds = time.perf_counter() - start
+        latencies = []
+        hits = 0
+        for query, expected in zip(queries, truth):
+            start = time.perf_counter()
+            result = collection.query(query_embeddings=[query.tolist()], n_results=len(expected), include=[])
+            latencies.append((time.perf_counter() - start) * 1000)
+            found = {int(i) for i in result["ids"][0]}
+            hits += len(found & {int(i) for i in expected})
+    finally:
+        client.delete_collection(name)
+    return {
+        "M": m,
+        "construction_ef": construction_ef,
+        "search_ef": search_ef,
+        "recall": round(hits / max(truth.size, 1), 4),
+        "latency_ms_mean": round(float(np.mean(latencies)), 3),
+        "latency_ms_p95": round(float(np.percentile(latencies, 95)), 3),
+        "build_seconds": round(build_seconds, 3),
+    }
+
+
+# 建索引时确定、不能通过modify修改的键
+BUILD_KEYS = {"hnsw:space", "hnsw:M", "hnsw:construction_ef"}
+
+
+def sample_embeddings(collection, max_vectors: int, rng: np.random.Generator, block: int = 1000) -> np.ndarray:
+    """
+    按limit/offset分块读取向量，集合超过max_vectors时随机抽取若干块，不一次性加载整个集合。
+
+    :param collection: chromadb集合
+    :param max_vectors: 最多读取的向量数量
+    :param rng: 随机数生成器
+    :param block: 每次读取的数量
+    :return: 向量，形状为 (n, d)
+    """
+    total = collection.count()
+    starts = np.arange(0, total, block)
+    if total > max_vectors:
+        starts = np.sort(rng.choice(starts, min(-(-max_vectors // block), len(starts)), replace=False))
+    chunks = []
+    for start in starts:
+        embeddings = collection.get(limit=block, offset=int(start), include=["embeddings"]).get("embeddings")
+        if embeddings is not None and len(embeddings):
+            chunks.append(np.asarray(embeddings, dtype=np.float32))
+    if not chunks:
+        return np.empty((0, 0), dtype=np.float32)
+    vectors = np.concatenate(chunks)
+    if len(vectors) > max_vectors:
+        vectors = vectors[rng.choice(len(vectors), max_vectors, replace=False)]
+    return vectors
+
+
+def apply_search_ef(collection, search_ef: int) -> None:
+    """
+    把search_ef写回集合。新版chroma通过configuration修改；旧版只能整体替换metadata，
+    且拒绝 hnsw:space 等建索引时确定的键，因此只发送其余的键。
+    """
+    import inspect
+    if "configuration" in inspect.signature(collection.modify).parameters:
+        collection.modify(configuration={"hnsw": {"ef_search": search_ef}})
+        return
+    metadata = dict(collection.metadata or {})
+    if metadata.get("hnsw:space", "l2") != "l2":
+        # 替换metadata会丢掉距离空间，之后的相似度会按l2换算
+        raise ValueError(f"this chroma version cannot change search_ef of a {metadata['hnsw:space']} collection "
+                         f"without dropping hnsw:space, rebuild the collection instead")
+    metadata = {key: value for key, value in metadata.items() if key not in BUILD_KEYS}
+    metadata["hnsw:search_ef"] = search_ef
+    collection.modify(metadata=metadata)
+
+
+def tune_collection(collection,
+                    k: int = 10,
+                    sample_size: int = 100,
+                    max_vectors: int = 20000,
+                    search_ef_values: list[int] = [10, 20, 40, 80, 160, 320],
+                    m_values: list[int] = [16, 32],
+                    construction_ef_values: list[int] = [100, 200],
+                    target_recall: float = 0.95,
+                    apply: bool = False,
+                    seed: Optional[int] = None) -> dict:
+    """
+    对集合做HNSW参数扫描：抽样已存储的向量，留出一部分作为查询（不放入索引，避免查询命中自身），
+    暴力计算真实近邻，在临时的内存集合中逐组参数测量recall@k和延迟，选出满足目标召回率且最快的参数。
+
+    :param collection: 要调优的chromadb集合
+    :param k: 计算recall@k的k
+    :param sample_size: 查询样本数量
+    :param max_vectors: 参与测量的最大向量数量，超过时随机抽样
+    :param search_ef_values: 扫描的search_ef取值
+    :param m_values: 扫描的M取值
+    :param construction_ef_values: 扫描的construction_ef取值
+    :param target_recall: 目标召回率
+    :param apply: 只需调整search_ef时是否直接写回集合
+    :param seed: 随机种子
+    :return: 扫描结果、推荐参数、是否已应用或需要重建，应用失败时包含apply_error
+    """
+    import chromadb
+    rng = np.random.default_rng(seed)
+    sampled = sample_embeddings(collection, max_vectors, rng)
+    if len(sampled) < 2:
+        raise ValueError(f"collection {collection.name} needs at least 2 embeddings to tune")
+    held_out = np.zeros(len(sampled), dtype=bool)
+    held_out[rng.choice(len(sampled), min(sample_size, len(sampled) // 2), replace=False)] = True
+    queries = sampled[held_out]
+    vectors = sampled[~held_out]
+    metadata: dict[str, Any] = dict(collection.metadata or {})
+    space = metadata.get("hnsw:space", "l2")
+    truth = exact_neighbors(vectors, queries, k, space)
+
+    client = chromadb.EphemeralClient()
+    results = []
+    for m in m_values:
+        for construction_ef in construction_ef_values:
+            for search_ef in search_ef_values:
+                result = measure(client, vectors, queries, truth, k, space, m, construction_ef, search_ef)
+                logging.info(f"hnsw tuning {result}")
+                results.append(result)
+
+    passing = [r for r in results if r["recall"] >= target_recall]
+    if passing:
+        best = min(passing, key=lambda r: r["latency_ms_mean"])
+    else:
+        best = max(results, key=lambda r: (r["recall"], -r["latency_ms_mean"]))
+    recommended = {
+        "hnsw:space": space,
+        "hnsw:M": best["M"],
+        "hnsw:construction_ef": best["construction_ef"],
+        "hnsw:search_ef": best["search_ef"],
+    }
+    # M 和 construction_ef 只在建索引时生效，和当前不同时只能重建集合
+    rebuild = (metadata.get("hnsw:M", 16) != best["M"]
+               or metadata.get("hnsw:construction_ef", 100) != best["construction_ef"])
+    applied = False
+    apply_error = None
+    if apply and not rebuild:
+        try:
+            apply_search_ef(collection, best["search_ef"])
+            applied = True
+        except Exception as e:
+            logging.warning(f"failed to apply search_ef to {collection.name}: {e}")
+            apply_error = str(e)
+    report = {
+        "collection": collection.name,
+        "k": k,
+        "vectors": len(vectors),
+        "queries": len(queries),
+        "target_recall": target_recall,
+        "met_target": bool(passing),
+        "results": results,
+        "recommended": recommended,
+        "rebuild_recommended": rebuild,
+        "applied": applied,
+    }
+    if apply_error:
+        report["apply_error"] = apply_error
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HNSW参数调优")
+    parser.add_argument("--path", type=str, required=True, help="chromadb存储路径")
+    parser.add_argument("--collection", type=str, required=True, help="集合名称")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--sample", type=int, default=100)
+    parser.add_argument("--target", type=float, default=0.95)
+    parser.add_argument("--apply", action="store_true")
+    args = parser.parse_args()
+
+    import chromadb
+    collection = chromadb.PersistentClient(path=args.path).get_collection(args.collection)
+    report = tune_collection(collection, k=args.k, sample_size=args.sample,
+                             target_recall=args.target, apply=args.apply)
+    print(json.dumps(report, ensure_ascii=False, indent=4))